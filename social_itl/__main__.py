@@ -1,11 +1,14 @@
 from social_itl.furhat import Furhat, DisconnectError
 from social_itl.tasklearning.agent import FurhatAgent
-from .lfd import LfD
+from .lfd import LfD, PooledLfD, ContextWindow
+from .calibration import decide, enable_score_log, use_thresholds
+from typing import Optional
 import asyncio
 import argparse
 import websockets
+from functools import partial
 
-async def run_experiment(furhat: FurhatAgent, gui_state):
+async def run_experiment(furhat: FurhatAgent, gui_state, pooled: Optional[PooledLfD] = None, lfd_context: bool = False):
     async def update_gui_state(event):
         while True:
             event = {"event_name": "ServerEvent", "type": "GUIState", **gui_state}
@@ -18,6 +21,12 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
             await event_queue.put(event)
         print("Event handler done")
     event_handler_task = asyncio.create_task(event_handler())
+    # LfD models stay loaded for the session, so testing uses the pairs learned so far without reloading them
+    lfds = {}
+    def get_lfd(participant_id):
+        if participant_id not in lfds:
+            lfds[participant_id] = LfD(participant_id)
+        return lfds[participant_id]
     try:
         cmd = await event_queue.get()
         while True:
@@ -39,7 +48,7 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
                 if cmd['mode'] == 'Learning':
                     print('Learning')
                     gui_state['LfDMode'] = 'Learning'
-                    lfd = LfD(gui_state['participantId'])
+                    lfd = get_lfd(gui_state['participantId'])
                     lfd_task = asyncio.create_task(lfd.train(furhat.dyadicSpeech()))
                     cmd = await event_queue.get()
                     print("Cancelling")
@@ -47,27 +56,46 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
                     await lfd_task
                     print("Cancelled")
                     lfd.save()
-                    print(lfd.pairs)
                     gui_state['LfDMode'] = 'Idle'
                 elif cmd['mode'] == 'Testing':
                     print('Testing')
                     gui_state['LfDMode'] = 'Testing'
+                    reject = lambda: None
                     try:
-                        lfd = LfD(gui_state['participantId'])
-                        load_task = asyncio.get_event_loop().run_in_executor(None, lfd.load)
-                        await load_task
+                        if pooled is not None:
+                            await asyncio.get_event_loop().run_in_executor(None, pooled.sync, lfds)
+                            get_action = pooled.get_action
+                        else:
+                            lfd = get_lfd(gui_state['participantId'])
+                            if not lfd.pairs:
+                                raise FileNotFoundError
+                            # Only embeds pairs the background worker has not got to yet
+                            await asyncio.get_event_loop().run_in_executor(None, lfd.vectorize)
+                            get_action = lfd.get_action
+                            if lfd_context:
+                                window = ContextWindow(lfd)
+                                get_action = lambda speech, action: window.get_action(speech)
+                                reject = window.undo
                         action = ''
                         cancel = asyncio.Event()
                         async def cancel_lfd():
                             cmd = await event_queue.get()
                             cancel.set()
                         cancel_task = asyncio.create_task(cancel_lfd())
-                        while not cancel.is_set():
-                            speech = await furhat.listen(noSpeechTimeout=4000)
-                            if cancel.is_set():
-                                break
-                            action, confidence = lfd.get_action(speech, action)
-                            await furhat.say(action)
+                        with furhat.log(f'Participant-{gui_state["participantId"]}', 'lfd_test', gui_state['participantId']) as logger:
+                            while not cancel.is_set():
+                                speech = await furhat.listen(noSpeechTimeout=4000)
+                                if cancel.is_set():
+                                    break
+                                match, confidence = get_action(speech, action)
+                                logger.info(f"Match distance: {confidence:.4f}")
+                                if not decide('lfd', confidence, speech):
+                                    # Too far from every demonstration, ask again rather than answer
+                                    reject()
+                                    await furhat.say("Sorry, could you say that another way?")
+                                    continue
+                                action = match
+                                await furhat.say(action)
                         print("Cancelling")
                         cancel_task.cancel()
                     except FileNotFoundError:
@@ -77,22 +105,41 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
                 elif cmd['mode'] == 'Evaluating':
                     print('Evaluating')
                     gui_state['LfDMode'] = 'Evaluating'
+                    reject = lambda: None
                     try:
-                        lfd = LfD(str(int(gui_state['participantId']) - 1))
-                        load_task = asyncio.get_event_loop().run_in_executor(None, lfd.load)
-                        await load_task
+                        if pooled is not None:
+                            # Everyone's demonstrations except the participant being evaluated
+                            await asyncio.get_event_loop().run_in_executor(None, pooled.sync, lfds)
+                            get_action = partial(pooled.get_action, exclude=[gui_state['participantId']])
+                        else:
+                            lfd = get_lfd(str(int(gui_state['participantId']) - 1))
+                            if not lfd.pairs:
+                                raise FileNotFoundError
+                            await asyncio.get_event_loop().run_in_executor(None, lfd.vectorize)
+                            get_action = lfd.get_action
+                            if lfd_context:
+                                window = ContextWindow(lfd)
+                                get_action = lambda speech, action: window.get_action(speech)
+                                reject = window.undo
                         action = ''
                         cancel = asyncio.Event()
                         async def cancel_lfd():
                             cmd = await event_queue.get()
                             cancel.set()
                         cancel_task = asyncio.create_task(cancel_lfd())
-                        with furhat.log(f'Participant-{gui_state["participantId"]}', 'lfd_eval'):
+                        with furhat.log(f'Participant-{gui_state["participantId"]}', 'lfd_eval', gui_state['participantId']) as logger:
                             while not cancel.is_set():
                                 speech = await furhat.listen(noSpeechTimeout=4000)
                                 if cancel.is_set():
                                     break
-                                action, confidence = lfd.get_action(speech, action)
+                                match, confidence = get_action(speech, action)
+                                logger.info(f"Match distance: {confidence:.4f}")
+                                if not decide('lfd', confidence, speech):
+                                    # Too far from every demonstration, ask again rather than answer
+                                    reject()
+                                    await furhat.say("Sorry, could you say that another way?")
+                                    continue
+                                action = match
                                 await furhat.say(action)
                         print("Cancelling")
                         cancel_task.cancel()
@@ -135,7 +182,7 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
                 elif cmd['mode'] == 'Evaluating':
                     print('Evaluating')
                     gui_state['ITLMode'] = 'Evaluating'
-                    with furhat.log(f'Participant-{gui_state["participantId"]}', 'itl_eval'):
+                    with furhat.log(f'Participant-{gui_state["participantId"]}', 'itl_eval', gui_state['participantId']):
                         itl_task = asyncio.create_task(furhat.execute(int(gui_state['participantId']) - 1, skip_intro=True))
                         async def cancel_itl():
                             cmd = await event_queue.get()
@@ -160,22 +207,30 @@ async def run_experiment(furhat: FurhatAgent, gui_state):
         event_handler_task.cancel()
 
 async def loop(args):
-    furhat = FurhatAgent(host=args.host, port=args.port)
+    parser_kwargs = {'device': args.device, 'quantize': args.quantize, 'onnx': args.onnx, 'joint': args.joint}
+    if args.student:
+        parser_kwargs.update(anonymizer_model='bert-model-student', parser_model='parse-model-student')
+    furhat = FurhatAgent(host=args.host, port=args.port, parser_kwargs=parser_kwargs, record=args.record)
     gui_state = {"mode": "", "participantId": "1", "ITLMode": "Idle", "LfDMode": "Idle"}
+    pooled = PooledLfD() if args.pooled_lfd else None
     # async with furhat.connect():
     #     print('Connected to Furhat')
     #     await run_experiment(furhat, gui_state)
+    # Short drops are handled inside Furhat.connect, this only runs once it has given up
+    delay = 1
     while True:
         try:
             async with furhat.connect():
                 print('Connected to Furhat')
-                await run_experiment(furhat, gui_state)
+                delay = 1
+                await run_experiment(furhat, gui_state, pooled, args.lfd_context)
         except DisconnectError:
             print('Disconnected from Furhat')
-            await asyncio.sleep(5)
-        except websockets.exceptions.WebSocketException as e:
+        except (OSError, websockets.exceptions.WebSocketException) as e:
             print("Websocket error:", e)
-            await asyncio.sleep(5)
+        print(f"Retrying in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
 
 
 def main():
@@ -183,7 +238,22 @@ def main():
     parser.add_argument('--host', type=str, default='localhost')
     parser.add_argument('--port', type=int, default=80)
     parser.add_argument('--sim', type=bool, default=False)
+    parser.add_argument('--device', type=str, default=None, help='Device for the parsing models, defaults to cuda when available')
+    parser.add_argument('--quantize', action='store_true', help='Use dynamic int8 quantized parsing models (CPU only)')
+    parser.add_argument('--onnx', action='store_true', help='Run the parsing models with ONNX Runtime')
+    parser.add_argument('--record', nargs='?', const=True, default=None, help='Record the raw event stream, optionally to the given directory')
+    lfd_mode = parser.add_mutually_exclusive_group()
+    lfd_mode.add_argument('--pooled-lfd', action='store_true', help='Answer LfD tests from the demonstrations of all participants, evaluation leaves out the current one')
+    lfd_mode.add_argument('--lfd-context', action='store_true', help='Match LfD tests on the last few turns as well, with the weights from python -m social_itl.lfd --fit-context')
+    parser.add_argument('--thresholds-version', type=int, default=None, help='Decision thresholds to use, see python -m social_itl.calibration show. Defaults to the latest')
+    parser.add_argument('--no-score-log', action='store_true', help='Do not record decision scores in the session store')
+    models = parser.add_mutually_exclusive_group()
+    models.add_argument('--student', action='store_true', help='Use the distilled student models, see social_itl.nlp.distill')
+    models.add_argument('--joint', action='store_true', help='Parse with the single pass model from train_parser --joint instead of BERT and T5')
     args = parser.parse_args()
+    use_thresholds(args.thresholds_version)
+    if not args.no_score_log:
+        enable_score_log()
     asyncio.run(loop(args))
 
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+import hashlib
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+from social_itl.artifacts import store
+from social_itl.session_store import SessionStore, log_name, parse_turn, read_log
+from social_itl.utils import get_data_path
+
+columns = ['kind', 'participant', 'session', 'time', 'speaker', 'text', 'label', 'distance']
+match_line = re.compile(r'^Match distance: ([-+\d.eE]+|inf|nan)')
+# What the learning dialog says when TreeParser raises ParseError
+parse_failure_prompt = "I'm sorry, I don't quite understand what you said"
+user_speakers = ['user', 'response', 'customer']
+
+def read_session(path: Path) -> pd.DataFrame:
+    """One row per turn or LfD match of a text log"""
+    participant = log_name.match(path.name).group(1)
+    rows = []
+    for when, message in read_log(path):
+        match = match_line.match(message)
+        if match is not None:
+            rows.append((when, 'match', '', None, float(match.group(1))))
+            continue
+        turn = parse_turn(message)
+        if turn is not None:
+            rows.append((when, *turn, np.nan))
+    frame = pd.DataFrame(rows, columns=['time', 'speaker', 'text', 'label', 'distance'])
+    frame.insert(0, 'session', path.stem)
+    frame.insert(0, 'participant', participant)
+    frame.insert(0, 'kind', path.parent.name)
+    return frame
+
+def cache_path(path: Path) -> Path:
+    return get_data_path('analytics-cache') / f'{hashlib.sha1(str(path.resolve()).encode()).hexdigest()}.pkl'
+
+def scan_logs(log_dir: Path, kinds: Optional[List[str]] = None, workers: Optional[int] = None) -> pd.DataFrame:
+    """Turns of every session log under log_dir. Logs are only parsed again when their mtime or size changed"""
+    paths = [p for p in sorted(Path(log_dir).glob('*/*.txt')) if log_name.match(p.name) and (kinds is None or p.parent.name in kinds)]
+    frames = {}
+    stale = []
+    for path in paths:
+        stat = path.stat()
+        cached = cache_path(path)
+        if cached.exists():
+            with open(cached, 'rb') as f:
+                entry = pickle.load(f)
+            if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                frames[path] = entry['frame']
+                continue
+        stale.append((path, stat))
+    print(f"{len(paths)} session logs, {len(stale)} new or changed")
+    if stale:
+        cache_path(stale[0][0]).parent.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(workers) as executor:
+            for (path, stat), frame in zip(stale, executor.map(read_session, [p for p, _ in stale], chunksize=16)):
+                frames[path] = frame
+                with open(cache_path(path), 'wb') as f:
+                    pickle.dump({'mtime': stat.st_mtime, 'size': stat.st_size, 'frame': frame}, f)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([frames[p] for p in paths], ignore_index=True)
+
+def read_store(session_store: SessionStore, kinds: Optional[List[str]] = None) -> pd.DataFrame:
+    """The same table as scan_logs, from the session store. Parse failures come from the parses table"""
+    rows = session_store.query("""
+        SELECT s.kind, s.participant_id AS participant, s.id AS session, t.time, t.speaker, t.text, t.label, NULL AS distance
+        FROM turns t JOIN sessions s ON s.id = t.session_id
+        UNION ALL
+        SELECT s.kind, s.participant_id, s.id, p.time, 'parse', p.sentence, CASE WHEN p.accepted THEN 'accepted' ELSE 'failed' END, NULL
+        FROM parses p JOIN sessions s ON s.id = p.session_id
+        ORDER BY 3, 4""")
+    frame = pd.DataFrame([tuple(row) for row in rows], columns=columns)
+    if kinds is not None:
+        frame = frame[frame['kind'].isin(kinds)]
+    frame['distance'] = frame['distance'].astype(float)
+    return frame.reset_index(drop=True)
+
+def session_metrics(turns: pd.DataFrame) -> pd.DataFrame:
+    turns = turns.sort_values(['session', 'time'], kind='stable')
+    is_user = turns['speaker'].isin(user_speakers)
+    metrics = turns.assign(
+        user_turn=is_user,
+        empty=is_user & turns['text'].eq(''),
+        unknown=turns['label'].eq('SentenceType.UNKNOWN'),
+        uncertain=turns['label'].eq('SentenceType.UNCERTAIN'),
+        parse_failure=(turns['speaker'].eq('prompt') & turns['text'].str.startswith(parse_failure_prompt)) | turns['label'].eq('failed'),
+        latency=latencies(turns),
+    ).groupby(['kind', 'participant', 'session'], sort=False).agg(
+        start=('time', 'min'),
+        end=('time', 'max'),
+        turns=('user_turn', 'sum'),
+        empty=('empty', 'sum'),
+        unknown=('unknown', 'sum'),
+        uncertain=('uncertain', 'sum'),
+        parse_failures=('parse_failure', 'sum'),
+        latency_median=('latency', 'median'),
+        distance_median=('distance', 'median'),
+    ).reset_index()
+    metrics['duration'] = metrics['end'] - metrics['start']
+    turns_or_nan = metrics['turns'].replace(0, np.nan)
+    metrics['empty_rate'] = metrics['empty'] / turns_or_nan
+    metrics['unknown_rate'] = metrics['unknown'] / turns_or_nan
+    metrics['uncertain_rate'] = metrics['uncertain'] / turns_or_nan
+    return metrics
+
+def summary(turns: pd.DataFrame, sessions: pd.DataFrame) -> pd.DataFrame:
+    """Totals per kind of session, rates are over all user turns rather than a mean of session rates"""
+    totals = sessions.groupby('kind').agg(
+        participants=('participant', 'nunique'),
+        sessions=('session', 'count'),
+        turns_per_session=('turns', 'mean'),
+        turns=('turns', 'sum'),
+        empty=('empty', 'sum'),
+        unknown=('unknown', 'sum'),
+        uncertain=('uncertain', 'sum'),
+        parse_failures=('parse_failures', 'sum'),
+        duration_median=('duration', 'median'),
+    )
+    turns_or_nan = totals['turns'].replace(0, np.nan)
+    totals['empty_rate'] = totals['empty'] / turns_or_nan
+    totals['unknown_rate'] = totals['unknown'] / turns_or_nan
+    totals['uncertain_rate'] = totals['uncertain'] / turns_or_nan
+    latency = latencies(turns).groupby(turns['kind']).quantile([0.5, 0.95]).unstack()
+    if not latency.empty:
+        totals['latency_median'] = latency[0.5]
+        totals['latency_p95'] = latency[0.95]
+    distances = turns.loc[turns['speaker'].eq('match')].groupby('kind')['distance']
+    totals['matches'] = distances.count()
+    totals['distance_median'] = distances.median()
+    return totals.reset_index()
+
+def latencies(turns: pd.DataFrame) -> pd.Series:
+    """Seconds from a user turn to the robot turn right after it, indexed like turns"""
+    # Match distances are logged between the two turns
+    turns = turns[turns['speaker'].isin(user_speakers + ['robot'])].sort_values(['session', 'time'], kind='stable')
+    is_user = turns['speaker'].isin(user_speakers)
+    follows_user = is_user.groupby(turns['session']).shift(1, fill_value=False).astype(bool)
+    previous = turns['time'].groupby(turns['session']).shift(1)
+    return (turns['time'] - previous).where(turns['speaker'].eq('robot') & follows_user).dropna()
+
+def histograms(turns: pd.DataFrame, sessions: pd.DataFrame, output: Path, bins: int = 30):
+    data = {
+        'latency': latencies(turns),
+        'distance': turns.loc[turns['speaker'].eq('match'), 'distance'].dropna(),
+        'turns_per_session': sessions['turns'].astype(float),
+    }
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        plt = None
+        print("matplotlib is not installed, writing histogram tables only")
+    for name, values in data.items():
+        values = values[np.isfinite(values)]
+        if values.empty:
+            continue
+        counts, edges = np.histogram(values, bins=bins)
+        pd.DataFrame({'low': edges[:-1], 'high': edges[1:], 'count': counts}).to_csv(output / f'{name}_histogram.csv', index=False)
+        if plt is not None:
+            fig, ax = plt.subplots(figsize=(6, 4))
+            ax.hist(values, bins=edges)
+            ax.set_xlabel(name.replace('_', ' '))
+            ax.set_ylabel('count')
+            fig.tight_layout()
+            fig.savefig(output / f'{name}.png')
+            plt.close(fig)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Aggregate metrics over the recorded study sessions')
+    parser.add_argument('--log-dir', type=Path, default=None, help='Defaults to the logs folder of the artifact store')
+    parser.add_argument('--store', action='store_true', help='Read the session store instead of the text logs')
+    parser.add_argument('--kinds', nargs='+', default=None, help='Only these kinds of session, e.g. learning_dialog lfd_eval')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--bins', type=int, default=30)
+    parser.add_argument('-o', '--output', type=Path, default=Path('analytics'))
+    args = parser.parse_args()
+
+    if args.store:
+        turns = read_store(SessionStore(), args.kinds)
+    else:
+        turns = scan_logs(args.log_dir or store.log_path(), args.kinds, args.workers)
+    args.output.mkdir(parents=True, exist_ok=True)
+    sessions = session_metrics(turns)
+    totals = summary(turns, sessions)
+    sessions.to_csv(args.output / 'sessions.csv', index=False)
+    totals.to_csv(args.output / 'summary.csv', index=False)
+    histograms(turns, sessions, args.output, args.bins)
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(totals.to_string(index=False))
+    print("Wrote", args.output)
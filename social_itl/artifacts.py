@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+from importlib_resources import files, as_file
+
+# Everything fetched from the Hugging Face hub at runtime, keyed by the name used in this package
+hub_artifacts = {
+    'bert-base-uncased': {'repo_id': 'bert-base-uncased', 'repo_type': 'model'},
+    't5-base': {'repo_id': 't5-base', 'repo_type': 'model'},
+    't5-small': {'repo_id': 't5-small', 'repo_type': 'model'},
+    'gpt-j-6B': {'repo_id': 'EleutherAI/gpt-j-6B', 'repo_type': 'model', 'revision': 'float16'},
+    'sup-simcse-bert-base-uncased': {'repo_id': 'princeton-nlp/sup-simcse-bert-base-uncased', 'repo_type': 'model'},
+    'daily_dialog': {'repo_id': 'daily_dialog', 'repo_type': 'dataset'},
+}
+
+# Weight formats we never load, skipped when a repo also has safetensors or pytorch weights
+unused_weights = ['*.h5', '*.msgpack', '*.ot', '*.onnx', 'onnx/*', 'tf_model*', 'flax_model*', 'rust_model*', 'coreml/*']
+
+class ArtifactMissingError(Exception):
+    pass
+
+def _package_root() -> Path:
+    with as_file(files('social_itl')) as p:
+        return Path(p)
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ArtifactStore:
+    def __init__(self, root: Optional[str] = None, offline: Optional[bool] = None):
+        if root is None:
+            root = os.environ.get('SOCIAL_ITL_HOME')
+        self.package_root = _package_root()
+        self.root = Path(root) if root is not None else self.package_root
+        if offline is None:
+            offline = os.environ.get('SOCIAL_ITL_OFFLINE', '0') not in ('', '0', 'false', 'False')
+        self.offline = offline
+        if offline:
+            # Must happen before transformers/datasets read their configuration
+            os.environ['HF_HUB_OFFLINE'] = '1'
+            os.environ['TRANSFORMERS_OFFLINE'] = '1'
+            os.environ['HF_DATASETS_OFFLINE'] = '1'
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.root / 'manifest.json'
+
+    def load_manifest(self) -> Dict:
+        if not self.manifest_path.exists():
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: Dict):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        tmp.replace(self.manifest_path)
+
+    def log_path(self) -> Path:
+        return self.root / 'logs'
+
+    def model_path(self, name: str) -> Path:
+        return self.root / 'models' / name
+
+    def hub_path(self, name: str) -> Path:
+        return self.root / 'hub' / name
+
+    def data_path(self, name: str) -> Path:
+        path = self.root / 'data' / name
+        # Files shipped with the package (grammar, word lists) are used unless the store overrides them
+        bundled = self.package_root / 'data' / name
+        if not path.exists() and bundled.exists():
+            return bundled
+        return path
+
+    def resolve(self, name: str) -> str:
+        """Local path for an artifact, or its hub id when it has not been prefetched and we are online"""
+        for path in (self.hub_path(name), self.model_path(name)):
+            if path.exists():
+                return str(path)
+        if name in hub_artifacts and not self.offline:
+            return hub_artifacts[name]['repo_id']
+        raise ArtifactMissingError(f'{name} is not in the artifact store at {self.root}, run `python -m social_itl.artifacts prefetch {name}`')
+
+    def from_pretrained(self, cls, name: str, **kwargs):
+        path = self.resolve(name)
+        if Path(path).exists():
+            # safetensors are memory-mapped instead of unpickled into memory
+            if any(Path(path).glob('*.safetensors')):
+                kwargs.setdefault('use_safetensors', True)
+        elif 'revision' in hub_artifacts.get(name, {}):
+            kwargs.setdefault('revision', hub_artifacts[name]['revision'])
+        return cls.from_pretrained(path, local_files_only=self.offline, **kwargs)
+
+    def load_dataset(self, name: str, **kwargs):
+        import datasets
+        path = self.hub_path(name)
+        if path.exists():
+            return datasets.load_from_disk(str(path))
+        if self.offline:
+            raise ArtifactMissingError(f'{name} is not in the artifact store at {self.root}, run `python -m social_itl.artifacts prefetch {name}`')
+        return datasets.load_dataset(hub_artifacts[name]['repo_id'], **kwargs)
+
+    def prefetch(self, name: str):
+        if self.offline:
+            raise ArtifactMissingError('Cannot prefetch in offline mode')
+        spec = hub_artifacts[name]
+        path = self.hub_path(name)
+        if spec['repo_type'] == 'dataset':
+            import datasets
+            datasets.load_dataset(spec['repo_id']).save_to_disk(str(path))
+        else:
+            from huggingface_hub import HfApi, snapshot_download
+            repo_files = HfApi().list_repo_files(spec['repo_id'], revision=spec.get('revision'))
+            ignore = list(unused_weights)
+            if any(f.endswith('.safetensors') for f in repo_files):
+                ignore.append('*.bin')
+            snapshot_download(spec['repo_id'], revision=spec.get('revision'), local_dir=str(path), ignore_patterns=ignore)
+        self.record(name, path)
+
+    def record(self, name: str, path: Optional[Path] = None):
+        if path is None:
+            path = Path(self.resolve(name))
+        checksums = {}
+        for f in sorted(path.rglob('*') if path.is_dir() else [path]):
+            if f.is_file() and '.cache' not in f.parts:
+                checksums[str(f.relative_to(path) if path.is_dir() else f.name)] = _sha256(f)
+        manifest = self.load_manifest()
+        manifest[name] = {
+            'path': str(path.relative_to(self.root)),
+            'source': hub_artifacts.get(name, {}).get('repo_id'),
+            'files': checksums,
+        }
+        self.save_manifest(manifest)
+
+    def verify(self, names: Optional[Iterable[str]] = None) -> List[str]:
+        manifest = self.load_manifest()
+        problems = []
+        for name in (names or manifest.keys()):
+            if name not in manifest:
+                problems.append(f'{name}: not in manifest')
+                continue
+            path = self.root / manifest[name]['path']
+            for rel, checksum in manifest[name]['files'].items():
+                f = path / rel if path.is_dir() else path
+                if not f.exists():
+                    problems.append(f'{name}: missing {rel}')
+                elif _sha256(f) != checksum:
+                    problems.append(f'{name}: checksum mismatch for {rel}')
+        return problems
+
+store = ArtifactStore()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['prefetch', 'verify', 'record', 'list'])
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--root', default=None)
+    args = parser.parse_args()
+    if args.root is not None:
+        store = ArtifactStore(args.root)
+    if args.command == 'prefetch':
+        for name in (args.names or hub_artifacts.keys()):
+            print("Prefetching", name)
+            store.prefetch(name)
+    elif args.command == 'record':
+        for name in args.names:
+            store.record(name)
+    elif args.command == 'verify':
+        problems = store.verify(args.names)
+        for problem in problems:
+            print(problem)
+        print("OK" if not problems else f"{len(problems)} problems")
+        exit(1 if problems else 0)
+    elif args.command == 'list':
+        for name, entry in store.load_manifest().items():
+            print(f"{name}: {entry['path']} ({len(entry['files'])} files)")
@@ -0,0 +1,219 @@
+import csv
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+from social_itl.utils import get_data_path
+
+# The cut-offs the decisions used before they were calibrated. LfD answered with its best match regardless of distance
+default_thresholds = {
+    'classify_ready': 0.65,
+    'classify_next': 0.7,
+    'person_says': 0.4,
+    'parse': 0.8,
+    'lfd': None,
+}
+# Classifier and parse scores are confidences, PersonSays and LfD scores are distances
+higher_is_better = {
+    'classify_ready': True,
+    'classify_next': True,
+    'person_says': False,
+    'parse': True,
+    'lfd': False,
+}
+
+def thresholds_path(version: Optional[int] = None) -> Path:
+    if version is None:
+        return get_data_path('calibration/thresholds.json')
+    return get_data_path(f'calibration/thresholds-v{version}.json')
+
+class Thresholds:
+    """A versioned set of decision thresholds, version 0 being the defaults"""
+    def __init__(self, thresholds: Dict = None, version: int = 0, fitted: Dict = None):
+        self.thresholds = {**default_thresholds, **(thresholds or {})}
+        self.version = version
+        self.fitted = fitted or {}
+
+    def __getitem__(self, decision: str):
+        return self.thresholds[decision]
+
+    def accept(self, decision: str, score: float) -> bool:
+        threshold = self.thresholds[decision]
+        if threshold is None:
+            return True
+        return score >= threshold if higher_is_better[decision] else score < threshold
+
+    @classmethod
+    def load(cls, version: Optional[int] = None) -> 'Thresholds':
+        path = thresholds_path(version)
+        if not path.exists():
+            if version not in (None, 0):
+                raise FileNotFoundError(f'No thresholds version {version}')
+            return cls()
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config['thresholds'], config['version'], config.get('fitted'))
+
+    def save(self) -> int:
+        """Store as the next version and make it current, returns the new version"""
+        self.version = Thresholds.load().version + 1
+        config = {'version': self.version, 'created': time.time(), 'thresholds': self.thresholds, 'fitted': self.fitted}
+        with open(thresholds_path(self.version), 'w') as f:
+            json.dump(config, f, indent=2)
+        tmp = thresholds_path().with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(config, f, indent=2)
+        tmp.replace(thresholds_path())
+        return self.version
+
+_thresholds = None
+score_log = False
+
+def get_thresholds() -> Thresholds:
+    global _thresholds
+    if _thresholds is None:
+        _thresholds = Thresholds.load()
+    return _thresholds
+
+def use_thresholds(version: Optional[int] = None):
+    global _thresholds
+    _thresholds = Thresholds.load(version)
+    print(f"Using decision thresholds version {_thresholds.version}")
+
+def enable_score_log():
+    """Record every decision score in the session store, meant for live sessions rather than offline tools"""
+    global score_log
+    score_log = True
+
+def log_score(decision: str, score: float, accepted: bool, text: str = None):
+    if score_log:
+        from social_itl.session_store import get_session_store
+        get_session_store().add_score(decision, float(score), accepted, text, get_thresholds().version)
+
+def decide(decision: str, score: float, text: str = None) -> bool:
+    """Whether to accept a decision with this score, logging the score when enabled"""
+    accepted = get_thresholds().accept(decision, float(score))
+    log_score(decision, score, accepted, text)
+    return accepted
+
+def fit_threshold(scores: np.ndarray, correct: np.ndarray, higher: bool, error_cost: float, clarify_cost: float) -> Dict:
+    """
+    Threshold with the lowest expected cost per decision. A rejected decision costs a clarification turn
+    whether or not it would have been right, an accepted wrong one costs error_cost turns to recover from.
+    """
+    if not higher:
+        scores = -scores
+    order = np.argsort(-scores, kind='stable')
+    scores, correct = scores[order], correct[order]
+    n = len(scores)
+    # Accepting the first k decisions, best score first, for every k at which the score changes
+    k = np.concatenate([[0], np.flatnonzero(np.diff(scores) != 0) + 1, [n]])
+    wrong = np.concatenate([[0], np.cumsum(~correct)])[k]
+    cost = (wrong * error_cost + (n - k) * clarify_cost) / n
+    best = int(np.argmin(cost))
+    # Halfway between the last accepted and the first rejected score, so it holds for < as well as >=
+    if k[best] == 0:
+        threshold = float(scores[0]) + 1e-6
+    elif k[best] == n:
+        threshold = float(scores[-1]) - 1e-6
+    else:
+        threshold = float(scores[k[best] - 1] + scores[k[best]]) / 2
+    return {
+        'threshold': threshold if higher else -threshold,
+        'expected_cost': float(cost[best]),
+        'accept_rate': float(k[best] / n),
+        'error_rate': float(wrong[best] / max(k[best], 1)),
+        'samples': n,
+    }
+
+def read_labels(path: Path) -> Dict[str, List]:
+    """(score, correct) per decision from a CSV or JSONL with decision, score and correct columns, unlabelled rows are skipped"""
+    rows = []
+    with open(path) as f:
+        if Path(path).suffix == '.jsonl':
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    labels = {}
+    for row in rows:
+        correct = row.get('correct')
+        if correct in (None, ''):
+            continue
+        if isinstance(correct, str):
+            correct = correct.strip().lower() in ('1', 'true', 'yes', 'y')
+        labels.setdefault(row['decision'], []).append((float(row['score']), bool(correct)))
+    return labels
+
+def export_scores(path: Path, decisions: Optional[List[str]] = None):
+    """Write the logged scores to a CSV with an empty correct column to label"""
+    from social_itl.session_store import get_session_store
+    rows = get_session_store().query('SELECT decision, time, score, accepted, text, thresholds_version FROM scores ORDER BY decision, time')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['decision', 'time', 'score', 'accepted', 'text', 'thresholds_version', 'correct'])
+        for row in rows:
+            if decisions is None or row['decision'] in decisions:
+                writer.writerow(list(row) + [''])
+    print(f"Wrote {len(rows)} scores to {path}")
+
+def score_summary(decisions: Optional[List[str]] = None, bins: int = 10):
+    """Distribution of the logged scores and the share of accepted decisions, per decision"""
+    from social_itl.session_store import get_session_store
+    for decision in decisions or list(default_thresholds):
+        rows = get_session_store().query('SELECT score, accepted FROM scores WHERE decision = ?', (decision,))
+        if not rows:
+            continue
+        scores = np.array([row['score'] for row in rows])
+        accepted = np.mean([row['accepted'] for row in rows])
+        print(f"{decision}: {len(scores)} decisions, {accepted:.1%} accepted, median {np.median(scores):.3f}")
+        counts, edges = np.histogram(scores, bins=bins)
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            print(f"    {low:7.3f} - {high:7.3f} {count:6d} {'#' * int(40 * count / max(counts.max(), 1))}")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Fit and inspect the decision thresholds')
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('show', help='Print the current thresholds and the distribution of the logged scores')
+    show.add_argument('--version', type=int, default=None)
+    export = commands.add_parser('export', help='Write the logged scores to a CSV to label')
+    export.add_argument('output', type=Path)
+    export.add_argument('--decisions', nargs='+', default=None)
+    fit = commands.add_parser('fit', help='Fit thresholds from labelled scores and save them as a new version')
+    fit.add_argument('labels', type=Path, help='CSV or JSONL with decision, score and correct columns')
+    fit.add_argument('--error-cost', type=float, default=3.0, help='Turns lost to an accepted wrong decision')
+    fit.add_argument('--clarify-cost', type=float, default=1.0, help='Turns lost to a clarification')
+    fit.add_argument('--min-samples', type=int, default=20)
+    fit.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        thresholds = Thresholds.load(args.version)
+        print(f"Version {thresholds.version}")
+        for decision, threshold in thresholds.thresholds.items():
+            print(f"    {decision:<16} {threshold}")
+        score_summary()
+    elif args.command == 'export':
+        export_scores(args.output, args.decisions)
+    else:
+        thresholds = Thresholds.load()
+        for decision, samples in read_labels(args.labels).items():
+            if decision not in default_thresholds:
+                print("Unknown decision", decision)
+                continue
+            if len(samples) < args.min_samples:
+                print(f"{decision}: only {len(samples)} labelled scores, keeping {thresholds[decision]}")
+                continue
+            scores, correct = map(np.array, zip(*samples))
+            result = fit_threshold(scores, correct.astype(bool), higher_is_better[decision], args.error_cost, args.clarify_cost)
+            # Cost of the current threshold on the same data, for comparison
+            current = thresholds[decision]
+            accepted = np.ones(len(scores), dtype=bool) if current is None else np.array([thresholds.accept(decision, s) for s in scores])
+            current_cost = (np.sum(accepted & ~correct) * args.error_cost + np.sum(~accepted) * args.clarify_cost) / len(scores)
+            print(f"{decision}: {current} -> {result['threshold']:.4f}, cost {current_cost:.3f} -> {result['expected_cost']:.3f} turns per decision, "
+                  f"accepting {result['accept_rate']:.1%} with {result['error_rate']:.1%} wrong")
+            thresholds.thresholds[decision] = result['threshold']
+            thresholds.fitted[decision] = {**result, 'error_cost': args.error_cost, 'clarify_cost': args.clarify_cost, 'labels': str(args.labels)}
+        if not args.dry_run:
+            print("Saved thresholds version", thresholds.save())
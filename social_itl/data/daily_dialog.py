@@ -1,91 +1,173 @@
-from datasets import load_dataset
+from datasets import Dataset
 from datasets.dataset_dict import DatasetDict
+from datasets.fingerprint import Hasher
+import pyarrow as pa
+import pyarrow.compute as pc
+import json
 import re
 import random
-from typing import Dict, List
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
 from lemminflect import getInflection
+from social_itl.artifacts import store
 from .dataset import get_dataset_path
 
-raw_dataset = load_dataset("daily_dialog")["train"]
-
-def split_dialogs(batch):
-    sentences = [s for sample in batch["dialog"] for s in sample if not re.search(r'[a-z]\.[A-Z]', s)]
-    return {"turns": sentences}
-
-def split_sentences(batch):
-    sentences = [s for sample in batch["turns"] for s in re.split(r'(?<=(?<!\bMr)(?<!\bMs)(?<!\bMrs)(?<![A-HK-Z])[\.\!\?])\s+', sample)]
-    return {"sentence": sentences}
-
-def lowercase(sample):
-    sample["sentence"] = sample["sentence"].lower()
-    return sample
-
-def normalize(sample):
-    s = sample["turns"]
-    s = re.sub(r' +', ' ', s)
-    # s = re.sub(r'\.(?! )', '. ', s)
-    s = s.replace(' ,', ',')
-    s = s.replace(' .', '.')
-    s = s.replace(' ?', '?')
-    s = s.replace(' !', '!')
-    s = s.replace('’', '\'')
-    s = s.replace('‘', '\'')
-    s = s.replace('“', '"')
-    s = s.replace('”', '"')
-    s = s.replace(' \' ', '\'')
-    s = s.replace('p. m.', 'pm')
-    s = s.replace('p.m.', 'pm ')
-    s = s.replace('p. m', 'pm')
-    s = s.replace('a. m.', 'am')
-    s = s.replace('a.m.', 'am ')
-    s = s.replace('a. m', 'am')
-    # s = s.replace('"', '')
-    s = s.strip()
-    sample["turns"] = s
-    return sample
-
-def is_question(sample):
-    first_word = sample["sentence"].split(' ')[0]
-    return first_word in ['who', 'what', 'where', 'when', 'why', 'which', 'how', 'is', 'could', 'may', 'would', 'should', 'can', 'do', 'does', 'did', 'are', 'what\'s', 'will', 'have']
-
-def is_do_question(sample):
-    first_word, second_word = sample["sentence"].split(' ')[:2]
-    return first_word == 'do' and second_word == 'you' and ',' not in sample["sentence"]
-
-def third_person_inflect(sample):
-    genders = ['he', 'she', 'they']
-    gender = random.choice(genders)
-    s: str = sample["sentence"]
-    s = s.replace(" you ", f' {gender} ')
-    if gender == 'they':
-        s = s.replace(" your ", " their ")
-        s = s.replace(" yourself", " themselves")
-        s = s.replace(" yours", " theirs")
-    elif gender == "he":
-        s = s.replace(" your ", " his ")
-        s = s.replace(" yourself", " himself")
-        s = s.replace(" yours", " his")
-    else:
-        s = s.replace(" your ", " her ")
-        s = s.replace(" yourself", " herself")
-        s = s.replace(" yours", " hers")
-    verb = s.split(' ')[2]
-    if gender != 'they':
-        s = s.replace(verb, getInflection(verb, 'VBZ')[0], 1)
-    replacement = random.choice(['if', 'whether'])
-    s = s.replace('do', replacement, 1)[:-1]
-    sample["sentence"] = s
-    return sample
-
-dataset = raw_dataset
-dataset = dataset.map(split_dialogs, batched=True, remove_columns=dataset.column_names)
-dataset = dataset.map(normalize)
-dataset = dataset.map(split_sentences, batched=True, remove_columns=dataset.column_names)
-dataset = dataset.map(lowercase)
-dataset = dataset.filter(lambda x: x["sentence"].count('"') == 0)
-dataset = dataset.filter(lambda x: x["sentence"].count('?') + x["sentence"].count('.') + x["sentence"].count('!') <= 1)
-questions = dataset.filter(lambda x: x["sentence"].endswith("?")).filter(is_question)
-whether_questions = questions.filter(is_do_question).map(third_person_inflect)
-statements = dataset.filter(lambda x: x["sentence"].endswith(".")).filter(lambda x: x["sentence"].count("...") == 0)
-dataset = DatasetDict({"questions": questions, "statements": statements, "whether_questions": whether_questions})
-dataset.save_to_disk(str(get_dataset_path("daily_dialog")))
\ No newline at end of file
+sentence_boundary = re.compile(r'(?<=(?<!\bMr)(?<!\bMs)(?<!\bMrs)(?<![A-HK-Z])[\.\!\?])\s+')
+question_words = ['who', 'what', 'where', 'when', 'why', 'which', 'how', 'is', 'could', 'may', 'would', 'should', 'can', 'do', 'does', 'did', 'are', 'what\'s', 'will', 'have']
+# Applied in order, some replacements depend on earlier ones
+normalize_replacements = [
+    (' ,', ','),
+    (' .', '.'),
+    (' ?', '?'),
+    (' !', '!'),
+    ('’', '\''),
+    ('‘', '\''),
+    ('“', '"'),
+    ('”', '"'),
+    (' \' ', '\''),
+    ('p. m.', 'pm'),
+    ('p.m.', 'pm '),
+    ('p. m', 'pm'),
+    ('a. m.', 'am'),
+    ('a.m.', 'am '),
+    ('a. m', 'am'),
+]
+
+# Stages marked arrow=True receive pyarrow tables and use vectorized pyarrow.compute kernels,
+# the others receive batches of python lists.
+
+def split_dialogs(batch: pa.Table) -> pa.Table:
+    turns = pc.list_flatten(batch['dialog'])
+    turns = turns.filter(pc.invert(pc.match_substring_regex(turns, r'[a-z]\.[A-Z]')))
+    return pa.table({'turns': turns})
+
+def normalize(batch: pa.Table) -> pa.Table:
+    s = batch['turns']
+    s = pc.replace_substring_regex(s, ' +', ' ')
+    for old, new in normalize_replacements:
+        s = pc.replace_substring(s, old, new)
+    s = pc.utf8_trim_whitespace(s)
+    return pa.table({'turns': s})
+
+def split_sentences(batch: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    return {'sentence': [s for turn in batch['turns'] for s in sentence_boundary.split(turn)]}
+
+def lowercase(batch: pa.Table) -> pa.Table:
+    return pa.table({'sentence': pc.utf8_lower(batch['sentence'])})
+
+def is_clean(batch: pa.Table) -> List[bool]:
+    s = batch['sentence']
+    no_quotes = pc.invert(pc.match_substring(s, '"'))
+    punctuation = pc.add(pc.add(pc.count_substring(s, '?'), pc.count_substring(s, '.')), pc.count_substring(s, '!'))
+    return pc.and_(no_quotes, pc.less_equal(punctuation, 1)).to_pylist()
+
+def is_question(batch: pa.Table) -> List[bool]:
+    s = batch['sentence']
+    first_word = pc.list_element(pc.split_pattern(s, ' ', max_splits=1), 0)
+    return pc.and_(pc.ends_with(s, '?'), pc.is_in(first_word, value_set=pa.array(question_words))).to_pylist()
+
+def is_do_question(batch: pa.Table) -> List[bool]:
+    s = batch['sentence']
+    return pc.and_(pc.starts_with(s, 'do you '), pc.invert(pc.match_substring(s, ','))).to_pylist()
+
+def is_statement(batch: pa.Table) -> List[bool]:
+    s = batch['sentence']
+    return pc.and_(pc.ends_with(s, '.'), pc.invert(pc.match_substring(s, '...'))).to_pylist()
+
+def third_person_inflect(batch: Dict[str, List[str]], indices: List[int], seed: int = 0) -> Dict[str, List[str]]:
+    sentences = []
+    for s, idx in zip(batch['sentence'], indices):
+        # Seeded per row so the output does not depend on process count or batch boundaries
+        rng = random.Random(f'{seed}:{idx}')
+        genders = ['he', 'she', 'they']
+        gender = rng.choice(genders)
+        s = s.replace(" you ", f' {gender} ')
+        if gender == 'they':
+            s = s.replace(" your ", " their ")
+            s = s.replace(" yourself", " themselves")
+            s = s.replace(" yours", " theirs")
+        elif gender == "he":
+            s = s.replace(" your ", " his ")
+            s = s.replace(" yourself", " himself")
+            s = s.replace(" yours", " his")
+        else:
+            s = s.replace(" your ", " her ")
+            s = s.replace(" yourself", " herself")
+            s = s.replace(" yours", " hers")
+        verb = s.split(' ')[2]
+        if gender != 'they':
+            s = s.replace(verb, getInflection(verb, 'VBZ')[0], 1)
+        replacement = rng.choice(['if', 'whether'])
+        s = s.replace('do', replacement, 1)[:-1]
+        sentences.append(s)
+    return {'sentence': sentences}
+
+class Stage:
+    def __init__(self, name: str, method: str, function: Callable, arrow: bool = False, **kwargs):
+        self.name = name
+        self.method = method
+        self.function = function
+        self.arrow = arrow
+        self.kwargs = kwargs
+
+    def fingerprint(self, previous: str) -> str:
+        return Hasher.hash([previous, self.name, self.method, self.function, self.arrow, self.kwargs])
+
+    def __call__(self, dataset: Dataset, cache_dir: Path, num_proc: Optional[int] = None) -> Dataset:
+        fingerprint = self.fingerprint(dataset._fingerprint)
+        if self.arrow:
+            dataset = dataset.with_format('arrow')
+        result = getattr(dataset, self.method)(
+            self.function,
+            batched=True,
+            num_proc=num_proc,
+            cache_file_name=str(cache_dir / f'{self.name}-{fingerprint}.arrow'),
+            new_fingerprint=fingerprint,
+            desc=self.name,
+            **self.kwargs,
+        )
+        return result.with_format(None)
+
+def run_stages(dataset: Dataset, stages: List[Stage], cache_dir: Path, num_proc: Optional[int] = None) -> Dataset:
+    for stage in stages:
+        dataset = stage(dataset, cache_dir, num_proc)
+    return dataset
+
+def build_daily_dialog(num_proc: Optional[int] = None, seed: int = 0, cache_dir: Optional[Path] = None) -> DatasetDict:
+    raw_dataset = store.load_dataset("daily_dialog")["train"]
+    if cache_dir is None:
+        cache_dir = get_dataset_path('daily_dialog-cache')
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    sentences = run_stages(raw_dataset, [
+        Stage('split_dialogs', 'map', split_dialogs, arrow=True, remove_columns=raw_dataset.column_names),
+        Stage('normalize', 'map', normalize, arrow=True),
+        Stage('split_sentences', 'map', split_sentences, remove_columns=['turns']),
+        Stage('lowercase', 'map', lowercase, arrow=True),
+        Stage('clean', 'filter', is_clean, arrow=True),
+    ], cache_dir, num_proc)
+    questions = run_stages(sentences, [Stage('questions', 'filter', is_question, arrow=True)], cache_dir, num_proc)
+    whether_questions = run_stages(questions, [
+        Stage('do_questions', 'filter', is_do_question, arrow=True),
+        Stage('third_person_inflect', 'map', third_person_inflect, with_indices=True, fn_kwargs={'seed': seed}),
+    ], cache_dir, num_proc)
+    statements = run_stages(sentences, [Stage('statements', 'filter', is_statement, arrow=True)], cache_dir, num_proc)
+    return DatasetDict({"questions": questions, "statements": statements, "whether_questions": whether_questions})
+
+def save_daily_dialog(dataset: DatasetDict, path: Path):
+    fingerprints = {name: split._fingerprint for name, split in dataset.items()}
+    manifest = path / 'pipeline.json'
+    if manifest.exists() and json.loads(manifest.read_text()) == fingerprints:
+        print("daily_dialog is up to date")
+        return
+    dataset.save_to_disk(str(path))
+    manifest.write_text(json.dumps(fingerprints))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-proc', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    dataset = build_daily_dialog(num_proc=args.num_proc, seed=args.seed)
+    save_daily_dialog(dataset, get_dataset_path("daily_dialog"))
@@ -4,16 +4,18 @@ import yaml
 import datasets
 from datasets import Dataset, concatenate_datasets
 import re
-from itertools import cycle
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import Counter
+from pathlib import Path
+import collections
+import json
+import multiprocessing
 import random
 from lemminflect import getInflection
-from importlib_resources import files, as_file
+from social_itl.artifacts import store
 
 def get_dataset_path(name: str = 'dataset-split'):
-    dataset_path = files('multimodal') / 'data' / name
-    with as_file(dataset_path) as p:
-        return p
+    return store.data_path(name)
 
 def get_dataset(name: str = 'dataset-split'):
     dataset = datasets.load_from_disk(str(get_dataset_path(name)))
@@ -58,11 +60,14 @@ def load_actions():
 
 """
 Algorithm:
-Generate a tree of of components, excluding phrases
-Lazy iterate through the tree, generating text where needed
+Compile every grammar component once into templates of literal text and wildcard slots
+Expand a root component by recursively filling slots and joining the pieces into a sentence and its parse
+Generation is split into shards, each with its own seeded RNG, so shards can be built in parallel processes
 """
 
 dynamic_wildcards = set(['phrase', 'question', 'imp', 'verb', 'gerund', 'pronoun-subj-s', 'pronoun-subj-pl', 'pronoun-obj'])
+quoted_wildcards = {'imp': 'imperatives', 'question': 'questions', 'phrase': 'statements'}
+spaced_wildcards = {'verb': 'actions', 'gerund': 'gerunds'}
 
 class Wildcard:
     def __init__(self, tag: str):
@@ -75,159 +80,234 @@ class Wildcard:
     def __str__(self):
         return f'{{{self.index}:{self.name}}}' if self.index else f'{{{self.name}}}'
 
-class Phrase:
-    def __init__(self, template: str, parse: str, grammar: Dict, vocab: Dict):
+class Template:
+    def __init__(self, template: str):
+        pieces = re.split(r'\{(.*?)\}', template)
         self.template = template
-        self.parse = parse
-        self.wildcards = [Wildcard(x) for x in re.findall('\{(.*?)\}', template)]
-        self.grammar = grammar
-        self.vocab = vocab
+        # literals always has one more entry than slots: literal, slot, literal, ..., literal
+        self.literals = pieces[0::2]
+        self.slots = [Wildcard(x) for x in pieces[1::2]]
 
     def __str__(self):
         return f'Template({self.template})'
-        
-    def replace(self, wildcard: Wildcard, replacement: Phrase | str) -> str:
-        if isinstance(replacement, Phrase):
-            sub_template = replacement.template
-            sub_parse = replacement.parse
-        else:
-            sub_template = replacement
-            sub_parse = replacement
-        new_template = self.template.replace(f'{str(wildcard)}', sub_template, 1)
-        if wildcard.index is None:
-            new_parse = self.parse
-        else:
-            new_parse = self.parse.replace(wildcard.index, sub_parse, 1)
-
-        return Phrase(new_template, new_parse, self.grammar, self.vocab)
-
-    def expand(self, recursion_depth=0) -> Iterable[Phrase]:
-        # print(f'Expanding {self.template}, recursion depth {recursion_depth}')
-        def get_replacements(wildcard: Wildcard) -> Iterable[Phrase]:
-            if wildcard.dynamic:
-                if wildcard.name == 'imp':
-                    yield from (f'"{s}"' for s in self.vocab["imperatives"])
-                elif wildcard.name == 'question':
-                    yield from (f'"{s}"' for s in self.vocab["questions"])
-                elif wildcard.name == 'phrase':
-                    yield from (f'"{s}"' for s in self.vocab["statements"])
-                elif wildcard.name == 'verb':
-                    yield from (f' {s}' for s in self.vocab["actions"])
-                elif wildcard.name == 'gerund':
-                    yield from (f' {s}' for s in self.vocab["gerunds"])
-                else:
-                    yield from cycle([self])
-            else:
-                component = self.grammar[wildcard.name]
-                yield from component.enumerate(recursion_depth=recursion_depth)
-        
-        replacements = [get_replacements(wildcard) for wildcard in self.wildcards]
-        while True:
-            phrase = self
-            # print("Subbing:")
-            # print(phrase)
-            for i, wildcard in enumerate(self.wildcards):
-                replacement = next(replacements[i])
-                # print(f'Phrase: {phrase} wildcard: {wildcard.name} replacement: {replacement}')
-                phrase = phrase.replace(wildcard, replacement)
-                # print(f'Index {i}: {phrase}')
-            yield phrase
 
 class Component:
-    registry = {}
-    def __init__(self, name: str, parse: str, sentences: List[str], vocab: Dict):
+    def __init__(self, name: str, parse: str, sentences: List[str]):
         self.name = name
         self.parse = parse
         self.sentences = sentences
-        self.vocab = vocab
-        Component.registry[name] = self
+        self.templates = [Template(s) for s in sentences]
+        self.parse_pieces = re.split(r'(\$\d+)', parse)
 
     def __str__(self):
         return f'{self.name} ({self.parse}): {self.sentences}'
 
-    def enumerate(self, num_examples: int = 1, recursion_depth=0) -> Iterable[str]:
-        templates = [Phrase(s, self.parse, Component.registry, self.vocab) for s in self.sentences]
-        template_expansions = [(t.expand(recursion_depth=recursion_depth+1)) for t in templates]
-        # print(len(template_expansions))
-        while True:
-            for i, t in enumerate(template_expansions):
-                n = next(t)
-                # if recursion_depth == 1:
-                # print(f'depth = {recursion_depth}, n = {n}')
-                yield n
-            # print('done')
-
-def strip(phrase: Phrase) -> Phrase:
-    return Phrase(phrase.template.replace('  ', ' ').strip(), phrase.parse.replace('  ', ' '), phrase.grammar, phrase.vocab)
-
-def fill_pronouns(phrase: Phrase) -> Phrase:
-    template = phrase.template
-    if 'pronoun' not in template:
-        return phrase
-
-    singular = False
-    plural = False
-    if 'pronoun-subj-s' in template:
-        singular = True
-    elif 'pronoun-subj-pl' in template:
-        plural = True
-
-    t = template
-
-    if singular:
-        gender = random.choice(['m', 'f'])
-        if gender == 'm':
-            t = t.replace('{pronoun-subj-s}', 'he')
-            t = t.replace('{pronoun-obj}', 'him')
-        else:
-            t = t.replace('{pronoun-subj-s}', 'she')
-            t = t.replace('{pronoun-obj}', 'her')
-            
-    elif plural:
-        t = t.replace('{pronoun-subj-pl}', 'they')
-        t = t.replace('{pronoun-obj}', 'them')
-
-    else:
-        gender = random.choice(['m', 'f', 'n'])
-        if gender == 'm':
-            t = t.replace('{pronoun-obj}', 'him')
-        elif gender == 'f':
-            t = t.replace('{pronoun-obj}', 'her')
-        else:
-            t = t.replace('{pronoun-obj}', 'them')
+class Grammar:
+    def __init__(self, grammar_file: str):
+        with open(grammar_file) as f:
+            grammar = yaml.safe_load(f)
+        self.roots = [Component(**obj) for obj in grammar['root']]
+        self.components = {c.name: c for c in self.roots}
+        self.components.update({obj['name']: Component(**obj) for obj in grammar['components']})
 
-    return Phrase(t, phrase.parse, phrase.grammar, phrase.vocab)
-
-def gen_phrases(grammar_file: str, num_examples: int, vocab: Dict) -> List[str]:
-    grammar = yaml.safe_load(open(grammar_file))
-    root_components = [Component(**obj, vocab=vocab) for obj in grammar['root']]
-    all_components = root_components + [Component(**obj, vocab=vocab) for obj in grammar['components']]
-    phrases = []
-    for c in root_components:
-        # print(c.name)
-        series = (fill_pronouns(p) for p in c.enumerate())
-        series = (strip(p) for p in series)
-        for i in range(num_examples // len(root_components)):
-            phrases.append(next(series))
-            # print(phrases[-1])
-
-    dataset = [{'sentence': p.template, 'parse': p.parse} for p in phrases]
-    dataset = Dataset.from_list(dataset)
-    def anonymize(x):
-        sentence = x['sentence']
-        parse = x['parse']
-        for i, pattern in enumerate(re.findall(r'"(.*?)"', sentence)):
-            sentence = sentence.replace(f'"{pattern}"', f'[phrase_{i}]')
-            parse = parse.replace(f'"{pattern}"', f'[phrase_{i}]')
-        x['sentence_anon'] = sentence
-        x['parse_anon'] = parse
-        return x
+def parse_structure(parse: str) -> str:
+    # Drop the argument text so parses only differ by their function nesting
+    return re.sub(r'\([^()]*\)', '()', parse)
 
-    dataset = dataset.map(anonymize).shuffle()
-    return dataset
-    
+class ExpansionContext:
+    def __init__(self, grammar: Grammar, vocab: Dict[str, List[str]], seed: int | str = 0, template_weights: Optional[Dict[str, List[float]]] = None):
+        self.grammar = grammar
+        self.vocab = vocab
+        self.rng = random.Random(seed)
+        self.template_weights = template_weights or {}
+        self.templates = Counter()
+        self.components = Counter()
+        self.wildcards = Counter()
+        self.structures = Counter()
+
+    def coverage(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'templates': dict(self.templates),
+            'components': dict(self.components),
+            'wildcards': dict(self.wildcards),
+            'structures': dict(self.structures),
+        }
+
+    def choose_template(self, component: Component) -> int:
+        weights = self.template_weights.get(component.name)
+        if weights is None:
+            return self.rng.randrange(len(component.templates))
+        return self.rng.choices(range(len(component.templates)), weights=weights)[0]
+
+    def draw(self, wildcard: Wildcard) -> str:
+        self.wildcards[wildcard.name] += 1
+        if wildcard.name in quoted_wildcards:
+            return f'"{self.rng.choice(self.vocab[quoted_wildcards[wildcard.name]])}"'
+        elif wildcard.name in spaced_wildcards:
+            return f' {self.rng.choice(self.vocab[spaced_wildcards[wildcard.name]])}'
+        # Pronouns are filled in after expansion so they agree with each other
+        return str(wildcard)
+
+    def expand(self, component: Component) -> Tuple[str, str]:
+        index = self.choose_template(component)
+        template = component.templates[index]
+        self.components[component.name] += 1
+        self.templates[f'{component.name}:{index}'] += 1
+        text = [template.literals[0]]
+        args = {}
+        for wildcard, literal in zip(template.slots, template.literals[1:]):
+            if wildcard.dynamic:
+                value = sub_parse = self.draw(wildcard)
+            else:
+                value, sub_parse = self.expand(self.grammar.components[wildcard.name])
+            text.append(value)
+            text.append(literal)
+            if wildcard.index is not None:
+                args[wildcard.index] = sub_parse
+        parse = ''.join(args.get(p, p) for p in component.parse_pieces)
+        return ''.join(text), parse
+
+    def generate(self, root: Component) -> Tuple[str, str]:
+        sentence, parse = self.expand(root)
+        sentence = self.fill_pronouns(sentence).replace('  ', ' ').strip()
+        parse = parse.replace('  ', ' ')
+        self.structures[parse_structure(parse)] += 1
+        return sentence, parse
+
+    def fill_pronouns(self, template: str) -> str:
+        if 'pronoun' not in template:
+            return template
+
+        singular = False
+        plural = False
+        if 'pronoun-subj-s' in template:
+            singular = True
+        elif 'pronoun-subj-pl' in template:
+            plural = True
+
+        t = template
+
+        if singular:
+            gender = self.rng.choice(['m', 'f'])
+            if gender == 'm':
+                t = t.replace('{pronoun-subj-s}', 'he')
+                t = t.replace('{pronoun-obj}', 'him')
+            else:
+                t = t.replace('{pronoun-subj-s}', 'she')
+                t = t.replace('{pronoun-obj}', 'her')
+                
+        elif plural:
+            t = t.replace('{pronoun-subj-pl}', 'they')
+            t = t.replace('{pronoun-obj}', 'them')
+
+        else:
+            gender = self.rng.choice(['m', 'f', 'n'])
+            if gender == 'm':
+                t = t.replace('{pronoun-obj}', 'him')
+            elif gender == 'f':
+                t = t.replace('{pronoun-obj}', 'her')
+            else:
+                t = t.replace('{pronoun-obj}', 'them')
+
+        return t
+
+def merge_coverage(reports: Iterable[Dict[str, Dict[str, int]]]) -> Dict[str, Dict[str, int]]:
+    merged = collections.defaultdict(Counter)
+    for report in reports:
+        for kind, counts in report.items():
+            merged[kind].update(counts)
+    return {kind: dict(counts) for kind, counts in merged.items()}
+
+def rebalance_weights(grammar: Grammar, coverage: Dict[str, Dict[str, int]]) -> Dict[str, List[float]]:
+    """Inverse frequency template weights, so under-represented templates are drawn more often next time"""
+    weights = {}
+    for name, component in grammar.components.items():
+        counts = [coverage['templates'].get(f'{name}:{i}', 0) for i in range(len(component.templates))]
+        if sum(counts) == 0:
+            continue
+        mean = sum(counts) / len(counts)
+        weights[name] = [mean / max(count, 1) for count in counts]
+    return weights
+
+def anonymize(sentence: str, parse: str) -> Dict[str, str]:
+    sentence_anon = sentence
+    parse_anon = parse
+    for i, pattern in enumerate(re.findall(r'"(.*?)"', sentence)):
+        sentence_anon = sentence_anon.replace(f'"{pattern}"', f'[phrase_{i}]')
+        parse_anon = parse_anon.replace(f'"{pattern}"', f'[phrase_{i}]')
+    return {'sentence': sentence, 'parse': parse, 'sentence_anon': sentence_anon, 'parse_anon': parse_anon}
+
+def shard_examples(grammar: Grammar, context: ExpansionContext, shard: int, num_examples: int, num_shards: int) -> Iterator[Tuple[str, str]]:
+    # Strided indices keep the root components balanced across shards
+    for i in range(shard, num_examples, num_shards):
+        yield context.generate(grammar.roots[i % len(grammar.roots)])
+
+def generate_examples(shards: List[int], grammar_file: str, num_examples: int, num_shards: int, vocab: Dict[str, List[str]], seed: int,
+                      template_weights: Optional[Dict[str, List[float]]] = None) -> Iterator[Dict[str, str]]:
+    grammar = Grammar(grammar_file)
+    for shard in shards:
+        context = ExpansionContext(grammar, vocab, seed=f'{seed}:{shard}', template_weights=template_weights)
+        for sentence, parse in shard_examples(grammar, context, shard, num_examples, num_shards):
+            yield anonymize(sentence, parse)
+
+def shards_coverage(shards: List[int], grammar_file: str, num_examples: int, num_shards: int, vocab: Dict[str, List[str]], seed: int,
+                    template_weights: Optional[Dict[str, List[float]]] = None) -> Dict[str, Dict[str, int]]:
+    """Coverage of these shards of generate_examples, expanding the same examples again with the same seeds"""
+    grammar = Grammar(grammar_file)
+    reports = []
+    for shard in shards:
+        context = ExpansionContext(grammar, vocab, seed=f'{seed}:{shard}', template_weights=template_weights)
+        for _ in shard_examples(grammar, context, shard, num_examples, num_shards):
+            pass
+        reports.append(context.coverage())
+    return merge_coverage(reports)
+
+def gen_phrases(grammar_file: str, num_examples: int, vocab: Dict[str, List[str]], seed: int = 0, num_shards: int = 64, num_proc: Optional[int] = None,
+                template_weights: Optional[Dict[str, List[float]]] = None) -> Dataset:
+    dataset = Dataset.from_generator(
+        generate_examples,
+        gen_kwargs={
+            'shards': list(range(num_shards)),
+            'grammar_file': str(grammar_file),
+            'num_examples': num_examples,
+            'num_shards': num_shards,
+            'vocab': vocab,
+            'seed': seed,
+            'template_weights': template_weights,
+        },
+        num_proc=num_proc,
+    )
+    return dataset.shuffle(seed=seed)
+
+def gen_coverage(grammar_file: str, num_examples: int, vocab: Dict[str, List[str]], seed: int = 0, num_shards: int = 64, num_proc: Optional[int] = None,
+                 template_weights: Optional[Dict[str, List[float]]] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Coverage of the dataset gen_phrases returns for the same arguments. It is computed apart from the generator
+    because from_generator skips the generator entirely when the dataset is already in its cache.
+    """
+    args = (str(grammar_file), num_examples, num_shards, vocab, seed, template_weights)
+    if not num_proc or num_proc == 1:
+        return shards_coverage(list(range(num_shards)), *args)
+    chunks = [list(range(num_shards))[i::num_proc] for i in range(num_proc)]
+    with multiprocessing.Pool(num_proc) as pool:
+        return merge_coverage(pool.starmap(shards_coverage, [(chunk, *args) for chunk in chunks if chunk]))
+
+def interleave(*sources: List[str]) -> List[str]:
+    """Alternate between the sources, repeating the shorter ones, so each is drawn from equally often whatever its size"""
+    longest = max(len(source) for source in sources)
+    return [source[i % len(source)] for i in range(longest) for source in sources]
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train-size', type=int, default=10000)
+    parser.add_argument('--test-size', type=int, default=1000)
+    parser.add_argument('--num-shards', type=int, default=64)
+    parser.add_argument('--num-proc', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rebalance', action='store_true', help='Weight templates by the inverse of the coverage from the previous run')
+    args = parser.parse_args()
+
     questions, statements, whether_questions = load_daily_dialog()
     questions = questions.shuffle(seed=1).train_test_split(test_size=0.2)
     statements = statements.shuffle(seed=1).train_test_split(test_size=0.2)
@@ -240,34 +320,43 @@ if __name__ == '__main__':
         x['sentence'] = x['sentence'].replace(first_word, gerund, 1)
         return x
 
-    def combine_iters(x, y):
-        while True:
-            yield next(x)
-            yield next(y)
-
     gerunds = actions.map(inflect)    
 
     train_vocab  = {
-        'questions': combine_iters(cycle(questions['train']['sentence']), cycle(whether_questions['train']['sentence'])),
-        'statements': cycle(statements['train']['sentence']),
-        'imperatives': cycle(imperatives['train']['sentence']),
-        'actions': cycle(actions['train']['sentence']),
-        'gerunds': cycle(gerunds['train']['sentence']),
+        'questions': interleave(questions['train']['sentence'], whether_questions['train']['sentence']),
+        'statements': statements['train']['sentence'],
+        'imperatives': imperatives['train']['sentence'],
+        'actions': actions['train']['sentence'],
+        'gerunds': gerunds['train']['sentence'],
     }
 
     test_vocab  = {
-        'questions': cycle(questions['test']['sentence']),
-        'statements': cycle(statements['test']['sentence']),
-        'imperatives': cycle(imperatives['test']['sentence']),
-        'actions': cycle(actions['test']['sentence']),
-        'gerunds': cycle(gerunds['test']['sentence']),
+        'questions': questions['test']['sentence'],
+        'statements': statements['test']['sentence'],
+        'imperatives': imperatives['test']['sentence'],
+        'actions': actions['test']['sentence'],
+        'gerunds': gerunds['test']['sentence'],
     }
 
-    train_ds = gen_phrases(get_dataset_path('grammar.yaml'), 10000, train_vocab)
-    for sample in list(train_ds)[:100]:
+    grammar_file = get_dataset_path('grammar.yaml')
+    coverage_dir = get_dataset_path('dataset-split-coverage')
+    template_weights = None
+    if args.rebalance:
+        with open(coverage_dir / 'train.json') as f:
+            template_weights = rebalance_weights(Grammar(grammar_file), json.load(f))
+    train_ds = gen_phrases(grammar_file, args.train_size, train_vocab, seed=args.seed, num_shards=args.num_shards, num_proc=args.num_proc,
+                           template_weights=template_weights)
+    for sample in train_ds.select(range(min(100, len(train_ds)))):
         print(sample["sentence"])
         print(sample["parse"])
-    test_ds = gen_phrases(get_dataset_path('grammar.yaml'), 1000, test_vocab)
+    test_ds = gen_phrases(grammar_file, args.test_size, test_vocab, seed=args.seed + 1, num_shards=args.num_shards, num_proc=args.num_proc)
+    coverage = gen_coverage(grammar_file, args.train_size, train_vocab, seed=args.seed, num_shards=args.num_shards, num_proc=args.num_proc,
+                            template_weights=template_weights)
+    coverage_dir.mkdir(parents=True, exist_ok=True)
+    with open(coverage_dir / 'train.json', 'w') as f:
+        json.dump(coverage, f, indent=2)
+    for structure, count in sorted(coverage['structures'].items(), key=lambda x: x[1]):
+        print(f'{count:8d} {structure}')
 
     dataset = datasets.DatasetDict({'train': train_ds, 'test': test_ds})
-    dataset.save_to_disk(get_dataset_path('dataset-split'))
\ No newline at end of file
+    dataset.save_to_disk(get_dataset_path('dataset-split'), num_proc=args.num_proc)
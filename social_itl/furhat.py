@@ -1,11 +1,15 @@
 import asyncio
+import time
 import websockets.client as client
 import websockets
 import json
 from enum import Enum
 from contextlib import asynccontextmanager, contextmanager
-from typing import Dict, List, AsyncIterator, AsyncGenerator
+from pathlib import Path
+from typing import Dict, List, AsyncIterator, AsyncGenerator, Optional, Union
 from .utils import get_logger
+from .recorder import EventRecorder, INBOUND, OUTBOUND
+from .session_store import get_session_store
 
 class SpeechType(Enum):
     FINAL = 0
@@ -39,56 +43,169 @@ class DisconnectError(Exception):
     pass
 
 class Furhat():
-    def __init__(self, host, port=80):
+    def __init__(self, host, port=80, record: Union[bool, str, Path, None] = None, reconnect_timeout: float = 120, max_backoff: float = 16):
         self.host = host
         self.port = port
         self.websocket = None
         self.disconnect_event = asyncio.Event()
+        self.connected = asyncio.Event()
+        # Replaced on every reconnect, actions waiting for a reply resend themselves when the old one is set
+        self.reconnected = asyncio.Event()
+        self.reconnect_timeout = reconnect_timeout
+        self.max_backoff = max_backoff
+        # Actions that stay in effect on the robot, such as infinite listening, and are sent again after a reconnect
+        self.persistent_actions: Dict[str, Dict] = {}
         self.subscriptions: Dict[str, List[asyncio.Queue]] = {}
         self.user_locations = {}
         self.logger = get_logger("Furhat", "furhat", True)
         self.custom_loggers = []
+        # record=True writes traces to the default log folder, a path writes them there
+        self.recorder: Optional[EventRecorder] = None
+        if record:
+            self.recorder = EventRecorder(None if record is True else Path(record))
+
+    @property
+    def url(self) -> str:
+        return "ws://{}:{}/api".format(self.host, self.port)
 
     @asynccontextmanager
     async def connect(self):
         self.disconnect_event.clear()
-        self.websocket = await client.connect("ws://{}:{}/api".format(self.host, self.port))
+        self.websocket = await client.connect(self.url)
+        self.connected.set()
         recv_task = asyncio.create_task(self.recv())
         async def heartbeat():
-            while True:
-                await asyncio.sleep(1)
-                await self.send({ "event_name": "ServerEvent", "type": "Heartbeat" })
+            try:
+                while True:
+                    await asyncio.sleep(1)
+                    await self.send({ "event_name": "ServerEvent", "type": "Heartbeat" })
+            except DisconnectError:
+                # recv gave up reconnecting, the caller sees it through its own requests
+                return
         heartbeat_task = asyncio.create_task(heartbeat())
         try:
             yield self
         finally:
             recv_task.cancel()
             heartbeat_task.cancel()
+            self.connected.clear()
             await self.websocket.close()
             self.subscriptions = {}
+            self.persistent_actions = {}
+
+    async def reconnect(self) -> bool:
+        """Reconnect with exponential backoff, restoring subscriptions and persistent actions. False once reconnect_timeout has passed"""
+        self.connected.clear()
+        deadline = time.monotonic() + self.reconnect_timeout
+        delay = 0.5
+        while time.monotonic() < deadline:
+            try:
+                self.websocket = await client.connect(self.url)
+            except (OSError, websockets.WebSocketException) as e:
+                print(f"Reconnect failed ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            for name in self.subscriptions:
+                await self.send_now({ "event_name": 'furhatos.event.actions.ActionRealTimeAPISubscribe', "name": name })
+            for event in self.persistent_actions.values():
+                await self.send_now(event)
+            print("Reconnected")
+            self.connected.set()
+            reconnected, self.reconnected = self.reconnected, asyncio.Event()
+            reconnected.set()
+            return True
+        return False
+
+    async def wait_connected(self):
+        if self.connected.is_set():
+            return
+        connected = asyncio.ensure_future(self.connected.wait())
+        closed = asyncio.ensure_future(self.disconnect_event.wait())
+        await asyncio.wait([connected, closed], return_when=asyncio.FIRST_COMPLETED)
+        connected.cancel()
+        closed.cancel()
+        if not self.connected.is_set():
+            raise DisconnectError
 
     @contextmanager
-    def log(self, name, folder="furhat"):
-        logger = get_logger(name, folder, True)
+    def log(self, name, folder="furhat", participant_id=None):
+        session_id = None
+        if participant_id is not None:
+            session_id = get_session_store().start_session(participant_id, folder)
+        logger = get_logger(name, folder, True, session_id)
         self.custom_loggers.append(logger)
         yield logger
         self.custom_loggers.remove(logger)
 
+    async def send_now(self, event):
+        message = json.dumps(event)
+        if self.recorder is not None:
+            self.recorder.record(OUTBOUND, message)
+        await self.websocket.send(message)
+
     async def send(self, event):
-        result = await self.websocket.send(json.dumps(event))
+        # Messages sent while the connection is down wait for the reconnect
+        while True:
+            await self.wait_connected()
+            try:
+                return await self.send_now(event)
+            except websockets.ConnectionClosed:
+                self.connected.clear()
 
-    async def recv(self):
+    async def request(self, name: str, action: Optional[Dict], accept=None) -> Dict:
+        """
+        Send an action and wait for the first name event that passes accept. The robot forgets
+        pending actions when the connection drops, so the action is sent again after a reconnect.
+        """
+        if name not in self.subscriptions:
+            await self.send({ "event_name": 'furhatos.event.actions.ActionRealTimeAPISubscribe', "name": name })
+            self.subscriptions[name] = []
+        queue = asyncio.Queue()
+        self.subscriptions[name].append(queue)
         try:
+            resend = True
             while True:
-                response = await self.websocket.recv()
-                event = json.loads(response)
-                name = event.get("event_name")
-                if name in self.subscriptions:
-                    for queue in self.subscriptions[name]:
-                        await queue.put(event)
-        except websockets.ConnectionClosed:
-            print("Connection closed")
-            self.disconnect_event.set()
+                reconnected = self.reconnected
+                if resend and action is not None:
+                    await self.send(action)
+                resend = False
+                get = asyncio.ensure_future(queue.get())
+                lost = asyncio.ensure_future(reconnected.wait())
+                closed = asyncio.ensure_future(self.disconnect_event.wait())
+                done, pending = await asyncio.wait([get, lost, closed], return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                if get in done:
+                    event = get.result()
+                    if accept is None or accept(event):
+                        return event
+                elif closed in done:
+                    raise DisconnectError
+                else:
+                    resend = True
+        finally:
+            if queue in self.subscriptions.get(name, []):
+                self.subscriptions[name].remove(queue)
+
+    async def recv(self):
+        while True:
+            try:
+                while True:
+                    response = await self.websocket.recv()
+                    if self.recorder is not None:
+                        self.recorder.record(INBOUND, response)
+                    event = json.loads(response)
+                    name = event.get("event_name")
+                    if name in self.subscriptions:
+                        for queue in self.subscriptions[name]:
+                            await queue.put(event)
+            except websockets.ConnectionClosed:
+                print("Connection closed")
+            if not await self.reconnect():
+                print("Giving up on reconnecting")
+                self.disconnect_event.set()
+                return
 
     async def subscribe(self, name) -> AsyncIterator[Dict]:
         if name not in self.subscriptions:
@@ -100,7 +217,8 @@ class Furhat():
         exit_event = asyncio.Event()
         try:
             while True:
-                done, pending = await asyncio.wait([queue.get(), self.disconnect_event.wait(), exit_event.wait()], return_when=asyncio.FIRST_COMPLETED)
+                pending = [asyncio.ensure_future(f) for f in (queue.get(), self.disconnect_event.wait(), exit_event.wait())]
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
                 if self.disconnect_event.is_set():
                     raise DisconnectError
                 yield done.pop().result()
@@ -118,7 +236,8 @@ class Furhat():
             except UnboundLocalError:
                 pass
             print("Subscription closed")
-            self.subscriptions[name].remove(queue)
+            if queue in self.subscriptions.get(name, []):
+                self.subscriptions[name].remove(queue)
 
 
     async def speech(self, return_silence=False) -> AsyncIterator[UserSpeech]:
@@ -141,7 +260,9 @@ class Furhat():
             finally:
                 gen.aclose()
         task = asyncio.create_task(recv_users())
-        await self.send({ "event_name": "furhatos.app.furhatdriver.CustomListen", "endSilTimeout": 500, "infinite": True })
+        listen = { "event_name": "furhatos.app.furhatdriver.CustomListen", "endSilTimeout": 500, "infinite": True }
+        self.persistent_actions['listen'] = listen
+        await self.send(listen)
         gen = self.subscribe("furhatos.event.senses.SenseSpeech")
         try:
             prev = None
@@ -166,6 +287,7 @@ class Furhat():
         except GeneratorExit:
             pass
         finally:
+            self.persistent_actions.pop('listen', None)
             await self.send({ "event_name": "furhatos.app.furhatdriver.StopListen" })
             gen.aclose()
             task.cancel()
@@ -176,24 +298,21 @@ class Furhat():
 
     async def say(self, text: str, asynchronous: bool = False, ifSilent: bool = False, abort: bool = False, interruptable: bool = False):
         text = text.replace('&', 'and')
-        subscription = self.subscribe("furhatos.event.monitors.MonitorSpeechEnd")
         event = { "event_name": 'furhatos.event.actions.ActionSpeech', "text": text, "asynchronous": asynchronous, "ifSilent": ifSilent, "abort": abort, "yielding": interruptable }
         self.logger.info(str(event))
         for logger in self.custom_loggers:
             logger.info(f"Robot: {text}")
-        await self.send(event)
-        async for event in subscription:
-            break
-        subscription.aclose()
+        await self.request("furhatos.event.monitors.MonitorSpeechEnd", event)
 
     async def listen(self, endSilTimeout: int = 3000, noSpeechTimeout: int = 10000) -> str:
         event = { "event_name": 'furhatos.app.furhatdriver.CustomListen', "endSilTimeout": endSilTimeout, "noSpeechTimeout": noSpeechTimeout}
-        await self.send(event)
-        async for event in self.speech(return_silence=True):
-            self.logger.info(str(event))
-            for logger in self.custom_loggers:
-                logger.info(f"User: {event.text}")
-            return event.text
+        def is_result(e):
+            return SpeechType(e.get("type")) in (SpeechType.FINAL, SpeechType.MAXSPEECH, SpeechType.SILENCE)
+        event = UserSpeech(await self.request("furhatos.event.senses.SenseSpeech", event, is_result))
+        self.logger.info(str(event))
+        for logger in self.custom_loggers:
+            logger.info(f"User: {event.text}")
+        return event.text
 
 if __name__ == "__main__":
     async def main():
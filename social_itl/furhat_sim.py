@@ -0,0 +1,239 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+import websockets
+from .furhat import SpeechType
+from .recorder import INBOUND, read_traces
+
+# Events the robot sends on its own, everything else is produced by the simulator in response to actions
+trace_events = ('furhatos.event.senses.SenseSpeech', 'furhatos.event.senses.SenseUsers', 'furhatos.app.furhatdriver.GUIEvent')
+# The Background state of the skill relays these under the skill's namespace
+relayed_events = {'GUIEvent': 'furhatos.app.furhatdriver.GUIEvent', 'ServerEvent': 'furhatos.app.furhatdriver.ServerEvent'}
+
+class TraceItem:
+    def __init__(self, time: float, event: Dict):
+        self.time = time
+        self.event = event
+
+    @property
+    def is_speech(self) -> bool:
+        return self.event.get('event_name') == 'furhatos.event.senses.SenseSpeech'
+
+def load_trace(path: Path) -> List[TraceItem]:
+    """
+    Robot events from a recording made with EventRecorder (a .trace file or a directory of them),
+    or from a JSONL trace with one {"time": seconds, "event": {...}} object per line
+    """
+    items = []
+    if path.is_dir() or path.suffix == '.trace':
+        start = None
+        for record in read_traces(path):
+            if start is None:
+                start = record.time
+            if record.direction == INBOUND:
+                event = record.event
+                if event.get('event_name') in trace_events:
+                    items.append(TraceItem(record.time - start, event))
+        return items
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record['event'].get('event_name') in trace_events:
+                    items.append(TraceItem(record['time'], record['event']))
+    return items
+
+def script_trace(lines: List[str]) -> List[TraceItem]:
+    """Trace that answers each listen with the next line of a script"""
+    return [TraceItem(0.0, speech_event(line)) for line in lines]
+
+def speech_event(text: str, type: SpeechType = SpeechType.FINAL, user_id: str = 'user-0') -> Dict:
+    return {
+        'event_name': 'furhatos.event.senses.SenseSpeech',
+        'text': text,
+        'conf': 1.0 if text else 0.0,
+        'type': type.value,
+        'length': len(text.split()),
+        'time': int(time.time() * 1000),
+        'userId': user_id,
+        'audiolength': 0,
+    }
+
+class FurhatSimulator:
+    """
+    Stand-in for the FurhatDriver skill behind the Realtime API. User speech and GUI events come from a
+    trace; speech is only delivered while listening, and every other trace event waits until the speech
+    recorded before it has been delivered. With speed=None the trace runs as fast as the client allows,
+    otherwise its timestamps are kept, scaled by speed. The configured ASR delay and fixed TTS duration
+    are applied in both modes.
+    """
+    def __init__(self, trace: List[TraceItem], speed: Optional[float] = 1.0, asr_delay: float = 0.5,
+                 words_per_second: float = 2.5, tts_duration: Optional[float] = None, timeout_scale: float = 1.0):
+        self.trace = trace
+        self.speed = speed
+        self.asr_delay = asr_delay
+        self.words_per_second = words_per_second
+        self.tts_duration = tts_duration
+        self.timeout_scale = timeout_scale
+        self.clients: Dict[object, Set[str]] = {}
+        self.listening = asyncio.Event()
+        self.infinite = False
+        self.listen_id = 0
+        self.speech_lock = asyncio.Lock()
+        self.speech_tasks: Set[asyncio.Task] = set()
+        self.speaking = False
+        self.started = asyncio.Event()
+        self.start_time = None
+        self.finished = asyncio.Event()
+
+    def delay(self, seconds: float) -> float:
+        return 0.0 if self.speed is None else seconds / self.speed
+
+    async def broadcast(self, event: Dict):
+        message = json.dumps(event)
+        name = event.get('event_name')
+        for websocket, subscriptions in list(self.clients.items()):
+            if name in subscriptions:
+                try:
+                    await websocket.send(message)
+                except websockets.ConnectionClosed:
+                    pass
+
+    def speech_duration(self, text: str) -> float:
+        if self.tts_duration is not None:
+            return self.tts_duration
+        return self.delay(len(text.split()) / self.words_per_second)
+
+    async def speak(self, event: Dict):
+        text = event.get('text', '')
+        async with self.speech_lock:
+            self.speaking = True
+            try:
+                await self.broadcast({'event_name': 'furhatos.event.monitors.MonitorSpeechStart', 'text': text})
+                await asyncio.sleep(self.speech_duration(text))
+                await self.broadcast({'event_name': 'furhatos.event.monitors.MonitorSpeechEnd', 'text': text})
+            except asyncio.CancelledError:
+                await self.broadcast({'event_name': 'furhatos.event.monitors.MonitorSpeechEnd', 'text': text, 'aborted': True})
+                raise
+            finally:
+                self.speaking = False
+
+    async def abort_speech(self) -> bool:
+        """Stop the current speech and drop the queued speech, returns whether anything was being said"""
+        was_speaking = self.speaking
+        tasks = [task for task in self.speech_tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return was_speaking
+
+    async def listen(self, event: Dict):
+        self.listen_id += 1
+        listen_id = self.listen_id
+        self.infinite = event.get('infinite', False)
+        self.listening.set()
+        if self.infinite:
+            return
+        await asyncio.sleep(event.get('noSpeechTimeout', 10000) / 1000 * self.timeout_scale)
+        if self.listening.is_set() and self.listen_id == listen_id:
+            self.listening.clear()
+            await self.broadcast(speech_event('', SpeechType.SILENCE))
+
+    def stop_listening(self):
+        self.listen_id += 1
+        self.infinite = False
+        self.listening.clear()
+
+    async def pump(self):
+        await self.started.wait()
+        for item in self.trace:
+            if self.speed is not None:
+                await asyncio.sleep(max(0.0, self.start_time + item.time / self.speed - time.monotonic()))
+            if item.is_speech:
+                await self.listening.wait()
+                await asyncio.sleep(self.asr_delay)
+                if not self.infinite:
+                    self.stop_listening()
+                await self.broadcast(item.event)
+            else:
+                await self.broadcast(item.event)
+        print("Trace finished")
+        self.finished.set()
+
+    async def handle(self, event: Dict, websocket):
+        name = event.get('event_name')
+        if name == 'furhatos.event.actions.ActionRealTimeAPISubscribe':
+            self.clients[websocket].add(event['name'])
+        elif name == 'furhatos.app.furhatdriver.CustomListen':
+            asyncio.create_task(self.listen(event))
+        elif name == 'furhatos.app.furhatdriver.StopListen':
+            self.stop_listening()
+        elif name == 'furhatos.event.actions.ActionSpeech':
+            if event.get('abort'):
+                aborted = await self.abort_speech()
+                if not event.get('text'):
+                    if not aborted:
+                        # Nothing to stop, but the client still waits for the end of speech
+                        await self.broadcast({'event_name': 'furhatos.event.monitors.MonitorSpeechEnd', 'text': ''})
+                    return
+            task = asyncio.create_task(self.speak(event))
+            self.speech_tasks.add(task)
+            task.add_done_callback(self.speech_tasks.discard)
+        elif name in relayed_events:
+            await self.broadcast({**event, 'event_name': relayed_events[name]})
+
+    async def serve_client(self, websocket, path: str = None):
+        if path is None:
+            path = getattr(websocket, 'path', None) or websocket.request.path
+        if path != '/api':
+            await websocket.close(code=1008, reason='Only /api is served')
+            return
+        self.clients[websocket] = set()
+        if not self.started.is_set():
+            self.start_time = time.monotonic()
+            self.started.set()
+        try:
+            async for message in websocket:
+                await self.handle(json.loads(message), websocket)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            del self.clients[websocket]
+
+    async def run(self, host: str = 'localhost', port: int = 8080, exit_when_done: bool = False):
+        async with websockets.serve(self.serve_client, host, port):
+            print(f"Simulating Furhat at ws://{host}:{port}/api")
+            pump = asyncio.create_task(self.pump())
+            try:
+                if exit_when_done:
+                    await self.finished.wait()
+                else:
+                    await asyncio.Future()
+            finally:
+                pump.cancel()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Emulate the Furhat Realtime API and FurhatDriver skill')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', type=Path, help='Recorded trace (file or directory) or JSONL trace of robot events to replay')
+    source.add_argument('--script', type=Path, help='Text file with one user utterance per line')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--speed', type=float, default=1.0, help='Playback speed of the trace timestamps and TTS')
+    parser.add_argument('--fast', action='store_true', help='Ignore trace timing and run as fast as possible')
+    parser.add_argument('--asr-delay', type=float, default=0.5, help='Seconds between a listen and the recognised speech')
+    parser.add_argument('--words-per-second', type=float, default=2.5, help='Speaking rate used for TTS durations')
+    parser.add_argument('--tts-duration', type=float, default=None, help='Fixed TTS duration in seconds')
+    parser.add_argument('--timeout-scale', type=float, default=1.0, help='Scale applied to listen timeouts')
+    parser.add_argument('--exit', action='store_true', help='Stop once the whole trace has been delivered')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        trace = load_trace(args.trace)
+    else:
+        trace = script_trace([line.strip() for line in open(args.script) if line.strip()])
+    simulator = FurhatSimulator(trace, None if args.fast else args.speed, args.asr_delay, args.words_per_second, args.tts_duration, args.timeout_scale)
+    asyncio.run(simulator.run(args.host, args.port, args.exit))
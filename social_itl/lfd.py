@@ -1,7 +1,14 @@
 import sentence_transformers
 from social_itl.furhat import UserSpeech, SpeakerRole
 from social_itl.utils import get_logger, get_data_path
-from typing import AsyncGenerator
+from social_itl.artifacts import store
+from social_itl.session_store import SessionHandler, get_session_store, read_pairs
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import threading
+import json
+import time
 import pickle
 import asyncio
 import numpy as np
@@ -10,34 +17,199 @@ from functools import partialmethod
 tqdm.__init__ = partialmethod(tqdm.__init__, disable=True)
 from simcse import SimCSE
 from scipy.spatial.distance import cosine
-similarity_model = SimCSE("princeton-nlp/sup-simcse-bert-base-uncased")
+similarity_model = None
 
+def embed(sentences: List[str]) -> np.ndarray:
+    # Loaded on first use, so building and querying the indexes does not pay for the model until text comes in
+    global similarity_model
+    if similarity_model is None:
+        similarity_model = SimCSE(store.resolve("sup-simcse-bert-base-uncased"))
+    return similarity_model.encode(sentences, return_numpy=True)
+
+
+class EmbeddingIndex():
+    """Embeddings of the states and actions of the pairs embedded so far, grown in place as pairs arrive"""
+    def __init__(self, dim: int = 768, capacity: int = 64):
+        self.states = np.zeros((capacity, dim), dtype=np.float32)
+        self.actions = np.zeros((capacity, dim), dtype=np.float32)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def append(self, states: np.ndarray, actions: np.ndarray):
+        with self.lock:
+            needed = self.size + len(states)
+            if needed > len(self.states):
+                capacity = max(needed, 2 * len(self.states))
+                self.states = np.resize(self.states, (capacity, self.states.shape[1]))
+                self.actions = np.resize(self.actions, (capacity, self.actions.shape[1]))
+            self.states[self.size:needed] = states
+            self.actions[self.size:needed] = actions
+            self.size = needed
+
+    def view(self):
+        with self.lock:
+            return self.states[:self.size], self.actions[:self.size]
+
+def context_embeddings(states: np.ndarray, actions: np.ndarray, window: int, decay: float) -> np.ndarray:
+    """
+    Decayed mean of the turns (state and action embedding averaged) before each pair, the most recent
+    weighted 1, the one before decay and so on for window turns. The first pair has no context.
+    """
+    turns = (states + actions) / 2
+    context = np.zeros_like(turns)
+    total = np.zeros((len(turns), 1), dtype=turns.dtype)
+    for j in range(1, min(window, len(turns)) + 1):
+        weight = decay ** (j - 1)
+        context[j:] += weight * turns[:-j]
+        total[j:] += weight
+    return context / np.maximum(total, 1e-9)
+
+def previous_actions(actions: np.ndarray) -> np.ndarray:
+    # Each state is paired with the action that came before it
+    return np.concatenate([np.zeros((1, actions.shape[1]), dtype=actions.dtype), actions[:-1]])
+
+def embed_pairs(pairs) -> Tuple[np.ndarray, np.ndarray]:
+    states, actions = zip(*pairs)
+    states = embed(list(states)).reshape(len(pairs), -1)
+    actions = embed(list(actions)).reshape(len(pairs), -1)
+    return states, actions
+
+def save_checkpoint(path: Path, states: np.ndarray, actions: np.ndarray):
+    tmp = path.with_suffix('.tmp.npz')
+    np.savez(tmp, states=states, actions=actions)
+    tmp.replace(path)
+
+def pairs_path(participant_id: str) -> Path:
+    return get_data_path('lfd') / f'p_{participant_id}.pkl'
+
+def load_demonstrations(participant_id: str) -> Tuple[List[Tuple[str, str]], np.ndarray, np.ndarray]:
+    """
+    Pairs of a participant with the state and action embeddings of every pair, read from the pair file and its
+    checkpoint without an LfD instance, so offline tools leave no session logs behind. Pairs the checkpoint
+    does not cover are embedded and checkpointed.
+    """
+    path = pairs_path(participant_id)
+    pairs = read_pairs(path)
+    states = actions = np.zeros((0, 768), dtype=np.float32)
+    if path.with_suffix('.npz').exists():
+        checkpoint = np.load(path.with_suffix('.npz'))
+        size = min(len(checkpoint['states']), len(pairs))
+        states, actions = checkpoint['states'][:size], checkpoint['actions'][:size]
+    if len(states) < len(pairs):
+        new_states, new_actions = embed_pairs(pairs[len(states):])
+        states = np.concatenate([states, new_states.astype(np.float32)])
+        actions = np.concatenate([actions, new_actions.astype(np.float32)])
+        save_checkpoint(path.with_suffix('.npz'), states, actions)
+    return pairs, states, actions
+
+def pairwise_distances(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    sq = np.sum(x ** 2, axis=1)[:, None] + np.sum(y ** 2, axis=1)[None, :] - 2 * x @ y.T
+    return np.sqrt(np.maximum(sq, 0))
 
 class LfD():
-    def __init__(self, participant_id: str = '0'):
+    def __init__(self, participant_id: str = '0', checkpoint_every: int = 10):
         self.pairs = []
-        self.logger = get_logger(f'LfD_{participant_id}', 'lfd', unique=True)
         self.participant_id = participant_id
-        if participant_id != '-1' and (get_data_path('lfd') / f'p_{self.participant_id}.pkl').exists():
+        # The log and the session are started on first use, so instances that only answer do not leave empty sessions behind
+        self._logger = None
+        self.session_id = None
+        self.index = EmbeddingIndex()
+        self.checkpoint_every = checkpoint_every
+        self.checkpointed = 0
+        # One worker keeps the embeddings in the same order as the pairs
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: Optional[Future] = None
+        self.context_cache = (None, None)
+        self.saved = False
+        if participant_id != '-1' and self.path.exists():
             self.load(vectorize=False)
-        self.actions = None
-        self.states = None
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            self._logger = get_logger(f'LfD_{self.participant_id}', 'lfd', unique=True)
+        return self._logger
+
+    @property
+    def path(self) -> Path:
+        return pairs_path(self.participant_id)
+
+    @property
+    def index_path(self) -> Path:
+        return self.path.with_suffix('.npz')
+
+    @property
+    def states(self) -> np.ndarray:
+        return self.index.view()[0]
+
+    @property
+    def actions(self) -> np.ndarray:
+        return previous_actions(self.index.view()[1])
+
+    @property
+    def ready(self) -> int:
+        """Number of pairs get_action can match against"""
+        return self.index.size
 
     def save(self):
-        path = get_data_path('lfd') / f'p_{self.participant_id}.pkl'
-        with open(path, 'wb') as f:
-            print("Saving pairs", self.pairs, "Particpant", self.participant_id)
+        """Rewrite the file as one list, folding in the pairs add_pair appended since the last save"""
+        path = self.path
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
             pickle.dump(self.pairs, f)
+        tmp.replace(path)
+        self.saved = True
+        self.logger.info(f"Saved {len(self.pairs)} pairs of participant {self.participant_id}")
+
+    def append_pair(self, state: str, action: str):
+        if not self.saved:
+            # Start from a clean file, pairs appended after a write that died halfway would not be read back
+            self.save()
+            return
+        # Only the new pair is written, read_pairs picks it up after the list
+        with open(self.path, 'ab') as f:
+            pickle.dump((state, action), f)
+
+    def save_index(self):
+        states, actions = self.index.view()
+        save_checkpoint(self.index_path, states, actions)
+        self.checkpointed = len(states)
+
+    def add_pair(self, state: str, action: str):
+        self.pairs.append((state, action))
+        if self.participant_id != '-1':
+            self.append_pair(state, action)
+            get_session_store().add_lfd_pair(self.participant_id, len(self.pairs) - 1, state, action, self.session_id)
+        self.pending = self.executor.submit(self.embed_pending)
+
+    def embed_pending(self):
+        start = self.index.size
+        pairs = self.pairs[start:]
+        if not pairs:
+            return
+        states, actions = embed_pairs(pairs)
+        self.index.append(states, actions)
+        if self.participant_id != '-1':
+            get_session_store().set_lfd_embeddings(self.participant_id, start, states, actions)
+        if self.participant_id != '-1' and self.index.size - self.checkpointed >= self.checkpoint_every:
+            self.save_index()
 
     def load(self, vectorize=True):
-        path = get_data_path('lfd') / f'p_{self.participant_id}.pkl'
-        with open(path, 'rb') as f:
-            self.pairs = pickle.load(f)
-            print(self.pairs)
+        self.pairs = read_pairs(self.path)
+        if self.index.size == 0 and self.index_path.exists():
+            # Reuse checkpointed embeddings, they cover a prefix of the pairs
+            checkpoint = np.load(self.index_path)
+            size = min(len(checkpoint['states']), len(self.pairs))
+            self.index.append(checkpoint['states'][:size], checkpoint['actions'][:size])
+            self.checkpointed = size
         if vectorize:
             self.vectorize()
 
     async def train(self, data: AsyncGenerator[UserSpeech, None]):
+        if self.participant_id != '-1' and self.session_id is None:
+            session_store = get_session_store()
+            self.session_id = session_store.start_session(self.participant_id, 'lfd')
+            self.logger.addHandler(SessionHandler(session_store, self.session_id))
         state = None
         action = None
         try:
@@ -47,7 +219,7 @@ class LfD():
                     if action is not None:
                         if state is None:
                             state = ''
-                        self.pairs.append((state, action))
+                        self.add_pair(state, action)
                         action = None
                         state = speech.text
                     elif state is None:
@@ -65,24 +237,285 @@ class LfD():
             if action is not None:
                 if state is None:
                     state = ''
-                self.pairs.append((state, action))
-        print(self.pairs)
+                self.add_pair(state, action)
+        self.logger.info(f"Learned {len(self.pairs)} pairs")
 
     def vectorize(self):
-        states, actions = zip(*self.pairs)
-        print(states)
-        states = similarity_model.encode(list(states), return_numpy=True)
-        actions = np.concatenate([np.zeros((1, 768)), similarity_model.encode(list(actions), return_numpy=True)[:-1]])
-        self.actions = actions
-        self.states = states
+        """Embed every pair that is not in the index yet and wait for it"""
+        self.executor.submit(self.embed_pending).result()
+        if self.participant_id != '-1' and self.index.size > self.checkpointed:
+            self.save_index()
+
+    def contexts(self, window: int, decay: float) -> np.ndarray:
+        """Context embedding of every pair embedded so far, recomputed only when the index has grown"""
+        key, contexts = self.context_cache
+        if key != (self.index.size, window, decay):
+            states, actions = self.index.view()
+            contexts = context_embeddings(states, actions, window, decay)
+            self.context_cache = ((len(states), window, decay), contexts)
+        return contexts
 
     def get_action(self, state: str, prev_action: str):
         if prev_action == '':
             action_embedding = np.zeros((1, 768))
         else:
-            action_embedding = similarity_model.encode([prev_action], return_numpy=True)
-        state_embedding = similarity_model.encode([state], return_numpy=True)
-        dist = 0.8 * np.linalg.norm(self.states - state_embedding, axis=1) + 0.2 * np.linalg.norm(self.actions - action_embedding, axis=1)
+            action_embedding = embed([prev_action])
+        state_embedding = embed([state])
+        # Pairs still being embedded are not searched yet
+        states, actions = self.index.view()
+        prev_actions = np.concatenate([np.zeros((1, actions.shape[1]), dtype=actions.dtype), actions[:-1]])
+        dist = 0.8 * np.linalg.norm(states - state_embedding, axis=1) + 0.2 * np.linalg.norm(prev_actions - action_embedding, axis=1)
         match_idx = np.argmin(dist)
         return self.pairs[match_idx][1], dist[match_idx]
-        
\ No newline at end of file
+
+class ContextWindow():
+    """
+    Matches a conversation against an LfD model using the last window turns as well as the current state
+    and previous action. Answers are actions of the model, so their embeddings come from the index and
+    every turn only embeds what the customer said.
+    """
+    def __init__(self, lfd: LfD, weights=None):
+        self.lfd = lfd
+        if weights is None:
+            weights = load_context_weights()
+        self.state_weight, self.action_weight, self.context_weight = weights['weights']
+        self.window = weights['window']
+        self.decay = weights['decay']
+        self.turns = []
+        self.prev_action = np.zeros(768, dtype=np.float32)
+        self.undo_state = (self.prev_action, 0)
+
+    def reset(self):
+        self.turns = []
+        self.prev_action = np.zeros(768, dtype=np.float32)
+
+    def context(self) -> np.ndarray:
+        context = np.zeros(768, dtype=np.float32)
+        total = 0.0
+        for j, turn in enumerate(reversed(self.turns[-self.window:])):
+            context += self.decay ** j * turn
+            total += self.decay ** j
+        return context / max(total, 1e-9)
+
+    def get_action(self, state: str):
+        state_embedding = embed([state]).reshape(-1)
+        states, actions = self.lfd.index.view()
+        prev_actions = np.concatenate([np.zeros((1, actions.shape[1]), dtype=actions.dtype), actions[:-1]])
+        contexts = self.lfd.contexts(self.window, self.decay)[:len(states)]
+        # The window only changes the precomputed contexts, a query is the same three distances for any window
+        dist = (self.state_weight * np.linalg.norm(states - state_embedding, axis=1)
+                + self.action_weight * np.linalg.norm(prev_actions - self.prev_action, axis=1)
+                + self.context_weight * np.linalg.norm(contexts - self.context(), axis=1))
+        match_idx = int(np.argmin(dist))
+        self.undo_state = (self.prev_action, len(self.turns))
+        self.prev_action = actions[match_idx]
+        self.turns.append((state_embedding + self.prev_action) / 2)
+        return self.lfd.pairs[match_idx][1], dist[match_idx]
+
+    def undo(self):
+        """Forget the last match, when the robot asked for clarification instead of answering"""
+        self.prev_action, size = self.undo_state
+        del self.turns[size:]
+
+default_context_weights = {'weights': [0.6, 0.2, 0.2], 'window': 3, 'decay': 0.5}
+
+def context_weights_path() -> Path:
+    return get_data_path('lfd') / 'context_weights.json'
+
+def load_context_weights() -> Dict:
+    if context_weights_path().exists():
+        with open(context_weights_path()) as f:
+            return json.load(f)
+    return dict(default_context_weights)
+
+def fit_context_weights(demonstrations, windows=(1, 2, 3, 5), decays=(0.3, 0.5, 0.8), step: float = 0.1) -> Dict:
+    """
+    Grid search over the window, decay and the weights of state, previous action and context, given the
+    (states, actions) embeddings of each participant. Each pair is matched against the other pairs of its
+    participant (leave one out), and a setting is scored by the mean cosine similarity between the action
+    it retrieves and the action that was demonstrated.
+    """
+    data = []
+    for states, actions in demonstrations:
+        if len(states) < 3:
+            continue
+        prev_actions = previous_actions(actions)
+        normed = actions / np.maximum(np.linalg.norm(actions, axis=1, keepdims=True), 1e-9)
+        data.append(((states, actions), pairwise_distances(states, states), pairwise_distances(prev_actions, prev_actions), normed @ normed.T))
+    if not data:
+        raise ValueError('Not enough demonstrations to fit the context weights')
+    grid = [(float(a), float(b), round(float(1 - a - b), 6)) for a in np.arange(0, 1 + 1e-9, step) for b in np.arange(0, 1 - a + 1e-9, step)]
+    results = []
+    for window in windows:
+        for decay in decays:
+            context_dists = []
+            for (states, actions), _, _, _ in data:
+                contexts = context_embeddings(states, actions, window, decay)
+                context_dists.append(pairwise_distances(contexts, contexts))
+            for weights in grid:
+                similarity = []
+                for (_, state_dist, action_dist, action_sim), context_dist in zip(data, context_dists):
+                    dist = weights[0] * state_dist + weights[1] * action_dist + weights[2] * context_dist
+                    np.fill_diagonal(dist, np.inf)
+                    match = np.argmin(dist, axis=1)
+                    similarity.append(action_sim[np.arange(len(match)), match])
+                results.append((float(np.mean(np.concatenate(similarity))), window, decay, weights))
+    score, window, decay, weights = max(results, key=lambda r: r[0])
+    baseline = max(r[0] for r in results if r[3][2] == 0)
+    print(f"Best: window {window}, decay {decay}, weights {weights}, similarity {score:.3f} (without context {baseline:.3f})")
+    return {'weights': [float(w) for w in weights], 'window': int(window), 'decay': float(decay), 'similarity': score}
+
+class PooledLfD():
+    """
+    Demonstrations of every participant in one index. Embeddings live in memory-mapped float32 files
+    next to a participant id column, and sync() appends pairs that are not in the index yet, so new
+    participants, or participants that are still demonstrating, never require a rebuild.
+    """
+    def __init__(self, path: Optional[Path] = None, dim: int = 768):
+        self.path = Path(path) if path is not None else get_data_path('lfd') / 'pooled'
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.manifest = {'dim': dim, 'size': 0, 'participants': {}}
+        if (self.path / 'manifest.json').exists():
+            with open(self.path / 'manifest.json') as f:
+                self.manifest = json.load(f)
+        self.pairs = {}
+        for participant_id in self.manifest['participants']:
+            self.pairs[participant_id] = read_pairs(pairs_path(participant_id))
+        self.open()
+
+    def open(self):
+        size = self.manifest['size']
+        # Bytes past size are from an append that died before the manifest was written
+        for name, dtype in (('states', np.float32), ('actions', np.float32), ('ids', np.int32), ('rows', np.int32)):
+            file = self.path / f'{name}.bin'
+            shape = (size, self.dim) if name in ('states', 'actions') else (size,)
+            if size == 0:
+                setattr(self, name, np.zeros(shape, dtype=dtype))
+            else:
+                setattr(self, name, np.memmap(file, dtype=dtype, mode='r', shape=shape))
+
+    def write_manifest(self):
+        tmp = self.path / 'manifest.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        tmp.replace(self.path / 'manifest.json')
+
+    def append(self, participant_id: str, states: np.ndarray, actions: np.ndarray):
+        size = self.manifest['size']
+        n = len(states)
+        start = self.manifest['participants'].get(participant_id, {}).get('count', 0)
+        columns = {
+            'states': states.astype(np.float32),
+            'actions': actions.astype(np.float32),
+            'ids': np.full(n, int(participant_id), dtype=np.int32),
+            'rows': np.arange(start, start + n, dtype=np.int32),
+        }
+        for name, values in columns.items():
+            with open(self.path / f'{name}.bin', 'r+b' if (self.path / f'{name}.bin').exists() else 'wb') as f:
+                f.seek(size * values[0].nbytes)
+                f.write(values.tobytes())
+                f.truncate()
+        self.manifest['size'] = size + n
+        self.manifest['participants'][participant_id] = {'count': start + n, 'updated': time.time()}
+        self.write_manifest()
+        self.open()
+
+    def sync(self, live: Optional[Dict[str, LfD]] = None) -> int:
+        """
+        Add the pairs of every participant file that are not in the index yet, returns the number of pairs added.
+        Participants in live are read from those LfD instances, whose embeddings are already mostly done.
+        """
+        live = live or {}
+        added = 0
+        for file in sorted(get_data_path('lfd').glob('p_*.pkl')):
+            participant_id = file.stem[2:]
+            if not participant_id.isdigit():
+                continue
+            count = self.manifest['participants'].get(participant_id, {}).get('count', 0)
+            if participant_id in live:
+                lfd = live[participant_id]
+                if len(lfd.pairs) <= count:
+                    continue
+                lfd.vectorize()
+                pairs, states, actions = lfd.pairs, lfd.states, lfd.actions
+            else:
+                if len(read_pairs(file)) <= count:
+                    continue
+                # Reuses the participant's embedding checkpoint and only embeds what it does not cover
+                pairs, states, actions = load_demonstrations(participant_id)
+                actions = previous_actions(actions)
+            self.append(participant_id, states[count:], actions[count:])
+            self.pairs[participant_id] = pairs
+            added += len(pairs) - count
+            print(f"Pooled {len(pairs) - count} pairs of participant {participant_id}")
+        return added
+
+    def scores(self, state: str, prev_action: str, participants=None, exclude=None, weights=None, half_life: Optional[float] = None) -> np.ndarray:
+        """LfD distance to every row, scaled by the participant weights and age, inf for rows that are filtered out"""
+        if prev_action == '':
+            action_embedding = np.zeros((1, self.dim), dtype=np.float32)
+        else:
+            action_embedding = embed([prev_action])
+        state_embedding = embed([state])
+        dist = 0.8 * np.linalg.norm(self.states - state_embedding, axis=1) + 0.2 * np.linalg.norm(self.actions - action_embedding, axis=1)
+        if participants is not None:
+            dist[~np.isin(self.ids, [int(p) for p in participants])] = np.inf
+        if exclude is not None:
+            dist[np.isin(self.ids, [int(p) for p in exclude])] = np.inf
+        if (weights is not None or half_life is not None) and len(self.ids):
+            scale = np.ones(int(self.ids.max()) + 1)
+            now = time.time()
+            for participant_id, info in self.manifest['participants'].items():
+                weight = 1.0 if weights is None else weights.get(participant_id, 1.0)
+                if half_life is not None:
+                    weight *= 0.5 ** ((now - info['updated']) / half_life)
+                scale[int(participant_id)] = weight
+            # Preferred participants look closer, a weight of 0 removes them
+            with np.errstate(divide='ignore'):
+                dist = dist / scale[self.ids]
+        return dist
+
+    def top_k(self, state: str, prev_action: str, k: int = 5, **filters):
+        """(action, distance, participant id) of the k best matches"""
+        dist = self.scores(state, prev_action, **filters)
+        k = min(k, int(np.sum(np.isfinite(dist))))
+        if k == 0:
+            return []
+        idx = np.argpartition(dist, k - 1)[:k]
+        idx = idx[np.argsort(dist[idx])]
+        return [(self.pairs[str(self.ids[i])][self.rows[i]][1], float(dist[i]), str(self.ids[i])) for i in idx]
+
+    def get_action(self, state: str, prev_action: str, **filters):
+        matches = self.top_k(state, prev_action, k=1, **filters)
+        if not matches:
+            raise FileNotFoundError('No pooled LfD data')
+        action, dist, _ = matches[0]
+        return action, dist
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build the pooled LfD index and query it')
+    parser.add_argument('--state', default=None, help='Customer utterance to match')
+    parser.add_argument('--prev-action', default='')
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--participants', nargs='+', default=None, help='Only match these participants')
+    parser.add_argument('--exclude', nargs='+', default=None)
+    parser.add_argument('--half-life', type=float, default=None, help='Halve the weight of a participant every this many seconds since their last pair')
+    parser.add_argument('--fit-context', action='store_true', help='Fit the ContextWindow weights on the demonstrations of --participants (default all) instead')
+    args = parser.parse_args()
+    if args.fit_context:
+        participants = args.participants or sorted(f.stem[2:] for f in get_data_path('lfd').glob('p_*.pkl') if f.stem[2:].isdigit())
+        weights = fit_context_weights([load_demonstrations(p)[1:] for p in participants if p not in (args.exclude or [])])
+        with open(context_weights_path(), 'w') as f:
+            json.dump(weights, f, indent=2)
+        print("Saved to", context_weights_path())
+        raise SystemExit
+    pooled = PooledLfD()
+    print("Added", pooled.sync(), "pairs,", pooled.manifest['size'], "in total")
+    if args.state is not None:
+        start = time.perf_counter()
+        matches = pooled.top_k(args.state, args.prev_action, k=args.k, participants=args.participants, exclude=args.exclude, half_life=args.half_life)
+        print(f"Query took {(time.perf_counter() - start) * 1000:.1f}ms")
+        for action, dist, participant_id in matches:
+            print(f"{dist:.3f} [{participant_id}] {action}")
@@ -1,64 +1,131 @@
 import xlsxwriter
 import collections
+import datetime
+import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
 
+# Timestamp, speaker and text of the lines of a furhat.log() log that are turns
+turn_line = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - (Robot|User): (.*)$')
+# <name>-<participant>-<timestamp>.txt
+log_participant = re.compile(r'-(\d+)-\d{14}\.txt$')
 
-def logs2xlsx(logs, output_file):
-    workbook = xlsxwriter.Workbook(output_file)
-    header_format = workbook.add_format({
-        'border': 1,
-        'bold': True,
-        'text_wrap': True,
-        'valign': 'vcenter',
-    })
-    body_format = workbook.add_format({
-        'valign': 'vjustify',
-    })
-    worksheet = workbook.add_worksheet()
+categories = ['Greeting', 'Checkin', 'Luggage', 'Checkout', 'Amenities', 'Resturants', 'Other']
+ratings = ['Appropriate', 'Appropriate w/ ASR error', 'Inappropriate']
+columns = ['Customer Said', 'Robot Responded', 'Robot Should Do', 'Robot Answer', 'Customer Time', 'Robot Time', 'Latency (s)']
+
+Turn = Tuple[datetime.datetime, str, str]
+
+def group_logs(logs: Iterable[Path]) -> Dict[str, List[Path]]:
     combined_logs = collections.defaultdict(list)
+    for log in sorted(logs):
+        match = log_participant.search(Path(log).name)
+        if match is not None:
+            combined_logs[match.group(1)].append(Path(log))
+    return combined_logs
+
+def read_turns(logs: List[Path]) -> Iterator[Turn]:
+    """Turns of the logs of one participant, a line at a time"""
     for log in logs:
         with open(log, 'r') as f:
-            pid = str(log).split('-')[1]
-            combined_logs[pid] += f.readlines()
+            for line in f:
+                match = turn_line.match(line)
+                if match is not None:
+                    when, speaker, text = match.groups()
+                    yield datetime.datetime.strptime(when, '%Y-%m-%d %H:%M:%S,%f'), speaker, text.strip()
+
+def store_turns(kind: str) -> Dict[str, List[Turn]]:
+    """The same turns as read_turns, from the sessions of this kind in the session store"""
+    from social_itl.session_store import get_session_store
+    return {
+        pid: [(datetime.datetime.fromtimestamp(turn['time']), turn['speaker'].capitalize(), turn['text'])
+              for turn in turns if turn['speaker'] in ('robot', 'user')]
+        for pid, turns in get_session_store().turns(kind=kind).items()
+    }
+
+def add_formats(workbook):
+    return {
+        'header': workbook.add_format({'border': 1, 'bold': True, 'text_wrap': True, 'valign': 'vcenter'}),
+        'body': workbook.add_format({'valign': 'vjustify'}),
+        'time': workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss.000', 'valign': 'vjustify'}),
+        'latency': workbook.add_format({'num_format': '0.000', 'valign': 'vjustify'}),
+    }
 
+def write_sheet(workbook, formats, name: str, turns: Iterable[Turn]) -> int:
+    """
+    One row per robot response, next to what the customer said before it. Rows are written in order so the
+    workbook can use constant_memory. Returns the number of rows.
+    """
+    worksheet = workbook.add_worksheet(name)
+    worksheet.set_column('A:B', 30)
+    worksheet.set_column('C:D', 20)
+    worksheet.set_column('E:F', 22)
+    worksheet.set_column('G:G', 10)
+    for col, title in enumerate(columns):
+        worksheet.write(0, col, title, formats['header'])
+    row = 1
+    user_time = None
+    for when, speaker, text in turns:
+        if speaker == 'User':
+            worksheet.write(row, 0, '(No response)' if text == '' else text, formats['body'])
+            worksheet.write_datetime(row, 4, when, formats['time'])
+            user_time = when
+        else:
+            worksheet.write(row, 1, text, formats['body'])
+            worksheet.write_datetime(row, 5, when, formats['time'])
+            if user_time is not None:
+                worksheet.write_number(row, 6, (when - user_time).total_seconds(), formats['latency'])
+            user_time = None
+            row += 1
+    if row > 1:
+        worksheet.data_validation(1, 2, row - 1, 2, {'validate': 'list', 'source': categories})
+        worksheet.data_validation(1, 3, row - 1, 3, {'validate': 'list', 'source': ratings})
+    return row - 1
+
+def logs2xlsx(combined_logs: Dict[str, Iterable[Turn]], output_file):
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True})
+    formats = add_formats(workbook)
+    workbook.add_worksheet()
     for pid in sorted(combined_logs.keys()):
-        worksheet = workbook.add_worksheet(pid)
-        worksheet.set_column('A:B', 30)
-        worksheet.set_column('C:D', 20)
-        worksheet.write('A1', 'Customer Said', header_format)
-        worksheet.write('B1', 'Robot Responded', header_format)
-        worksheet.write('C1', 'Robot Should Do', header_format)
-        worksheet.write('D1', 'Robot Answer', header_format)
-        row = 1
-        for line in combined_logs[pid]:
-            try:
-                robot_utterance = line.split('Robot: ')[1]
-                worksheet.write(row, 1, robot_utterance, body_format)
-                worksheet.data_validation(row, 2, row, 2, {'validate': 'list',
-                                 'source': ['Greeting', 'Checkin', 'Luggage', 'Checkout', 'Amenities', 'Resturants', 'Other'],
-                                 })
-                worksheet.data_validation(row, 3, row, 3, {'validate': 'list',
-                                    'source': ['Appropriate', 'Appropriate w/ ASR error', 'Inappropriate'],
-                                    })
-                row += 1
-                continue
-            except IndexError:
-                robot_utterance = None
-            try:
-                user_utterance = line.split('User: ')[1].strip()
-                print(f"User utterance '{user_utterance}'")
-                user_utterance = '(No response)' if user_utterance == '' else user_utterance
-                worksheet.write(row, 0, user_utterance, body_format)
-                continue
-            except IndexError:
-                user_utterance = None
+        rows = write_sheet(workbook, formats, pid, combined_logs[pid])
+        print(f"Participant {pid}: {rows} rows")
+    workbook.close()
+
+def participant_workbook(pid: str, logs: List[Path], output_file: Path) -> int:
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True})
+    rows = write_sheet(workbook, add_formats(workbook), pid, read_turns(logs))
     workbook.close()
+    return rows
+
+def split_logs2xlsx(combined_logs: Dict[str, List[Path]], output_file: Path, workers: int = None):
+    """One workbook per participant next to output_file, written in parallel"""
+    output_file = Path(output_file)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {
+            pid: executor.submit(participant_workbook, pid, logs, output_file.with_name(f'{output_file.stem}-{pid}{output_file.suffix}'))
+            for pid, logs in sorted(combined_logs.items())
+        }
+        for pid, future in futures.items():
+            print(f"Participant {pid}: {future.result()} rows")
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--logdir')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--logdir')
+    source.add_argument('--kind', help='Read the sessions of this kind (e.g. lfd_eval) from the session store instead')
     parser.add_argument('-o', '--output-file', default='logs.xlsx')
+    parser.add_argument('--split', action='store_true', help='Write one workbook per participant, in parallel')
+    parser.add_argument('--workers', type=int, default=None)
     args = parser.parse_args()
-    logs = Path(args.logdir).glob('*.txt')
-    logs2xlsx(logs, args.output_file)
\ No newline at end of file
+    if args.split and args.kind is not None:
+        parser.error('--split only works with --logdir')
+    if args.kind is not None:
+        logs2xlsx(store_turns(args.kind), args.output_file)
+    else:
+        combined_logs = group_logs(Path(args.logdir).glob('*.txt'))
+        if args.split:
+            split_logs2xlsx(combined_logs, args.output_file, args.workers)
+        else:
+            logs2xlsx({pid: read_turns(logs) for pid, logs in combined_logs.items()}, args.output_file)
@@ -0,0 +1,106 @@
+import time
+import numpy as np
+import torch
+from transformers import AutoModelForTokenClassification, T5ForConditionalGeneration
+from social_itl.artifacts import store
+from social_itl.utils import get_model_path
+
+def quantize(model: torch.nn.Module) -> torch.nn.Module:
+    # Dynamic int8 quantization only converts the Linear layers, which is where BERT and T5 spend their time on CPU
+    return torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_onnx(name: str, seq2seq: bool = False):
+    """Export a trained model to ONNX Runtime on first use and load the exported copy afterwards"""
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTModelForTokenClassification
+    cls = ORTModelForSeq2SeqLM if seq2seq else ORTModelForTokenClassification
+    path = get_model_path(f'{name}-onnx')
+    if not path.exists():
+        model = cls.from_pretrained(store.resolve(name), export=True)
+        model.save_pretrained(path)
+        store.record(f'{name}-onnx')
+    return cls.from_pretrained(path)
+
+def load_parser(device: str = 'cpu', quantized: bool = False, onnx: bool = False, parser_model: str = 'parse-model'):
+    if onnx:
+        return load_onnx(parser_model, seq2seq=True)
+    parse_model = store.from_pretrained(T5ForConditionalGeneration, parser_model)
+    if quantized:
+        if device != 'cpu':
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        parse_model = quantize(parse_model)
+    return parse_model.to(device)
+
+def load_models(device: str = 'cpu', quantized: bool = False, onnx: bool = False, anonymizer_model: str = 'bert-model', parser_model: str = 'parse-model'):
+    if onnx:
+        return load_onnx(anonymizer_model), load_parser(onnx=True, parser_model=parser_model)
+    bert_model = store.from_pretrained(AutoModelForTokenClassification, anonymizer_model)
+    if quantized:
+        if device != 'cpu':
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        bert_model = quantize(bert_model)
+    return bert_model, load_parser(device, quantized, parser_model=parser_model)
+
+def latency_summary(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+def benchmark(parser, samples):
+    """Time the models on each sample. They are called directly, parser.parse would answer repeated samples from the parse cache"""
+    from social_itl.nlp.parse_constraint import joint_input
+    from social_itl.tasklearning.tree_parser import ParseError
+    outputs = []
+    latencies = []
+    for sample in samples:
+        start = time.perf_counter()
+        sentence_anon, subs = (joint_input(sample), {}) if parser.joint else parser.pipe(sample)
+        parse, score, complete = parser.generate([sentence_anon])[0]
+        latencies.append(time.perf_counter() - start)
+        try:
+            parser.check_parse(parse, score, complete)
+            outputs.append(parser.fill_phrases(parse, subs))
+        except ParseError:
+            outputs.append(None)
+    return outputs, latencies
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    from social_itl.data.dataset import get_dataset
+    from social_itl.tasklearning.tree_parser import TextParser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-samples', type=int, default=500)
+    parser.add_argument('--onnx', action='store_true', help='Also benchmark the ONNX Runtime export')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    test = get_dataset()['test'].select(range(args.num_samples))
+    # Live input has no quotes, the anonymizer has to find the phrases itself
+    samples = [s.replace('"', '') for s in test['sentence']]
+    references = [p.replace('"', '') for p in test['parse']]
+
+    modes = {'fp32': {}, 'int8': {'quantize': True}}
+    if args.onnx:
+        modes['onnx'] = {'onnx': True}
+    outputs = {}
+    results = {}
+    for mode, kwargs in modes.items():
+        print("Benchmarking", mode)
+        outputs[mode], latencies = benchmark(TextParser(device='cpu', **kwargs), samples)
+        results[mode] = {
+            'exact_match': float(np.mean([o is not None and o.strip() == r.strip() for o, r in zip(outputs[mode], references)])),
+            'agreement_with_fp32': float(np.mean([o == b for o, b in zip(outputs[mode], outputs['fp32'])])),
+            'parse_failures': sum(o is None for o in outputs[mode]),
+            **latency_summary(latencies),
+        }
+
+    print(f"{'mode':<6} {'exact':>7} {'agree':>7} {'fail':>5} {'mean':>8} {'p50':>8} {'p95':>8}")
+    for mode, r in results.items():
+        print(f"{mode:<6} {r['exact_match']:>7.3f} {r['agreement_with_fp32']:>7.3f} {r['parse_failures']:>5d} {r['mean_ms']:>7.1f}ms {r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
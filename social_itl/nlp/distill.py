@@ -0,0 +1,168 @@
+import copy
+import json
+import torch
+import torch.nn.functional as F
+from transformers import (AutoModelForTokenClassification, AutoTokenizer, DataCollatorForTokenClassification,
+                          T5ForConditionalGeneration, T5Tokenizer, Trainer, TrainingArguments)
+from social_itl.artifacts import store
+from social_itl.data.dataset import get_dataset
+from social_itl.nlp.train_anonymizer import tokenize_dataset
+from social_itl.nlp.train_parser import ParserDataCollator, preprocess as preprocess_parser, precision_kwargs
+from social_itl.utils import get_model_path
+
+student_models = {'anonymizer_model': 'bert-model-student', 'parser_model': 'parse-model-student'}
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature: float, alpha: float):
+    """Cross entropy on the labels mixed with the KL divergence to the softened teacher distribution"""
+    mask = labels != -100
+    student_logits = student_logits[mask]
+    teacher_logits = teacher_logits[mask]
+    ce = F.cross_entropy(student_logits, labels[mask])
+    kl = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=-1),
+        F.softmax(teacher_logits / temperature, dim=-1),
+        reduction='batchmean',
+    ) * temperature ** 2
+    return alpha * ce + (1 - alpha) * kl
+
+class DistillationTrainer(Trainer):
+    def __init__(self, teacher, temperature: float = 2.0, alpha: float = 0.5, **kwargs):
+        super().__init__(**kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        inputs.pop('allowed_ids', None)
+        outputs = model(**inputs)
+        with torch.no_grad():
+            teacher_logits = self.teacher(**inputs).logits
+        loss = distillation_loss(outputs.logits, teacher_logits, inputs['labels'], self.temperature, self.alpha)
+        return (loss, outputs) if return_outputs else loss
+
+def bert_student(teacher, num_layers: int):
+    """Shallower copy of the teacher, initialised from evenly spaced teacher layers"""
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = num_layers
+    student = AutoModelForTokenClassification.from_config(config)
+    student.base_model.embeddings.load_state_dict(teacher.base_model.embeddings.state_dict())
+    step = teacher.config.num_hidden_layers // num_layers
+    for i, layer in enumerate(student.base_model.encoder.layer):
+        layer.load_state_dict(teacher.base_model.encoder.layer[(i + 1) * step - 1].state_dict())
+    student.classifier.load_state_dict(teacher.classifier.state_dict())
+    return student
+
+def training_args(name: str, args, learning_rate: float) -> TrainingArguments:
+    return TrainingArguments(
+        output_dir=f"../data/{name}-results",
+        learning_rate=learning_rate,
+        per_device_train_batch_size=args.batch_size,
+        num_train_epochs=args.epochs,
+        weight_decay=0.01,
+        group_by_length=True,
+        remove_unused_columns=False,
+        save_strategy="no",
+        **precision_kwargs(args.precision),
+    )
+
+def distill_anonymizer(args):
+    tokenizer = store.from_pretrained(AutoTokenizer, "bert-base-uncased")
+    teacher = store.from_pretrained(AutoModelForTokenClassification, "bert-model")
+    student = bert_student(teacher, args.layers)
+    dataset = tokenize_dataset(get_dataset(), tokenizer, args.num_proc)
+    trainer = DistillationTrainer(
+        teacher=teacher,
+        temperature=args.temperature,
+        alpha=args.alpha,
+        model=student,
+        args=training_args('anonymizer-student', args, args.anonymizer_learning_rate),
+        train_dataset=dataset['train'],
+        data_collator=DataCollatorForTokenClassification(tokenizer=tokenizer),
+    )
+    trainer.train()
+    student.save_pretrained(get_model_path(student_models['anonymizer_model']), safe_serialization=True)
+    store.record(student_models['anonymizer_model'])
+
+def distill_parser(args):
+    tokenizer = store.from_pretrained(T5Tokenizer, "t5-base", model_max_length=128)
+    teacher = store.from_pretrained(T5ForConditionalGeneration, "parse-model")
+    # t5-small shares the t5-base vocabulary, so teacher and student logits line up
+    student = store.from_pretrained(T5ForConditionalGeneration, args.parser_student)
+    dataset = get_dataset()
+    dataset = dataset.map(
+        preprocess_parser,
+        batched=True,
+        batch_size=1000,
+        num_proc=args.num_proc,
+        remove_columns=dataset.column_names['train'],
+        fn_kwargs={'tokenizer': tokenizer, 'special_ids': set(tokenizer.all_special_ids)},
+    )
+    trainer = DistillationTrainer(
+        teacher=teacher,
+        temperature=args.temperature,
+        alpha=args.alpha,
+        model=student,
+        args=training_args('parser-student', args, args.parser_learning_rate),
+        train_dataset=dataset['train'],
+        data_collator=ParserDataCollator(tokenizer, model=student, label_pad_token_id=-100),
+    )
+    trainer.train()
+    student.save_pretrained(get_model_path(student_models['parser_model']), safe_serialization=True)
+    store.record(student_models['parser_model'])
+
+def num_parameters(model) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+def report(args):
+    from social_itl.nlp.eval_models import evaluate_anonymizer, evaluate_parser
+    from social_itl.tasklearning.tree_parser import TextParser
+    test = get_dataset()['test']
+    if args.num_samples is not None:
+        test = test.select(range(min(args.num_samples, len(test))))
+    results = {}
+    for device in args.devices:
+        for name, kwargs in (('teacher', {}), ('student', student_models)):
+            print(f"Evaluating {name} on {device}")
+            parser = TextParser(device=device, cache_size=0, **kwargs)
+            results[f'{name}-{device}'] = {
+                'anonymizer_parameters': num_parameters(parser.pipe.model),
+                'parser_parameters': num_parameters(parser.model),
+                'anonymizer': evaluate_anonymizer(parser, test, args.batch_size),
+                'parser': evaluate_parser(parser, test, args.batch_size),
+            }
+
+    print(f"{'model':<16} {'anon f1':>8} {'anon p95':>9} {'parse em':>9} {'parse p95':>10} {'params':>8}")
+    for name, r in results.items():
+        params = (r['anonymizer_parameters'] + r['parser_parameters']) / 1e6
+        print(f"{name:<16} {r['anonymizer']['token_f1']:>8.3f} {r['anonymizer']['p95_ms']:>7.1f}ms "
+              f"{r['parser']['exact_match']:>9.3f} {r['parser']['p95_ms']:>8.1f}ms {params:>7.1f}M")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Distill the anonymizer and parser into smaller student models')
+    parser.add_argument('command', choices=['anonymizer', 'parser', 'report', 'all'])
+    parser.add_argument('--layers', type=int, default=4, help='Encoder layers of the anonymizer student')
+    parser.add_argument('--parser-student', default='t5-small', help='Initial weights of the parser student')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.5, help='Weight of the label loss against the teacher loss')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=64)
+    # The rates train_anonymizer and train_parser use for the teachers
+    parser.add_argument('--anonymizer-learning-rate', type=float, default=2e-5)
+    parser.add_argument('--parser-learning-rate', type=float, default=3e-4)
+    parser.add_argument('--precision', choices=['auto', 'fp32', 'fp16', 'bf16'], default='auto')
+    parser.add_argument('--num-proc', type=int, default=None)
+    parser.add_argument('--devices', nargs='+', default=['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu'])
+    parser.add_argument('--num-samples', type=int, default=1000)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.command in ('anonymizer', 'all'):
+        distill_anonymizer(args)
+    if args.command in ('parser', 'all'):
+        distill_parser(args)
+    if args.command in ('report', 'all'):
+        report(args)
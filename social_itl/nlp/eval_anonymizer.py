@@ -1,15 +1,10 @@
 import datasets
+import torch
 from transformers import AutoTokenizer
 from tokenizers import Tokenizer
 from transformers import AutoModelForTokenClassification, TrainingArguments, Trainer
 from transformers.pipelines.token_classification import TokenClassificationPipeline
-from social_itl.utils import get_model_path
-
-tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-
-model_path = get_model_path("bert-model")
-
-model = AutoModelForTokenClassification.from_pretrained(str(model_path))
+from social_itl.artifacts import store
 
 class AnonymizationPipeline(TokenClassificationPipeline):
     def __init__(self, **kwargs):
@@ -34,13 +29,20 @@ class AnonymizationPipeline(TokenClassificationPipeline):
             result = result[:-1] + "\""
         return result
 
-pipe = AnonymizationPipeline(model=model, tokenizer=tokenizer, device=0)
+def main():
+    tokenizer: AutoTokenizer = store.from_pretrained(AutoTokenizer, "bert-base-uncased")
+    model = store.from_pretrained(AutoModelForTokenClassification, "bert-model")
+    device = 0 if torch.cuda.is_available() else -1
+    pipe = AnonymizationPipeline(model=model, tokenizer=tokenizer, device=device)
+
+    print(pipe(["Say hello to the customer",
+        "ask them what they would like to order",
+        "if they say sandwich then ask them what meat they would like",
+        "next ask them whether they want cheese",
+        "ask them if they want any other toppings",
+        "then tell them to go to the payment counter",
+        "say to the customer welcome to starbucks what can i get you",
+        "ask the customer how is your day going"]))
 
-print(pipe(["Say hello to the customer",
-"ask them what they would like to order",
-"if they say sandwich then ask them what meat they would like",
-"next ask them whether they want cheese",
-"ask them if they want any other toppings",
-"then tell them to go to the payment counter",
-"say to the customer welcome to starbucks what can i get you",
-"ask the customer how is your day going"]))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List
+import numpy as np
+import torch
+from social_itl.data.dataset import get_dataset
+from social_itl.nlp.cpu_inference import latency_summary
+from social_itl.nlp.train_anonymizer import label_sentence
+from social_itl.nlp.parse_constraint import joint_example
+
+def function_name(parse: str) -> str:
+    return parse.split('(', 1)[0].strip()
+
+def predict_labels(model, tokenizer, words: List[List[str]], device: str) -> List[List[int]]:
+    """Label of the first sub-token of every word, words that were truncated away are labelled 0"""
+    inputs = tokenizer(words, is_split_into_words=True, truncation=True, padding=True, return_tensors='pt')
+    with torch.no_grad():
+        logits = model(**{k: v.to(device) for k, v in inputs.items()}).logits
+    predictions = logits.argmax(dim=-1).tolist()
+    labels = []
+    for i, sentence in enumerate(words):
+        label = [0] * len(sentence)
+        previous = None
+        for token, word_idx in enumerate(inputs.word_ids(i)):
+            if word_idx is not None and word_idx != previous:
+                label[word_idx] = predictions[i][token]
+            previous = word_idx
+        labels.append(label)
+    return labels
+
+def evaluate_anonymizer(parser, dataset, batch_size: int) -> Dict:
+    model = parser.pipe.model
+    tokenizer = parser.pipe.tokenizer
+    tp = fp = fn = 0
+    correct = 0
+    total = 0
+    latencies = []
+    start = time.perf_counter()
+    for batch in dataset.iter(batch_size=batch_size):
+        sentences, labels = zip(*[label_sentence(s) for s in batch['sentence']])
+        words = [s.split(' ') for s in sentences]
+        batch_start = time.perf_counter()
+        predictions = predict_labels(model, tokenizer, words, parser.device)
+        latencies.append(time.perf_counter() - batch_start)
+        for label, prediction in zip(labels, predictions):
+            label = np.array(label) == 1
+            prediction = np.array(prediction) == 1
+            tp += int(np.sum(label & prediction))
+            fp += int(np.sum(~label & prediction))
+            fn += int(np.sum(label & ~prediction))
+            correct += bool(np.all(label == prediction))
+            total += 1
+    elapsed = time.perf_counter() - start
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {
+        'token_precision': precision,
+        'token_recall': recall,
+        'token_f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'sentence_accuracy': correct / total,
+        'sentences_per_second': total / elapsed,
+        **latency_summary(latencies),
+    }
+
+def evaluate_parser(parser, dataset, batch_size: int, show_errors: int = 0) -> Dict:
+    from social_itl.tasklearning.tree_parser import ParseError
+    matches = defaultdict(list)
+    accepted = []
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    for batch in dataset.iter(batch_size=batch_size):
+        if parser.joint:
+            sources = [joint_example(s) for s in batch['sentence']]
+            references = [joint_example(p) for p in batch['parse']]
+        else:
+            sources = batch['sentence_anon']
+            references = batch['parse_anon']
+        batch_start = time.perf_counter()
+        outputs = parser.generate(sources)
+        latencies.append(time.perf_counter() - batch_start)
+        for reference, (parse, score, complete) in zip(references, outputs):
+            match = parse.strip() == reference.strip()
+            matches[function_name(reference)].append(match)
+            try:
+                parser.check_parse(parse, score, complete)
+                accepted.append(True)
+            except ParseError:
+                accepted.append(False)
+            if not match and len(errors) < show_errors:
+                errors.append((parse, reference))
+    elapsed = time.perf_counter() - start
+    for parse, reference in errors:
+        print(f'pred: {parse}, label: {reference}')
+    all_matches = [m for ms in matches.values() for m in ms]
+    return {
+        'exact_match': float(np.mean(all_matches)),
+        'accepted': float(np.mean(accepted)),
+        'per_function': {fn: {'exact_match': float(np.mean(ms)), 'count': len(ms)} for fn, ms in sorted(matches.items())},
+        'sentences_per_second': len(all_matches) / elapsed,
+        **latency_summary(latencies),
+    }
+
+if __name__ == '__main__':
+    import argparse
+    from social_itl.tasklearning.tree_parser import TextParser
+    parser = argparse.ArgumentParser(description='Evaluate the anonymizer and parser on the dataset-split test set')
+    parser.add_argument('--devices', nargs='+', default=['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu'])
+    parser.add_argument('--batch-size', type=int, default=64, help='Latency percentiles are per batch, use 1 for per-sentence latency')
+    parser.add_argument('--num-samples', type=int, default=None)
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--onnx', action='store_true')
+    parser.add_argument('--joint', action='store_true', help='Evaluate the single pass parse-model-joint, there is no anonymizer to evaluate')
+    parser.add_argument('--show-errors', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    test = get_dataset()['test']
+    if args.num_samples is not None:
+        test = test.select(range(min(args.num_samples, len(test))))
+    results = {}
+    for device in args.devices:
+        print("Evaluating on", device)
+        text_parser = TextParser(device=device, quantize=args.quantize, onnx=args.onnx, joint=args.joint)
+        results[device] = {'parser': evaluate_parser(text_parser, test, args.batch_size, args.show_errors)}
+        if not args.joint:
+            results[device]['anonymizer'] = evaluate_anonymizer(text_parser, test, args.batch_size)
+
+    for device, result in results.items():
+        p = result['parser']
+        if 'anonymizer' in result:
+            a = result['anonymizer']
+            print(f"{device}: anonymizer f1 {a['token_f1']:.3f}, {a['sentences_per_second']:.1f} sentences/s, p95 {a['p95_ms']:.1f}ms")
+        print(f"{device}: parser exact {p['exact_match']:.3f}, accepted {p['accepted']:.3f}, {p['sentences_per_second']:.1f} sentences/s, p95 {p['p95_ms']:.1f}ms")
+        for fn, r in p['per_function'].items():
+            print(f"    {fn:<8} {r['exact_match']:.3f} ({r['count']})")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'batch_size': args.batch_size, 'num_samples': len(test), 'quantize': args.quantize, 'onnx': args.onnx, 'joint': args.joint, 'results': results}, f, indent=2)
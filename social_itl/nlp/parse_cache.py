@@ -0,0 +1,107 @@
+import hashlib
+import json
+import pickle
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional, Tuple
+from social_itl.artifacts import store
+
+MISSING = object()
+# Bumped when the layout of the cached entries changes, older cache files are ignored
+cache_format = 3
+
+def normalize(text: str) -> str:
+    text = re.sub(r'[^\w\s\[\]\']', ' ', text.lower())
+    return ' '.join(text.split())
+
+def models_version(names: Tuple[str, ...] = ('bert-model', 'parse-model', 'gpt-j-6B')) -> str:
+    # Cached parses are only valid for the models that produced them
+    manifest = store.load_manifest()
+    models = {name: manifest.get(name, {}).get('files') for name in names}
+    return hashlib.sha256(json.dumps(models, sort_keys=True).encode()).hexdigest()
+
+class LRUCache:
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key: Hashable, value: Any):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.data
+
+    def __getstate__(self):
+        # Hit counts are per session
+        return {'maxsize': self.maxsize, 'data': self.data}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+        self.data = state['data']
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+class ParseCache:
+    """
+    Level one maps an utterance to its anonymized sentence and phrases, and the normalized anonymized
+    sentence and thresholds version to the parse model output (parse template, score, complete).
+    Level two maps a rephrasing request to the rephrased text.
+    """
+    def __init__(self, path: Optional[Path] = None, maxsize: int = 4096, models: Tuple[str, ...] = ('bert-model', 'parse-model', 'gpt-j-6B')):
+        self.path = path
+        self.version = f'{cache_format}:{models_version(models)}'
+        self.anonymized = LRUCache(maxsize)
+        self.templates = LRUCache(maxsize)
+        self.rephrasings = LRUCache(maxsize)
+        if path is not None and path.exists():
+            self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != self.version:
+            print("Parse cache is from different models or an older format, ignoring it")
+            return
+        self.anonymized = state['anonymized']
+        self.templates = state['templates']
+        self.rephrasings = state['rephrasings']
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump({
+                'version': self.version,
+                'anonymized': self.anonymized,
+                'templates': self.templates,
+                'rephrasings': self.rephrasings,
+            }, f)
+        tmp.replace(self.path)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {'size': len(cache), 'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hit_rate}
+            for name, cache in (('anonymized', self.anonymized), ('templates', self.templates), ('rephrasings', self.rephrasings))
+        }
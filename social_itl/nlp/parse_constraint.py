@@ -0,0 +1,135 @@
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Tokens the parser may always produce, besides the tokens of its input
+keywords = ' if( says([phrase_0]), say([phrase_1], ask([phrase_2]))) resolve() label() tell()'
+
+# Function names allowed at each position of the parse IR:
+#   top    := if( cond, action ) | action | label(text)
+#   cond   := says(text)
+#   action := say(text) | ask(text) | tell(text) | resolve(text)
+function_names = {
+    'top': ('if', 'say', 'ask', 'tell', 'resolve', 'label'),
+    'cond': ('says',),
+    'action': ('say', 'ask', 'tell', 'resolve'),
+}
+closing_states = {'top': ('done',), 'cond': ('sep',), 'action': ('close',)}
+
+State = Tuple
+start_state: State = ('fn', 'top', '')
+
+# Text ends at the first ')' and cannot hold ',' or '(', the joint model's phrases are copied into the IR without them
+phrase_punctuation = re.compile(r'[,()]')
+
+def joint_example(text: str) -> str:
+    """A dataset sentence or parse as the joint model sees it, its quoted phrases unquoted and without the punctuation text cannot hold"""
+    # Live speech has no quotes, so the joint model learns to find the phrases itself
+    return re.sub(r'"([^"]*)"', lambda match: phrase_punctuation.sub('', match.group(1)), text)
+
+def joint_input(sample: str) -> str:
+    # The sentence templates have no commas or parentheses, in live speech they can only be part of a phrase
+    return phrase_punctuation.sub('', sample).replace('"', '')
+
+def step(state: State, c: str) -> Optional[State]:
+    """Advance the IR automaton by one character, None if the character is not allowed"""
+    kind = state[0]
+    if kind == 'fn':
+        _, context, prefix = state
+        if c == ' ' and prefix == '':
+            return state
+        if c == '(':
+            if prefix not in function_names[context]:
+                return None
+            return ('fn', 'cond', '') if prefix == 'if' else ('text', context)
+        prefix += c
+        if any(name.startswith(prefix) for name in function_names[context]):
+            return ('fn', context, prefix)
+        return None
+    elif kind == 'text':
+        if c == ')':
+            return closing_states[state[1]]
+        if c in '(,':
+            return None
+        return state
+    elif c == ' ':
+        return state
+    elif kind == 'sep' and c == ',':
+        return ('fn', 'action', '')
+    elif kind == 'close' and c == ')':
+        return ('done',)
+    return None
+
+def accepts(parse: str) -> bool:
+    """Whether a whole parse string is valid IR"""
+    state = start_state
+    for c in parse:
+        state = step(state, c)
+        if state is None:
+            return False
+    return state == ('done',)
+
+class ParseConstraint:
+    def __init__(self, tokenizer):
+        self.eos_token_id = tokenizer.eos_token_id
+        special = set(tokenizer.all_special_ids)
+        self.keyword_ids = sorted(set(tokenizer.encode(keywords, add_special_tokens=False)) - special)
+        self.special_ids = special
+        self.pieces: Dict[int, str] = {}
+        self.tokenizer = tokenizer
+        self.transitions: Dict[Tuple[State, int], Optional[State]] = {}
+        self.allowed_keywords: Dict[State, List[int]] = {}
+
+    def piece(self, token_id: int) -> str:
+        piece = self.pieces.get(token_id)
+        if piece is None:
+            piece = self.tokenizer.convert_ids_to_tokens(token_id).replace('▁', ' ')
+            self.pieces[token_id] = piece
+        return piece
+
+    def transition(self, state: Optional[State], token_id: int) -> Optional[State]:
+        if state is None or token_id in self.special_ids:
+            return None
+        key = (state, token_id)
+        if key not in self.transitions:
+            next_state = state
+            for c in self.piece(token_id):
+                next_state = step(next_state, c)
+                if next_state is None:
+                    break
+            self.transitions[key] = next_state
+        return self.transitions[key]
+
+    def allowed(self, state: Optional[State], input_ids: Sequence[int]) -> List[int]:
+        # Stop as soon as the outermost call is closed, and end any sequence that has gone wrong
+        if state is None or state == ('done',):
+            return [self.eos_token_id]
+        if state not in self.allowed_keywords:
+            self.allowed_keywords[state] = [t for t in self.keyword_ids if self.transition(state, t) is not None]
+        allowed = set(self.allowed_keywords[state])
+        allowed.update(t for t in input_ids if self.transition(state, t) is not None)
+        return list(allowed) if allowed else [self.eos_token_id]
+
+    def is_complete(self, output_ids: Sequence[int]) -> bool:
+        state = start_state
+        for token_id in output_ids[1:]:
+            if token_id == self.eos_token_id:
+                break
+            state = self.transition(state, token_id)
+        return state == ('done',)
+
+    def prefix_allowed_tokens_fn(self, batch_input_ids: List[List[int]]) -> Callable[[int, 'torch.Tensor'], List[int]]:
+        """Build a prefix_allowed_tokens_fn for model.generate over a batch of encoder inputs"""
+        batch_input_ids = [sorted(set(ids) - self.special_ids) for ids in batch_input_ids]
+        states: Dict[Tuple[int, ...], Optional[State]] = {}
+
+        def state_of(prefix: Tuple[int, ...]) -> Optional[State]:
+            # The first decoder token is the decoder start token
+            if len(prefix) <= 1:
+                return start_state
+            if prefix not in states:
+                states[prefix] = self.transition(state_of(prefix[:-1]), prefix[-1])
+            return states[prefix]
+
+        def allowed_tokens_fn(batch_id, decoder_ids):
+            return self.allowed(state_of(tuple(decoder_ids.tolist())), batch_input_ids[batch_id])
+        return allowed_tokens_fn
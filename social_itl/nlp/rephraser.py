@@ -1,12 +1,16 @@
 from transformers import GPTJForCausalLM, AutoTokenizer
 import torch
+from social_itl.artifacts import store
 
 class Rephraser:
-    def __init__(self):
+    def __init__(self, device='cuda'):
         print("Loading GPT model...")
-        self.model = GPTJForCausalLM.from_pretrained("EleutherAI/gpt-j-6B", torch_dtype=torch.float16).to('cuda')
+        self.device = device
+        # Half precision matmuls are not supported on CPU
+        dtype = torch.float16 if device != 'cpu' else torch.float32
+        self.model = store.from_pretrained(GPTJForCausalLM, "gpt-j-6B", torch_dtype=dtype).to(device)
         print("Done loading GPT model")
-        self.tokenizer = AutoTokenizer.from_pretrained("EleutherAI/gpt-j-6B")
+        self.tokenizer = store.from_pretrained(AutoTokenizer, "gpt-j-6B")
 
     def rephrase_ask(self, phrase):
         prompt = (
@@ -18,7 +22,7 @@ Response: "Would you like anything else with your order?"
 Instruction: {phrase}.
 Response: '''
         )
-        tokenized = self.tokenizer(prompt, return_tensors="pt").to('cuda')
+        tokenized = self.tokenizer(prompt, return_tensors="pt").to(self.device)
         input_ids = tokenized['input_ids']
         attention_mask = tokenized['attention_mask']
         gen_tokens = self.model.generate(
@@ -41,7 +45,7 @@ Response: "You can pick your order up at the counter."
 Instruction: {phrase}.
 Response: '''
         )
-        tokenized = self.tokenizer(prompt, return_tensors="pt").to('cuda')
+        tokenized = self.tokenizer(prompt, return_tensors="pt").to(self.device)
         input_ids = tokenized['input_ids']
         attention_mask = tokenized['attention_mask']
         gen_tokens = self.model.generate(
@@ -2,6 +2,8 @@ import sentence_transformers
 from enum import Enum
 from social_itl.data.dataset import get_dataset
 from social_itl.utils import get_model_path
+from social_itl.artifacts import store
+from social_itl.calibration import decide
 from sklearn.neighbors import KNeighborsClassifier
 from pickle import dump, load
 from tqdm import tqdm
@@ -33,7 +35,7 @@ instruction_pairs = [(0, a) for a in done_answers] + \
                     [(3, i) for i in instructions['train'][:4000]['sentence']]
 
 def train():
-    embedding_model = SimCSE("princeton-nlp/sup-simcse-bert-base-uncased")#sentence_transformers.SentenceTransformer('all-mpnet-base-v2')
+    embedding_model = SimCSE(store.resolve("sup-simcse-bert-base-uncased"))#sentence_transformers.SentenceTransformer('all-mpnet-base-v2')
     ready_model = KNeighborsClassifier(n_neighbors=3, algorithm='brute', weights='distance', metric='cosine')
     instruction_model = KNeighborsClassifier(n_neighbors=5, weights='distance', metric='cosine')
     y, x = zip(*ready_pairs)
@@ -58,7 +60,7 @@ class SentenceType(Enum):
 
 class SentenceClassifier:
     def __init__(self):
-        self.embedding_model = SimCSE("princeton-nlp/sup-simcse-bert-base-uncased")#sentence_transformers.SentenceTransformer('all-mpnet-base-v2')
+        self.embedding_model = SimCSE(store.resolve("sup-simcse-bert-base-uncased"))#sentence_transformers.SentenceTransformer('all-mpnet-base-v2')
         self.ready_model = load(open(get_model_path('ready_model.pkl'), 'rb'))
         self.instruction_model = load(open(get_model_path('instruction_model.pkl'), 'rb'))
     
@@ -68,7 +70,7 @@ class SentenceClassifier:
         embedding = self.embedding_model.encode([sentence])
         y_pred = self.ready_model.predict_proba(embedding)
         score = y_pred.max()
-        if score < 0.65:
+        if not decide('classify_ready', score, sentence):
             return SentenceType.UNKNOWN
         return SentenceType(y_pred.argmax())
 
@@ -80,7 +82,7 @@ class SentenceClassifier:
         score = y_pred.max()
         print("Sentence score:", score)
         print(y_pred)
-        if score < 0.7:
+        if not decide('classify_next', score, sentence):
             return SentenceType.UNKNOWN
         return SentenceType(y_pred.argmax() + 2)
     
@@ -3,14 +3,13 @@ from transformers import AutoTokenizer
 from transformers import DataCollatorForTokenClassification
 from transformers import AutoModelForTokenClassification, TrainingArguments, Trainer
 from transformers.pipelines.token_classification import TokenClassificationPipeline
-from social_itl.data.dataset import get_dataset
+from datasets.fingerprint import Hasher
+from social_itl.data.dataset import get_dataset, get_dataset_path
 from social_itl.utils import get_model_path
+from social_itl.artifacts import store
 
 def label_sentence(sentence: str):
     label = []
-    filtered_ids = []
-    inquote = False
-    beginquote = False
     sentence = sentence.replace('.', '')
     sentence = sentence.replace('?', '')
     sentence = sentence.replace('!', '')
@@ -34,59 +33,6 @@ def label_sentence(sentence: str):
     sentence = sentence.replace('"', '')
     return sentence, label
 
-
-tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-dataset = get_dataset()
-
-def preprocess(sample):
-    sentence = sample['sentence']
-    masked_sentence, label = label_sentence(sentence)
-    tokenized_inputs = tokenizer(masked_sentence.split(' '), truncation=True, is_split_into_words=True)
-
-
-    word_ids = tokenized_inputs.word_ids()  # Map tokens to their respective word.
-    previous_word_idx = None
-    label_ids = []
-    for word_idx in word_ids:  # Set the special tokens to -100.
-        if word_idx is None:
-            label_ids.append(-100)
-        elif word_idx != previous_word_idx:  # Only label the first token of a given word.
-            label_ids.append(label[word_idx])
-        else:
-            label_ids.append(-100)
-        previous_word_idx = word_idx
-
-    tokenized_inputs["labels"] = label_ids
-    tokenized_inputs["masked_sentence"] = masked_sentence
-    return tokenized_inputs
-
-dataset = dataset.map(preprocess)
-
-data_collator = DataCollatorForTokenClassification(tokenizer=tokenizer)
-model = AutoModelForTokenClassification.from_pretrained("bert-base-uncased", num_labels=4)
-training_args = TrainingArguments(
-    output_dir="../data/results",
-    evaluation_strategy="epoch",
-    learning_rate=2e-5,
-    per_device_train_batch_size=128,
-    per_device_eval_batch_size=128,
-    num_train_epochs=4,
-    weight_decay=0.01,
-)
-
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=dataset["train"].remove_columns(["sentence", "masked_sentence"]),
-    eval_dataset=dataset["test"].remove_columns(["sentence", "masked_sentence"]),
-    tokenizer=tokenizer,
-    data_collator=data_collator,
-)
-
-trainer.train()
-model.save_pretrained(get_model_path("bert-model"))
-
-
 class AnonymizationPipeline(TokenClassificationPipeline):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -110,16 +56,92 @@ class AnonymizationPipeline(TokenClassificationPipeline):
             result += "\""
         return result
 
+def preprocess(batch, tokenizer):
+    sentences, labels = zip(*[label_sentence(sentence) for sentence in batch['sentence']])
+    tokenized_inputs = tokenizer([s.split(' ') for s in sentences], truncation=True, is_split_into_words=True)
+    all_label_ids = []
+    for i, label in enumerate(labels):
+        word_ids = tokenized_inputs.word_ids(i)  # Map tokens to their respective word.
+        previous_word_idx = None
+        label_ids = []
+        for word_idx in word_ids:  # Set the special tokens to -100.
+            if word_idx is None:
+                label_ids.append(-100)
+            elif word_idx != previous_word_idx:  # Only label the first token of a given word.
+                label_ids.append(label[word_idx])
+            else:
+                label_ids.append(-100)
+            previous_word_idx = word_idx
+        all_label_ids.append(label_ids)
+    tokenized_inputs["labels"] = all_label_ids
+    return tokenized_inputs
 
-
-pipe = AnonymizationPipeline(model=model, tokenizer=tokenizer, device=0)
-
-print(pipe(["Say hello to the customer",
-"ask for their name",
-"ask them what they would like to order",
-"if they say sandwich then ask them what meat they would like",
-"next ask them whether they want cheese",
-"ask them if they want any other toppings",
-"then tell them to go to the payment counter",
-"Say to the customer welcome to starbucks what can i get you",
-"ask the customer how is your day going"]))
\ No newline at end of file
+def tokenize_dataset(dataset: datasets.DatasetDict, tokenizer, num_proc: int = None) -> datasets.DatasetDict:
+    """Tokenize and align labels, cached by the fingerprint of the data and the preprocessing code so hyperparameter runs reuse it"""
+    cache_dir = get_dataset_path('anonymizer-cache')
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tokenized = {}
+    for name, split in dataset.items():
+        fingerprint = Hasher.hash([split._fingerprint, preprocess, label_sentence, tokenizer])
+        tokenized[name] = split.map(
+            preprocess,
+            batched=True,
+            batch_size=1000,
+            num_proc=num_proc,
+            fn_kwargs={'tokenizer': tokenizer},
+            remove_columns=split.column_names,
+            cache_file_name=str(cache_dir / f'{name}-{fingerprint}.arrow'),
+            new_fingerprint=fingerprint,
+            desc=f'Tokenizing {name}',
+        )
+    return datasets.DatasetDict(tokenized)
+
+def main(args):
+    tokenizer: AutoTokenizer = store.from_pretrained(AutoTokenizer, "bert-base-uncased")
+    dataset = tokenize_dataset(get_dataset(), tokenizer, args.num_proc)
+
+    data_collator = DataCollatorForTokenClassification(tokenizer=tokenizer)
+    model = store.from_pretrained(AutoModelForTokenClassification, "bert-base-uncased", num_labels=4)
+    training_args = TrainingArguments(
+        output_dir="../data/results",
+        evaluation_strategy="epoch",
+        learning_rate=args.learning_rate,
+        per_device_train_batch_size=args.batch_size,
+        per_device_eval_batch_size=args.batch_size,
+        num_train_epochs=args.epochs,
+        weight_decay=0.01,
+    )
+
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=dataset["train"],
+        eval_dataset=dataset["test"],
+        tokenizer=tokenizer,
+        data_collator=data_collator,
+    )
+
+    trainer.train()
+    model.save_pretrained(get_model_path("bert-model"), safe_serialization=True)
+    store.record("bert-model")
+
+    pipe = AnonymizationPipeline(model=model, tokenizer=tokenizer, device=0)
+
+    print(pipe(["Say hello to the customer",
+        "ask for their name",
+        "ask them what they would like to order",
+        "if they say sandwich then ask them what meat they would like",
+        "next ask them whether they want cheese",
+        "ask them if they want any other toppings",
+        "then tell them to go to the payment counter",
+        "Say to the customer welcome to starbucks what can i get you",
+        "ask the customer how is your day going"]))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--learning-rate', type=float, default=2e-5)
+    parser.add_argument('--num-proc', type=int, default=None, help='Processes for tokenization')
+    main(parser.parse_args())
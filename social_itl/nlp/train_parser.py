@@ -1,3 +1,4 @@
+import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import datasets
@@ -5,17 +6,30 @@ import evaluate
 import numpy as np
 import torch
 from torch import nn
-from transformers import (Seq2SeqTrainer, Seq2SeqTrainingArguments,
-                          T5ForConditionalGeneration, T5Tokenizer)
+from transformers import (DataCollatorForSeq2Seq, Seq2SeqTrainer, Seq2SeqTrainingArguments,
+                          T5ForConditionalGeneration, T5Tokenizer, TrainerCallback)
 from social_itl.data.dataset import get_dataset
+from social_itl.nlp.parse_constraint import ParseConstraint, joint_example
 from social_itl.utils import get_model_path
+from social_itl.artifacts import store
 
-dataset = get_dataset().shuffle()
-tokenizer: T5Tokenizer = T5Tokenizer.from_pretrained("t5-base", model_max_length=128)
-model = T5ForConditionalGeneration.from_pretrained("t5-base")
-custom_token_ids = tokenizer.encode('if( says([phrase_0]), say([phrase_1], ask([phrase_2]))) resolve() label()', return_tensors='pt')
+class ParserDataCollator(DataCollatorForSeq2Seq):
+    # allowed_ids has a different length per example, it is passed through as a list instead of padded
+    def __call__(self, features, return_tensors=None):
+        allowed_ids = [f.pop('allowed_ids') for f in features]
+        batch = super().__call__(features, return_tensors)
+        batch['allowed_ids'] = allowed_ids
+        return batch
 
 class ParserTrainer(Seq2SeqTrainer):
+    def __init__(self, constraint: ParseConstraint, **kwargs):
+        super().__init__(**kwargs)
+        self.constraint = constraint
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        inputs.pop('allowed_ids', None)
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -23,83 +37,115 @@ class ParserTrainer(Seq2SeqTrainer):
         prediction_loss_only: bool,
         ignore_keys: Optional[List[str]] = None,
     ) -> Tuple[Optional[float], Optional[torch.Tensor], Optional[torch.Tensor]]:
-        # output_space = torch.concat([custom_token_ids, inputs['input_ids']], dim=1)
-        batch_size = inputs['input_ids'].shape[0]
-        output_space = torch.cat([custom_token_ids.repeat(batch_size, 1), inputs['input_ids']], dim=1)
-        unique = torch.unique(output_space, dim=1, sorted=False)
-        def allowed_tokens_fn(batch_id, input_ids):
-            return unique[batch_id]
-
-        self._gen_kwargs['prefix_allowed_tokens_fn'] = allowed_tokens_fn
+        allowed_ids = inputs.pop('allowed_ids')
+        self._gen_kwargs['prefix_allowed_tokens_fn'] = self.constraint.prefix_allowed_tokens_fn(allowed_ids)
         return super().prediction_step(model, inputs, prediction_loss_only, ignore_keys)
 
-def preprocess(sample):
-    model_inputs = tokenizer(
-        sample['sentence_anon'],
-        padding="max_length",
-        max_length=128,
-        truncation=True,
-        return_tensors="pt",
-    )
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, tokens_per_epoch: int):
+        self.tokens_per_epoch = tokens_per_epoch
+        self.start = None
 
-    labels = tokenizer(
-        sample['parse_anon'], 
-        max_length=128, 
-        padding="max_length", 
-        truncation=True,
-        return_tensors="pt",
-    )
-    label_ids = labels["input_ids"]
-    label_ids[label_ids == tokenizer.pad_token_id] = -100
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.start = time.perf_counter()
 
-    model_inputs["labels"] = label_ids
+    def on_epoch_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self.start
+        print(f"Epoch {state.epoch:.0f}: {elapsed:.1f}s, {self.tokens_per_epoch / elapsed:.0f} tokens/s")
+        state.log_history.append({'epoch': state.epoch, 'epoch_time': elapsed, 'tokens_per_second': self.tokens_per_epoch / elapsed})
+
+def preprocess(batch, tokenizer: T5Tokenizer, special_ids: set, joint: bool = False):
+    if joint:
+        sources = [joint_example(s) for s in batch['sentence']]
+        targets = [joint_example(p) for p in batch['parse']]
+    else:
+        sources = batch['sentence_anon']
+        targets = batch['parse_anon']
+    model_inputs = tokenizer(sources, max_length=128, truncation=True)
+    labels = tokenizer(text_target=targets, max_length=128, truncation=True)
+    model_inputs['labels'] = labels['input_ids']
+    # Tokens the parse may copy from its input, the keywords are added by the constraint
+    model_inputs['allowed_ids'] = [sorted(set(ids) - special_ids) for ids in model_inputs['input_ids']]
     return model_inputs
 
-def prefix(sample):
-    sample['sentence_anon'] = ' ' + sample['sentence_anon']
-    return sample
-
-dataset = dataset.map(preprocess, batched=True, batch_size=128, remove_columns=dataset.column_names['train'])
-train_ds = dataset['train']
-val_ds = dataset['test']
-
-training_args = Seq2SeqTrainingArguments(
-    output_dir="../data/parser-results",
-    evaluation_strategy="epoch",
-    learning_rate=3e-4,
-    per_device_train_batch_size=64,
-    per_device_eval_batch_size=64,
-    num_train_epochs=1,
-    predict_with_generate=True,
-    generation_max_length=30,
-)
-
-metric = evaluate.load("exact_match")
-def exact_match(eval_result):
-    preds, labels = eval_result
-    preds = preds[0]
-    decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-
-def compute_metrics(eval_preds):
-    preds, labels = eval_preds
-    if isinstance(preds, tuple):
-        preds = preds[0]
-    decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-    labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-    decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
-    for pred, label, dpred, dlabel in zip(preds, labels, decoded_preds, decoded_labels):
-        if dlabel != dpred:
+def precision_kwargs(precision: str) -> Dict[str, bool]:
+    if precision == 'auto':
+        # T5 overflows in fp16, so only bf16 is picked automatically
+        precision = 'bf16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'fp32'
+    return {'fp16': precision == 'fp16', 'bf16': precision == 'bf16'}
+
+def main(args):
+    dataset = get_dataset().shuffle(seed=args.seed)
+    tokenizer: T5Tokenizer = store.from_pretrained(T5Tokenizer, "t5-base", model_max_length=128)
+    model = store.from_pretrained(T5ForConditionalGeneration, "t5-base")
+    constraint = ParseConstraint(tokenizer)
+
+    dataset = dataset.map(
+        preprocess,
+        batched=True,
+        batch_size=1000,
+        num_proc=args.num_proc,
+        remove_columns=dataset.column_names['train'],
+        fn_kwargs={'tokenizer': tokenizer, 'special_ids': set(tokenizer.all_special_ids), 'joint': args.joint},
+    )
+    train_ds = dataset['train']
+    val_ds = dataset['test']
+    tokens_per_epoch = sum(len(i) + len(l) for i, l in zip(train_ds['input_ids'], train_ds['labels']))
+
+    training_args = Seq2SeqTrainingArguments(
+        output_dir="../data/parser-joint-results" if args.joint else "../data/parser-results",
+        evaluation_strategy="epoch",
+        learning_rate=3e-4,
+        per_device_train_batch_size=args.batch_size,
+        per_device_eval_batch_size=args.batch_size,
+        num_train_epochs=args.epochs,
+        predict_with_generate=True,
+        generation_max_length=30,
+        group_by_length=True,
+        remove_unused_columns=False,
+        dataloader_num_workers=args.dataloader_workers,
+        **precision_kwargs(args.precision),
+    )
+
+    metric = evaluate.load("exact_match")
+    def compute_metrics(eval_preds):
+        preds, labels = eval_preds
+        if isinstance(preds, tuple):
+            preds = preds[0]
+        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
+        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
+        decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+        mismatches = [(p, l) for p, l in zip(decoded_preds, decoded_labels) if p != l]
+        for dpred, dlabel in mismatches[:args.show_errors]:
             print(f'pred: {dpred}, label: {dlabel}')
-    result = metric.compute(predictions=decoded_preds, references=decoded_labels)
-    return result
-
-trainer = ParserTrainer(
-    model=model,
-    train_dataset=train_ds,
-    eval_dataset=val_ds,
-    args=training_args,
-    compute_metrics=compute_metrics
-)
-trainer.train()
-
-model.save_pretrained(get_model_path('parse-model'))
+        return metric.compute(predictions=decoded_preds, references=decoded_labels)
+
+    trainer = ParserTrainer(
+        constraint=constraint,
+        model=model,
+        train_dataset=train_ds,
+        eval_dataset=val_ds,
+        args=training_args,
+        data_collator=ParserDataCollator(tokenizer, model=model, label_pad_token_id=-100),
+        compute_metrics=compute_metrics,
+        callbacks=[ThroughputCallback(tokens_per_epoch)],
+    )
+    trainer.train()
+
+    name = 'parse-model-joint' if args.joint else 'parse-model'
+    model.save_pretrained(get_model_path(name), safe_serialization=True)
+    store.record(name)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--precision', choices=['auto', 'fp32', 'fp16', 'bf16'], default='auto')
+    parser.add_argument('--num-proc', type=int, default=None)
+    parser.add_argument('--dataloader-workers', type=int, default=0)
+    parser.add_argument('--show-errors', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--joint', action='store_true', help='Train parse-model-joint on the sentences with phrases instead of the anonymized sentences')
+    main(parser.parse_args())
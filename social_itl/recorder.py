@@ -0,0 +1,156 @@
+import atexit
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+from .artifacts import store
+
+# File layout: magic, then the monotonic and wall clock time the file was opened, then frames.
+# A frame is a little-endian u32 length followed by that many bytes of zlib-compressed records,
+# and a record is (f64 monotonic time, u8 direction, u32 length) followed by the raw JSON message.
+MAGIC = b'SITLTRC1'
+file_header = struct.Struct('<dd')
+frame_header = struct.Struct('<I')
+record_header = struct.Struct('<dBI')
+
+INBOUND = 0
+OUTBOUND = 1
+
+class TraceRecord:
+    def __init__(self, time: float, direction: int, message: bytes):
+        self.time = time
+        self.direction = direction
+        self.message = message
+
+    @property
+    def event(self) -> Dict:
+        return json.loads(self.message)
+
+    def __str__(self) -> str:
+        return f"{self.time:.3f} {'<' if self.direction == INBOUND else '>'} {self.message.decode()}"
+
+class EventRecorder:
+    """
+    Appends raw Realtime API messages to compressed trace files from a background thread, so recording
+    costs the event loop one queue put per message. Files are rotated once they exceed max_bytes.
+    """
+    def __init__(self, directory: Optional[Path] = None, name: str = 'furhat', max_bytes: int = 64 << 20,
+                 frame_records: int = 256, flush_interval: float = 1.0):
+        if directory is None:
+            directory = store.log_path() / 'traces'
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.name = f"{name}-{time.strftime('%Y%m%d%H%M%S')}"
+        self.max_bytes = max_bytes
+        self.frame_records = frame_records
+        self.flush_interval = flush_interval
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.file = None
+        self.index = 0
+        self.paths: List[Path] = []
+        self.thread = threading.Thread(target=self.run, name='EventRecorder', daemon=True)
+        self.thread.start()
+        # Flush whatever is still queued when the process exits
+        atexit.register(self.close)
+
+    def record(self, direction: int, message: Union[str, bytes]):
+        self.queue.put((time.monotonic(), direction, message))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def open_next(self):
+        if self.file is not None:
+            self.file.close()
+        path = self.directory / f'{self.name}-{self.index:04d}.trace'
+        self.index += 1
+        self.paths.append(path)
+        self.file = open(path, 'ab')
+        self.file.write(MAGIC + file_header.pack(time.monotonic(), time.time()))
+
+    def write_frame(self, records: List[bytes]):
+        if self.file is None or self.file.tell() >= self.max_bytes:
+            self.open_next()
+        payload = zlib.compress(b''.join(records))
+        self.file.write(frame_header.pack(len(payload)) + payload)
+        self.file.flush()
+
+    def run(self):
+        records = []
+        closing = False
+        while not closing:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                closing = True
+            elif item:
+                t, direction, message = item
+                if isinstance(message, str):
+                    message = message.encode()
+                records.append(record_header.pack(t, direction, len(message)) + message)
+            # Write when the frame is full, the queue has gone quiet, or we are shutting down
+            if records and (closing or len(records) >= self.frame_records or not item):
+                self.write_frame(records)
+                records = []
+        if self.file is not None:
+            self.file.close()
+
+def read_trace(path: Path) -> Iterator[TraceRecord]:
+    """Stream the records of one trace file, stopping quietly at a frame cut short by a crash"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a trace file')
+        f.read(file_header.size)
+        while True:
+            header = f.read(frame_header.size)
+            if len(header) < frame_header.size:
+                return
+            (length,) = frame_header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            data = zlib.decompress(payload)
+            offset = 0
+            while offset < len(data):
+                t, direction, size = record_header.unpack_from(data, offset)
+                offset += record_header.size
+                yield TraceRecord(t, direction, data[offset:offset + size])
+                offset += size
+
+def trace_start(path: Path):
+    """Monotonic and wall clock time at which a trace file was opened"""
+    with open(path, 'rb') as f:
+        f.read(len(MAGIC))
+        return file_header.unpack(f.read(file_header.size))
+
+def trace_files(path: Path) -> List[Path]:
+    path = Path(path)
+    return sorted(path.glob('*.trace')) if path.is_dir() else [path]
+
+def read_traces(path: Path) -> Iterator[TraceRecord]:
+    """Records of a trace file, or of every trace file in a directory in order"""
+    for f in trace_files(path):
+        yield from read_trace(f)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Print a recorded Furhat trace')
+    parser.add_argument('path', type=Path, help='Trace file or directory of trace files')
+    parser.add_argument('--event', default=None, help='Only print events with this event_name')
+    args = parser.parse_args()
+    start = None
+    for record in read_traces(args.path):
+        if start is None:
+            start = record.time
+        if args.event is not None and record.event.get('event_name') != args.event:
+            continue
+        record.time -= start
+        print(record)
@@ -0,0 +1,316 @@
+import atexit
+import json
+import logging
+import pickle
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from .artifacts import store
+
+schema = """
+CREATE TABLE IF NOT EXISTS participants (id TEXT PRIMARY KEY, created REAL);
+CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, participant_id TEXT, kind TEXT, started REAL, ended REAL);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions (participant_id, kind);
+CREATE INDEX IF NOT EXISTS sessions_kind ON sessions (kind, started);
+CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY, session_id TEXT, time REAL, speaker TEXT, text TEXT, label TEXT);
+CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, time);
+CREATE TABLE IF NOT EXISTS parses (id INTEGER PRIMARY KEY, session_id TEXT, time REAL, sentence TEXT, parse TEXT, accepted INTEGER);
+CREATE INDEX IF NOT EXISTS parses_session ON parses (session_id, time);
+CREATE TABLE IF NOT EXISTS trees (id INTEGER PRIMARY KEY, participant_id TEXT, session_id TEXT, version INTEGER, time REAL, ir TEXT);
+CREATE INDEX IF NOT EXISTS trees_participant ON trees (participant_id, time);
+CREATE TABLE IF NOT EXISTS lfd_pairs (participant_id TEXT, idx INTEGER, session_id TEXT, time REAL, state TEXT, action TEXT,
+                                      state_embedding BLOB, action_embedding BLOB, PRIMARY KEY (participant_id, idx));
+CREATE TABLE IF NOT EXISTS scores (id INTEGER PRIMARY KEY, decision TEXT, time REAL, score REAL, accepted INTEGER, text TEXT, thresholds_version INTEGER);
+CREATE INDEX IF NOT EXISTS scores_decision ON scores (decision, time);
+"""
+
+# Log lines that are turns of a conversation, the label is the sentence type or needs_response flag in parentheses
+turn_line = re.compile(r'^(Robot|User|Customer|Employee|Prompt|Response): (.*?)(?: \(([^()]*)\))?$', re.S)
+labelled_speakers = ('Prompt', 'Response')
+
+class SessionStore:
+    """
+    SQLite database of participants, sessions, turns, parses, tree IR versions, LfD pairs and decision scores. Writes go
+    through a queue to one writer thread, so callers on the event loop never wait on the disk, and the
+    database runs in WAL mode so reports can read while a session is being written.
+    """
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path) if path is not None else store.data_path('social_itl.sqlite')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(schema)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='SessionStore', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA synchronous=NORMAL')
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            # Commit everything that queued up while the last batch was written in one transaction
+            items = [item]
+            closing = False
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                items.append(item)
+            flushed = [i for i in items if isinstance(i, threading.Event)]
+            writes = [i for i in items if not isinstance(i, threading.Event)]
+            try:
+                with db:
+                    for sql, params in writes:
+                        db.execute(sql, params)
+            except Exception:
+                # Retry one write at a time so only the bad ones are lost. The writer has to survive them,
+                # otherwise every later flush() waits forever
+                for sql, params in writes:
+                    try:
+                        with db:
+                            db.execute(sql, params)
+                    except Exception as e:
+                        print(f"Session store write failed: {e!r} in {' '.join(sql.split())[:80]}")
+            finally:
+                for event in flushed:
+                    event.set()
+            if closing:
+                break
+        db.close()
+
+    def write(self, sql: str, params: Tuple = ()):
+        self.queue.put((sql, params))
+
+    def flush(self):
+        """Wait until everything written so far is in the database"""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def start_session(self, participant_id, kind: str) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        self.write('INSERT OR IGNORE INTO participants VALUES (?, ?)', (str(participant_id), now))
+        self.write('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', (session_id, str(participant_id), kind, now, now))
+        return session_id
+
+    def add_turn(self, session_id: str, speaker: str, text: str, label: str = None, when: float = None):
+        when = time.time() if when is None else when
+        self.write('INSERT INTO turns (session_id, time, speaker, text, label) VALUES (?, ?, ?, ?, ?)', (session_id, when, speaker, text, label))
+        self.write('UPDATE sessions SET ended = max(ended, ?) WHERE id = ?', (when, session_id))
+
+    def add_parse(self, session_id: str, sentence: str, parse: Optional[str]):
+        self.write('INSERT INTO parses (session_id, time, sentence, parse, accepted) VALUES (?, ?, ?, ?, ?)',
+                   (session_id, time.time(), sentence, parse, parse is not None))
+
+    def add_tree(self, participant_id, session_id: Optional[str], version: int, ir: Dict):
+        self.write('INSERT INTO trees (participant_id, session_id, version, time, ir) VALUES (?, ?, ?, ?, ?)',
+                   (str(participant_id), session_id, version, time.time(), json.dumps(ir)))
+
+    def add_lfd_pair(self, participant_id, idx: int, state: str, action: str, session_id: str = None):
+        self.write('INSERT OR REPLACE INTO lfd_pairs (participant_id, idx, session_id, time, state, action) VALUES (?, ?, ?, ?, ?, ?)',
+                   (str(participant_id), idx, session_id, time.time(), state, action))
+
+    def set_lfd_embeddings(self, participant_id, start: int, states: np.ndarray, actions: np.ndarray):
+        for i, (state, action) in enumerate(zip(states, actions)):
+            self.write('UPDATE lfd_pairs SET state_embedding = ?, action_embedding = ? WHERE participant_id = ? AND idx = ?',
+                       (state.astype(np.float32).tobytes(), action.astype(np.float32).tobytes(), str(participant_id), start + i))
+
+    def add_score(self, decision: str, score: float, accepted: bool, text: str = None, thresholds_version: int = None):
+        self.write('INSERT INTO scores (decision, time, score, accepted, text, thresholds_version) VALUES (?, ?, ?, ?, ?, ?)',
+                   (decision, time.time(), score, accepted, text, thresholds_version))
+
+    def query(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        # Readers get their own connection, WAL lets them run alongside the writer
+        with closing(sqlite3.connect(self.path)) as db:
+            db.row_factory = sqlite3.Row
+            return db.execute(sql, params).fetchall()
+
+    def sessions(self, kind: str = None, participant_id=None) -> List[sqlite3.Row]:
+        sql, params = 'SELECT * FROM sessions WHERE 1', []
+        if kind is not None:
+            sql += ' AND kind = ?'
+            params.append(kind)
+        if participant_id is not None:
+            sql += ' AND participant_id = ?'
+            params.append(str(participant_id))
+        return self.query(sql + ' ORDER BY started', tuple(params))
+
+    def turns(self, kind: str = None, participant_id=None) -> Dict[str, List[sqlite3.Row]]:
+        """Turns of the matching sessions by participant, in order"""
+        sql = 'SELECT s.participant_id, t.* FROM turns t JOIN sessions s ON s.id = t.session_id WHERE 1'
+        params = []
+        if kind is not None:
+            sql += ' AND s.kind = ?'
+            params.append(kind)
+        if participant_id is not None:
+            sql += ' AND s.participant_id = ?'
+            params.append(str(participant_id))
+        turns = {}
+        for row in self.query(sql + ' ORDER BY s.started, t.time, t.id', tuple(params)):
+            turns.setdefault(row['participant_id'], []).append(row)
+        return turns
+
+    def latest_tree(self, participant_id) -> Optional[Dict]:
+        rows = self.query('SELECT ir FROM trees WHERE participant_id = ? ORDER BY time DESC LIMIT 1', (str(participant_id),))
+        return json.loads(rows[0]['ir']) if rows else None
+
+    def lfd_pairs(self, participant_id, embeddings: bool = False):
+        """
+        Pairs of a participant in order. With embeddings, also their state and action embeddings, which are None
+        unless every pair has been embedded, so they always line up with the pairs
+        """
+        rows = self.query('SELECT * FROM lfd_pairs WHERE participant_id = ? ORDER BY idx', (str(participant_id),))
+        pairs = [(row['state'], row['action']) for row in rows]
+        if not embeddings:
+            return pairs
+        if not rows or any(row['state_embedding'] is None or row['action_embedding'] is None for row in rows):
+            return pairs, None, None
+        states = np.stack([np.frombuffer(row['state_embedding'], dtype=np.float32) for row in rows])
+        actions = np.stack([np.frombuffer(row['action_embedding'], dtype=np.float32) for row in rows])
+        return pairs, states, actions
+
+class SessionHandler(logging.Handler):
+    """Copies the turns written to a session logger into the store"""
+    def __init__(self, session_store: SessionStore, session_id: str):
+        super().__init__(logging.DEBUG)
+        self.session_store = session_store
+        self.session_id = session_id
+
+    def emit(self, record: logging.LogRecord):
+        turn = parse_turn(record.getMessage())
+        if turn is not None:
+            self.session_store.add_turn(self.session_id, *turn, when=record.created)
+
+_session_store = None
+
+def get_session_store() -> SessionStore:
+    global _session_store
+    if _session_store is None:
+        _session_store = SessionStore()
+    return _session_store
+
+# Text logs are named <name>-<participant>-<timestamp>.txt, or <name>_<participant>-<timestamp>.txt for LfD
+log_name = re.compile(r'^[A-Za-z]+[-_](-?\d+)-(\d{14})\.txt$')
+log_line = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - (.*)$')
+
+def read_log(path: Path) -> List[Tuple[float, str]]:
+    """(time, message) of every record of a text log, lines without a timestamp continue the previous message"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            match = log_line.match(line)
+            if match is None:
+                if records:
+                    records[-1] = (records[-1][0], records[-1][1] + line)
+                continue
+            when, millis, message = match.groups()
+            records.append((time.mktime(time.strptime(when, '%Y-%m-%d %H:%M:%S')) + int(millis) / 1000, message + '\n'))
+    return [(when, message.rstrip('\n')) for when, message in records]
+
+def read_pairs(path: Path) -> List[Tuple[str, str]]:
+    """(state, action) pairs of an LfD file, a pickled list followed by one pickled pair for every pair added since"""
+    pairs = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except pickle.UnpicklingError:
+                # A pair that was being appended when the process died
+                break
+            if isinstance(record, list):
+                pairs.extend(record)
+            else:
+                pairs.append(tuple(record))
+    return pairs
+
+def parse_turn(message: str) -> Optional[Tuple[str, str, Optional[str]]]:
+    """(speaker, text, label) of a log message that is a turn"""
+    match = turn_line.match(message)
+    if match is None:
+        return None
+    speaker, text, label = match.groups()
+    if label is not None and speaker not in labelled_speakers:
+        text, label = f'{text} ({label})', None
+    return speaker.lower(), text.strip(), label
+
+def import_logs(session_store: SessionStore, log_dir: Path) -> int:
+    """Import the text logs of every folder under log_dir as sessions of that kind, returns the number of sessions"""
+    imported = 0
+    for path in sorted(Path(log_dir).glob('*/*.txt')):
+        match = log_name.match(path.name)
+        if match is None:
+            continue
+        kind = path.parent.name
+        participant_id, stamp = match.groups()
+        started = time.mktime(time.strptime(stamp, '%Y%m%d%H%M%S'))
+        if session_store.query('SELECT 1 FROM sessions WHERE participant_id = ? AND kind = ? AND started = ?', (participant_id, kind, started)):
+            continue
+        session_id = uuid.uuid4().hex
+        session_store.write('INSERT OR IGNORE INTO participants VALUES (?, ?)', (participant_id, started))
+        session_store.write('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', (session_id, participant_id, kind, started, started))
+        for when, message in read_log(path):
+            turn = parse_turn(message)
+            if turn is not None:
+                session_store.add_turn(session_id, *turn, when=when)
+        imported += 1
+    session_store.flush()
+    return imported
+
+def import_lfd(session_store: SessionStore, lfd_dir: Path) -> int:
+    """Import the pairs and checkpointed embeddings of every p_<participant>.pkl, returns the number of pairs"""
+    imported = 0
+    for path in sorted(Path(lfd_dir).glob('p_*.pkl')):
+        participant_id = path.stem[2:]
+        pairs = read_pairs(path)
+        session_store.write('INSERT OR IGNORE INTO participants VALUES (?, ?)', (participant_id, path.stat().st_mtime))
+        for idx, (state, action) in enumerate(pairs):
+            session_store.add_lfd_pair(participant_id, idx, state, action)
+        if path.with_suffix('.npz').exists():
+            checkpoint = np.load(path.with_suffix('.npz'))
+            size = min(len(checkpoint['states']), len(pairs))
+            session_store.set_lfd_embeddings(participant_id, 0, checkpoint['states'][:size], checkpoint['actions'][:size])
+        imported += len(pairs)
+    session_store.flush()
+    return imported
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Import existing session artifacts into the session store and summarise it')
+    parser.add_argument('command', choices=['import', 'summary'])
+    parser.add_argument('--db', type=Path, default=None)
+    args = parser.parse_args()
+    session_store = SessionStore(args.db)
+    if args.command == 'import':
+        print("Imported", import_logs(session_store, store.log_path()), "sessions")
+        print("Imported", import_lfd(session_store, store.data_path('lfd')), "LfD pairs")
+    for row in session_store.query('SELECT kind, count(DISTINCT participant_id) AS participants, count(*) AS sessions FROM sessions GROUP BY kind ORDER BY kind'):
+        print(f"{row['kind']:<16} {row['participants']:>4} participants {row['sessions']:>5} sessions")
+    for table in ('turns', 'parses', 'trees', 'lfd_pairs'):
+        print(f"{table:<16} {session_store.query(f'SELECT count(*) AS n FROM {table}')[0]['n']:>5}")
+    session_store.close()
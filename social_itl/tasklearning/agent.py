@@ -1,9 +1,11 @@
 import asyncio
 from social_itl.furhat import Furhat
 from social_itl.tasklearning.tasklearner import TaskLearner, Prompt, Response
+from social_itl.tasklearning.replay import LearningCheckpoint, fast_forward
 from social_itl.nlp.sentence_classifier import SentenceClassifier, SentenceType
 from social_itl.utils import get_logger, get_data_path
-from social_itl.tasklearning.behaviours import AskBehavior, SayBehavior
+from social_itl.tasklearning.behaviours import AskBehavior, SayBehavior, tree_to_ir
+from social_itl.session_store import get_session_store
 from py_trees.trees import BehaviourTree
 from py_trees.blackboard import Client
 from py_trees.common import Status, Access
@@ -12,8 +14,8 @@ from social_itl.tasklearning.behaviours import FurhatBlackboard
 import py_trees
 
 class DialogAgent:
-    def __init__(self):
-        self.task_tree = TaskLearner()
+    def __init__(self, parser_kwargs: dict = None):
+        self.task_tree = TaskLearner(parser_kwargs=parser_kwargs)
         self.sentence_classifier = SentenceClassifier()
         # self.model_gen = asyncio.get_event_loop().run_in_executor(None, get_model)
 
@@ -57,7 +59,17 @@ Are you ready to begin?"""
         await self.say("Okay, let's begin!")
 
     async def learn(self, participant_id=0):
-        logger = get_logger(f"Participant-{participant_id}", "learning_dialog", True)
+        session_store = get_session_store()
+        session_id = session_store.start_session(participant_id, "learning_dialog")
+        logger = get_logger(f"Participant-{participant_id}", "learning_dialog", True, session_id)
+        self.task_tree.parser.parse_listener = lambda sentence, parse: session_store.add_parse(session_id, sentence, parse)
+        tree_version = None
+        def save_tree_version():
+            nonlocal tree_version
+            root = self.task_tree.root
+            if getattr(root, 'version', 0) != tree_version:
+                tree_version = getattr(root, 'version', 0)
+                session_store.add_tree(participant_id, session_id, tree_version, tree_to_ir(root))
         model_path = get_data_path(f"itl-models/participant-{participant_id}.pkl")
         # if model_path.exists():
         #     self.task_tree.tree = load(open(model_path, 'rb'))
@@ -65,11 +77,19 @@ Are you ready to begin?"""
         # else:
         #     self.task_tree.reset()
         self.task_tree.reset()
+        checkpoint = LearningCheckpoint(participant_id)
         try:
-            await self.introduce()
             gen = self.task_tree.generate_prompts()
-            prompt = next(gen)
             try:
+                responses = checkpoint.load()
+                if responses:
+                    # An earlier session for this participant was interrupted, rebuild its state and carry on
+                    logger.info(f"Resuming from {len(responses)} checkpointed responses")
+                    prompt = fast_forward(gen, responses)
+                    await self.say("Sorry about that, let's continue where we left off.")
+                else:
+                    await self.introduce()
+                    prompt = next(gen)
                 while True:
                     if prompt.needs_response:
                         await self.say(prompt.text)
@@ -95,14 +115,19 @@ Are you ready to begin?"""
                             response = Response(user_text, sentence_type)
                             logger.info(str(response))
                         prompt = gen.send(response)
+                        checkpoint.append(response)
+                        save_tree_version()
                         logger.info(str(prompt))
                     else:
                         await self.say(prompt.text)
                         prompt = next(gen)
                         logger.info(str(prompt))
             except StopIteration:
+                checkpoint.clear()
                 await self.say("Okay, I think I've learned everything I need to know. Thank you for your help!")
         except asyncio.exceptions.CancelledError as e:
+            # The operator stopped learning, only a DisconnectError leaves the checkpoint to resume from
+            checkpoint.clear()
             print("Dialog cancelled")
 
         # try:
@@ -122,6 +147,10 @@ Are you ready to begin?"""
         #     return
         model_path = get_data_path(f"itl-models/participant-{participant_id}.pkl")
         dump(self.task_tree.tree, open(model_path, 'wb'))
+        save_tree_version()
+        self.task_tree.parser.parse_listener = None
+        self.task_tree.parser.cache.save()
+        logger.info(f"Parse cache: {self.task_tree.parser.cache.stats()}")
 
     async def execute(self, participant_id=0, skip_intro=False):
         print("Loading pkl...")
@@ -175,9 +204,9 @@ Are you ready to begin?"""
 
 
 class FurhatAgent(Furhat, DialogAgent):
-    def __init__(self, host='localhost', port=80):
-        Furhat.__init__(self, host, port)
-        DialogAgent.__init__(self)
+    def __init__(self, host='localhost', port=80, parser_kwargs: dict = None, record=None):
+        Furhat.__init__(self, host, port, record)
+        DialogAgent.__init__(self, parser_kwargs)
 
 class VirtualAgent(DialogAgent):
     async def say(self, phrase: str):
@@ -4,12 +4,15 @@ from py_trees.blackboard import Client
 from py_trees.common import Status, Access
 from py_trees.decorators import FailureIsSuccess, Decorator
 from lemminflect import getInflection
+from copy import deepcopy
 from tqdm import tqdm
 from functools import partialmethod
 tqdm.__init__ = partialmethod(tqdm.__init__, disable=True)
 from simcse import SimCSE
+from social_itl.artifacts import store
+from social_itl.calibration import decide
 from scipy.spatial.distance import cosine
-similarity_model = SimCSE("princeton-nlp/sup-simcse-bert-base-uncased")
+similarity_model = SimCSE(store.resolve("sup-simcse-bert-base-uncased"))
 
 import asyncio
 
@@ -30,6 +33,56 @@ class LearnableBehaviour(Describable):
         super().__init__(*args, **kwargs)
         self.learned = False
 
+    @property
+    def learned(self):
+        # Trees pickled before learned became a property stored it under its own name
+        return self.__dict__.get('_learned', self.__dict__.get('learned', False))
+
+    @learned.setter
+    def learned(self, value):
+        self._learned = value
+        self.touch()
+
+    def touch(self):
+        # Bump the structure version of this node and everything above it, then tell the root's listener
+        node = self
+        while True:
+            node.version = getattr(node, 'version', 0) + 1
+            if node.parent is None:
+                break
+            node = node.parent
+        listener = getattr(node, 'listener', None)
+        if listener is not None:
+            listener(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('listener', None)
+        return state
+
+    def add_child(self, child):
+        result = super().add_child(child)
+        self.touch()
+        return result
+
+    def insert_child(self, child, index):
+        result = super().insert_child(child, index)
+        self.touch()
+        return result
+
+    def remove_child(self, child):
+        result = super().remove_child(child)
+        self.touch()
+        return result
+
+    def remove_all_children(self):
+        super().remove_all_children()
+        self.touch()
+
+    def replace_child(self, child, replacement):
+        super().replace_child(child, replacement)
+        self.touch()
+
 class Approach(Describable, Behaviour):
     def __init__(self, *args, **kwargs):
         super().__init__(name="Approach", description='a person approaches me', *args, **kwargs)
@@ -89,6 +142,63 @@ class Conditional(LearnableBehaviour, Selector):
     def description(self, value):
         pass
 
+class BehaviourReference(Behaviour):
+    """
+    Stands in for a learned behaviour that is reused elsewhere in the tree. The definition is shared,
+    a private copy is only made when the reference runs, and is remade if the definition was edited.
+    """
+    def __init__(self, definition: CustomBehavior, **kwargs):
+        super().__init__(name=definition.name, **kwargs)
+        self.definition = definition
+        self.instance = None
+        self.instance_version = None
+
+    @property
+    def description(self):
+        return self.definition.description
+
+    @property
+    def gerund(self):
+        return self.definition.gerund
+
+    def instantiate(self):
+        version = getattr(self.definition, 'version', 0)
+        if self.instance is None or self.instance_version != version:
+            parent = self.definition.parent
+            # Copy only the definition, not the tree it sits in
+            self.definition.parent = None
+            try:
+                self.instance = deepcopy(self.definition)
+            finally:
+                self.definition.parent = parent
+            self.instance.setup_with_descendants()
+            self.instance_version = version
+        return self.instance
+
+    def initialise(self):
+        self.instantiate()
+
+    def update(self):
+        self.instance.tick_once()
+        return self.instance.status
+
+    def terminate(self, new_status):
+        if new_status == Status.INVALID and self.instance is not None:
+            self.instance.stop(Status.INVALID)
+
+    def __deepcopy__(self, memo):
+        # Copies of a tree keep pointing at the same definition
+        reference = BehaviourReference(self.definition)
+        memo[id(self)] = reference
+        reference.parent = deepcopy(self.parent, memo)
+        return reference
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['instance'] = None
+        state['instance_version'] = None
+        return state
+
 class AskBehavior(Describable, Behaviour):
     def __init__(self, text, **kwargs):
         super().__init__(name='Ask', description=f'I ask, {text}', **kwargs)
@@ -150,16 +260,30 @@ class PersonSays(Describable, Behaviour):
         self.running = False
 
     def update(self):
-        print(self.blackboard)
         if self.running and self.blackboard.furhat.done_listening.is_set():
             self.running = False
             difference = cosine(*similarity_model.encode([self.text, self.blackboard.furhat.user_speech]))
             print(self.text, self.blackboard.furhat.user_speech, difference)
-            if difference < 0.4:
+            if decide('person_says', difference, self.blackboard.furhat.user_speech):
                 return Status.SUCCESS
             else:
                 return Status.FAILURE
         elif not self.running:
             # self.blackboard.furhat.done_listening.clear()
             self.running = True
-        return Status.RUNNING
\ No newline at end of file
+        return Status.RUNNING
+
+def tree_to_ir(behaviour: Behaviour) -> dict:
+    """JSON-serializable description of a behaviour and everything below it, references only name their definition"""
+    ir = {'type': type(behaviour).__name__, 'name': behaviour.name}
+    if isinstance(behaviour, BehaviourReference):
+        ir['definition'] = behaviour.definition.name
+        return ir
+    for key in ('text', 'description', 'gerund'):
+        value = getattr(behaviour, key, None)
+        if isinstance(value, str):
+            ir[key] = value
+    if isinstance(behaviour, LearnableBehaviour):
+        ir['learned'] = behaviour.learned
+    ir['children'] = [tree_to_ir(child) for child in behaviour.children]
+    return ir
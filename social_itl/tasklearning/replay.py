@@ -0,0 +1,161 @@
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from pickle import dump
+from typing import Dict, Generator, List, Optional
+from social_itl.artifacts import store
+from social_itl.nlp.sentence_classifier import SentenceType
+from social_itl.tasklearning.tasklearner import TaskLearner, Prompt, Response
+from social_itl.utils import get_data_path
+
+# Lines written by DialogAgent.learn through the learning_dialog logger
+response_line = re.compile(r' - Response: (.*) \(SentenceType\.(\w+)\)$')
+transcript_name = re.compile(r'Participant-(\w+)-(\d{14})\.txt$')
+
+def read_transcript(path: Path) -> List[Response]:
+    """
+    Read the responses of a teaching session, either from a learning_dialog log or from a JSONL
+    file with one {"text": ..., "sentence_type": ...} object per line.
+    """
+    responses = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if path.suffix == '.jsonl':
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                responses.append(Response(record['text'], SentenceType[record['sentence_type']]))
+            else:
+                match = response_line.search(line)
+                if match:
+                    responses.append(Response(match.group(1), SentenceType[match.group(2)]))
+    # The agent keeps asking until the answer is understood, these never reach the task learner
+    return [r for r in responses if r.sentence_type not in (SentenceType.UNCERTAIN, SentenceType.UNKNOWN)]
+
+def find_transcripts(log_dir: Optional[Path] = None) -> Dict[str, Path]:
+    """Latest learning_dialog log of each participant"""
+    if log_dir is None:
+        log_dir = store.log_path() / 'learning_dialog'
+    transcripts = {}
+    for path in sorted(log_dir.iterdir()):
+        match = transcript_name.search(path.name)
+        if match:
+            # Names end in a sortable timestamp, later sessions replace earlier ones
+            transcripts[match.group(1)] = path
+        elif path.suffix == '.jsonl':
+            transcripts[path.stem] = path
+    return transcripts
+
+def fast_forward(gen: Generator[Prompt, Response, None], responses: List[Response]) -> Prompt:
+    """
+    Feed recorded responses into a fresh prompt generator and return the first prompt that still needs
+    an answer. Raises StopIteration if learning finishes on the way.
+    """
+    prompt = next(gen)
+    for response in responses:
+        while not prompt.needs_response:
+            prompt = next(gen)
+        prompt = gen.send(response)
+    while not prompt.needs_response:
+        prompt = next(gen)
+    return prompt
+
+def replay(learner: TaskLearner, responses: List[Response]) -> bool:
+    """Drive the task learner with recorded responses, True if it finished learning"""
+    learner.reset()
+    learner.parser.learned = {}
+    try:
+        fast_forward(learner.generate_prompts(), responses)
+    except StopIteration:
+        return True
+    print("Transcript ended before learning finished")
+    return False
+
+class LearningCheckpoint:
+    """
+    Responses of an unfinished teaching session, appended as a JSONL transcript as they are given.
+    Replaying them rebuilds the tree and the position of the prompt generator.
+    """
+    def __init__(self, participant_id):
+        self.path = get_data_path('itl-checkpoints') / f'participant-{participant_id}.jsonl'
+
+    def load(self) -> List[Response]:
+        if not self.path.exists():
+            return []
+        return read_transcript(self.path)
+
+    def append(self, response: Response):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'text': response.text, 'sentence_type': response.sentence_type.name}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+_learner: Optional[TaskLearner] = None
+
+def _init_worker(parser_kwargs: dict):
+    global _learner
+    _learner = TaskLearner(parser_kwargs={'lazy_rephraser': True, **parser_kwargs})
+
+def _rebuild(participant_id: str, transcript: Path, output_dir: Path):
+    cache = _learner.parser.cache
+    known = set(cache.rephrasings.data)
+    complete = replay(_learner, read_transcript(transcript))
+    path = output_dir / f'participant-{participant_id}.pkl'
+    with open(path, 'wb') as f:
+        dump(_learner.tree, f)
+    # Hand new rephrasings back so the parent can store them in the shared cache
+    rephrasings = {key: value for key, value in cache.rephrasings.data.items() if key not in known}
+    return participant_id, path, complete, rephrasings
+
+def rebuild_all(transcripts: Dict[str, Path], parser_kwargs: dict = None, workers: int = 4, output_dir: Optional[Path] = None):
+    parser_kwargs = parser_kwargs or {}
+    if output_dir is None:
+        output_dir = get_data_path('itl-models')
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Parse everything up front in batches, the workers then find the parses in the saved cache
+    learner = TaskLearner(parser_kwargs={'lazy_rephraser': True, **parser_kwargs})
+    texts = [r.text for path in transcripts.values() for r in read_transcript(path) if r.sentence_type == SentenceType.INSTRUCTION]
+    print(f"Parsing {len(texts)} instructions from {len(transcripts)} transcripts")
+    learner.parser.parse_batch(texts)
+    learner.parser.cache.save()
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(parser_kwargs,)) as executor:
+        futures = [executor.submit(_rebuild, pid, path, output_dir) for pid, path in transcripts.items()]
+        for future in as_completed(futures):
+            participant_id, path, complete, rephrasings = future.result()
+            for key, value in rephrasings.items():
+                learner.parser.cache.rephrasings.put(key, value)
+            results[participant_id] = complete
+            print(f"Participant {participant_id}: {'complete' if complete else 'incomplete'}, wrote {path}")
+    learner.parser.cache.save()
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Rebuild ITL models from recorded teaching sessions')
+    parser.add_argument('transcripts', nargs='*', type=Path, help='Transcripts to replay, defaults to the latest learning_dialog log of every participant')
+    parser.add_argument('--log-dir', type=Path, default=None)
+    parser.add_argument('--output-dir', type=Path, default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--quantize', action='store_true')
+    args = parser.parse_args()
+
+    if args.transcripts:
+        transcripts = {}
+        for path in args.transcripts:
+            match = transcript_name.search(path.name)
+            transcripts[match.group(1) if match else path.stem] = path
+    else:
+        transcripts = find_transcripts(args.log_dir)
+    results = rebuild_all(transcripts, {'device': args.device, 'quantize': args.quantize}, args.workers, args.output_dir)
+    print(f"{sum(results.values())}/{len(results)} participants finished learning")
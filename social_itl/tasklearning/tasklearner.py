@@ -28,25 +28,60 @@ class Response:
     def __repr__(self) -> str:
         return self.__str__()
 
+class UnlearnedIndex:
+    """
+    Path from the root to the deepest unlearned behaviour. Learnable nodes report every change to
+    the root's listener, and only the part of the path below the closest changed node is rescanned.
+    """
+    def __init__(self, root: Behaviour):
+        self.path = [root]
+        self.changed = []
+        root.listener = self.changed.append
+
+    def find(self) -> Behaviour:
+        path = self.path
+        if self.changed:
+            positions = {id(node): i for i, node in enumerate(path)}
+            keep = len(path) - 1
+            for node in self.changed:
+                while node is not None and id(node) not in positions:
+                    node = node.parent
+                keep = min(keep, 0 if node is None else positions[id(node)])
+            del path[keep + 1:]
+            self.changed.clear()
+            # The node that changed may have been learned or moved
+            while len(path) > 1 and (path[-1].learned or path[-1].parent is not path[-2]):
+                path.pop()
+        while True:
+            for child in path[-1].children:
+                if isinstance(child, LearnableBehaviour) and not child.learned:
+                    path.append(child)
+                    break
+            else:
+                # No children are unlearned, so return the parent
+                return path[-1]
+
 class TaskLearner:
-    def __init__(self, root : Behaviour = None):
+    def __init__(self, root : Behaviour = None, parser_kwargs: dict = None, debug: bool = False):
         if root is None:
             self.root = CustomBehavior(name="Root")
         else:
             self.root = root
         self.tree = BehaviourTree(root=self.root)
         self.root.add_child(Approach())
-        self.parser = TreeParser()
+        self.index = UnlearnedIndex(self.root)
+        self.parser = TreeParser(**(parser_kwargs or {}))
+        self.debug = debug
 
     def reset(self):
         self.root = CustomBehavior(name="Root")
         self.tree = BehaviourTree(root=self.root)
         self.root.add_child(Approach())
+        self.index = UnlearnedIndex(self.root)
     
     def find_unlearned_behaviour(self, parent : Behaviour = None):
         if parent is None:
-            parent = self.root
-        # print(parent.name)
+            return self.index.find()
         for child in parent.children:
             if isinstance(child, LearnableBehaviour) and not child.learned:
                 return self.find_unlearned_behaviour(child)
@@ -55,7 +90,8 @@ class TaskLearner:
 
     def generate_prompts(self):
         while True:
-            print(ascii_tree(self.tree.root))
+            if self.debug:
+                print(ascii_tree(self.tree.root))
             if self.root.learned:
                 # Done learning, stop generating prompts
                 return
@@ -2,12 +2,17 @@ from py_trees.behaviour import Behaviour
 from py_trees.trees import BehaviourTree
 from transformers import AutoTokenizer, AutoModelForTokenClassification, T5ForConditionalGeneration, T5Tokenizer
 from transformers.pipelines.token_classification import TokenClassificationPipeline
-from social_itl.tasklearning.behaviours import CustomBehavior, Conditional, AskBehavior, SayBehavior, PersonSays
+from social_itl.tasklearning.behaviours import CustomBehavior, Conditional, AskBehavior, SayBehavior, PersonSays, BehaviourReference
 from social_itl.nlp.rephraser import Rephraser
-from social_itl.utils import get_model_path
-from copy import deepcopy
+from social_itl.artifacts import store
+from social_itl.nlp.cpu_inference import load_models, load_parser
+from social_itl.nlp.parse_constraint import ParseConstraint, joint_input
+from social_itl.nlp.parse_cache import ParseCache, MISSING, normalize
+from social_itl.utils import get_data_path
+from social_itl.calibration import get_thresholds, log_score
 import re
 import torch
+from typing import List, Optional, Tuple
 
 class ParseError(Exception):
     pass
@@ -44,53 +49,172 @@ class AnonymizationPipeline(TokenClassificationPipeline):
         return result, substitutions
 
 class TextParser:
-    def __init__(self):
-        bert_tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-        bert_model = AutoModelForTokenClassification.from_pretrained(get_model_path("bert-model"))
-        self.pipe = AnonymizationPipeline(model=bert_model, tokenizer=bert_tokenizer, device=0)
-        self.tokenizer: T5Tokenizer = T5Tokenizer.from_pretrained("t5-base", model_max_length=128)
-        self.model = T5ForConditionalGeneration.from_pretrained(get_model_path("parse-model")).to('cuda')
-        self.custom_token_ids = self.tokenizer.encode('if( says([phrase_0]), say([phrase_1], ask([phrase_2]))) resolve() label()', return_tensors='pt')
-        self.rephraser = Rephraser()
+    """
+    Parses an instruction into the IR. By default BERT first replaces the quoted phrases with placeholders
+    and T5 parses the anonymized sentence. In joint mode a single T5 parses the sentence directly,
+    copying the phrases into the IR itself.
+    """
+    def __init__(self, device: str = None, quantize: bool = False, onnx: bool = False, cache_size: int = 4096,
+                 anonymizer_model: str = 'bert-model', parser_model: Optional[str] = None, joint: bool = False):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.joint = joint
+        if parser_model is None:
+            parser_model = 'parse-model-joint' if joint else 'parse-model'
+        if joint:
+            self.pipe = None
+            self.model = load_parser(device, quantized=quantize, onnx=onnx, parser_model=parser_model)
+            models = (parser_model,)
+        else:
+            bert_tokenizer: AutoTokenizer = store.from_pretrained(AutoTokenizer, "bert-base-uncased")
+            bert_model, self.model = load_models(device, quantized=quantize, onnx=onnx, anonymizer_model=anonymizer_model, parser_model=parser_model)
+            self.pipe = AnonymizationPipeline(model=bert_model, tokenizer=bert_tokenizer, device=device, framework="pt")
+            models = (anonymizer_model, parser_model)
+        self.tokenizer: T5Tokenizer = store.from_pretrained(T5Tokenizer, "t5-base", model_max_length=128)
+        self.constraint = ParseConstraint(self.tokenizer)
+        cache_name = 'parse-cache.pkl'
+        variant = models + (('int8',) if quantize else ()) + (('onnx',) if onnx else ())
+        if variant != ('bert-model', 'parse-model'):
+            # Keep a separate cache per model pair and inference mode so switching does not throw the default cache away
+            cache_name = f'parse-cache-{"-".join(variant)}.pkl'
+        # cache_size=0 disables the cache, without loading or saving the cache file
+        self.cache = ParseCache(get_data_path(cache_name) if cache_size else None, maxsize=cache_size, models=models + ('gpt-j-6B',))
+
+    def anonymize(self, sample: str):
+        # Keyed on the exact sample, the phrases substituted back into the parse are copied from it
+        anonymized = self.cache.anonymized.get(sample)
+        if anonymized is MISSING:
+            anonymized = self.pipe(sample)
+            self.cache.anonymized.put(sample, anonymized)
+        return anonymized
+
+    def model_input(self, sample: str):
+        """Text given to the parse model and the placeholder substitutions to apply to its output"""
+        if self.joint:
+            return joint_input(sample), {}
+        return self.anonymize(sample)
 
     def parse(self, sample: str):
         if not sample:
             raise ValueError("Sample is empty")
-        sentence_anon, subs = self.pipe(sample)
+        sentence_anon, subs = self.model_input(sample)
+        parse = self.parse_anonymized(sentence_anon)
+        return self.fill_phrases(parse, subs)
+
+    def fill_phrases(self, parse: str, subs):
+        # get match count
+        if len(re.findall(r'\[phrase_\d+\]', parse)) != len(subs):
+            raise ParseError("Parse failed")
+        for key, value in subs.items():
+            parse = parse.replace(key, value)
+        return parse
+
+    def parse_batch(self, samples: List[str], batch_size: int = 32) -> List[Optional[str]]:
+        """Parse many samples with batched model calls, None where parsing failed. Results go through the cache like parse()"""
+        unique = list(dict.fromkeys(sample for sample in samples if sample))
+        pending = [sample for sample in unique if not self.joint and sample not in self.cache.anonymized]
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            for sample, anonymized in zip(batch, self.pipe(batch, batch_size=batch_size)):
+                self.cache.anonymized.put(sample, anonymized)
+        templates = {}
+        for sample in unique:
+            sentence_anon, _ = self.model_input(sample)
+            if self.template_key(sentence_anon) not in self.cache.templates:
+                templates.setdefault(self.template_key(sentence_anon), sentence_anon)
+        pending = list(templates.values())
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            for sentence_anon, generated in zip(batch, self.generate(batch)):
+                self.cache.templates.put(self.template_key(sentence_anon), generated)
+        parses = []
+        for sample in samples:
+            try:
+                parses.append(self.parse(sample))
+            except (ParseError, ValueError):
+                parses.append(None)
+        return parses
+
+    def generate(self, sentences_anon: List[str]) -> List[Tuple[str, float, bool]]:
+        """Run the parse model over a batch of anonymized sentences, returning (parse, confidence, complete) for each"""
         model_inputs = self.tokenizer(
-            sentence_anon,
+            sentences_anon,
             max_length=128,
             truncation=True,
+            padding=True,
             return_tensors="pt",
-        )['input_ids']
-        output_space = torch.cat([self.custom_token_ids, model_inputs], dim=1)
-        unique = torch.unique(output_space, dim=1, sorted=False)
-        def allowed_tokens_fn(batch_id, input_ids):
-            return unique[batch_id]
-        output = self.model.generate(model_inputs.to('cuda'), max_length=30, prefix_allowed_tokens_fn=allowed_tokens_fn, num_beams=1, output_scores=True, return_dict_in_generate=True)
+        )
+        allowed_tokens_fn = self.constraint.prefix_allowed_tokens_fn(model_inputs['input_ids'].tolist())
+        output = self.model.generate(
+            model_inputs['input_ids'].to(self.device),
+            attention_mask=model_inputs['attention_mask'].to(self.device),
+            max_length=30,
+            prefix_allowed_tokens_fn=allowed_tokens_fn,
+            num_beams=1,
+            output_scores=True,
+            return_dict_in_generate=True,
+        )
         output_ids = output.sequences
-        logits = torch.cat(output.scores, dim=0)
-        scores, _ = torch.max(torch.nn.functional.softmax(logits, dim=1), dim=1)
-        score = torch.prod(scores)
-        print(score)
-        if score < 0.8:
+        scores = torch.stack([torch.max(torch.nn.functional.softmax(logits, dim=1), dim=1).values for logits in output.scores], dim=1)
+        # Sequences that finished early are padded, those steps do not count towards the confidence
+        scores = torch.where(output_ids[:, 1:] != self.tokenizer.pad_token_id, scores, torch.ones_like(scores))
+        confidences = torch.prod(scores, dim=1).tolist()
+        return [
+            (self.tokenizer.decode(ids, skip_special_tokens=True), confidence, self.constraint.is_complete(ids.tolist()))
+            for ids, confidence in zip(output_ids, confidences)
+        ]
+
+    def check_parse(self, parse: str, score: float, complete: bool, text: str = None):
+        confident = get_thresholds().accept('parse', score)
+        log_score('parse', score, confident and complete, text)
+        if not confident:
             raise ParseError("Low confidence in parse")
-        parse = self.tokenizer.decode(output_ids[0], skip_special_tokens=True)
-        print(sentence_anon)
-        print("Parse:")
-        print(parse)
-        # get match count
-        if len(re.findall(r'\[phrase_\d+\]', parse)) != len(subs):
-            raise ParseError("Parse failed")
-        print(self.tokenizer.convert_ids_to_tokens(output_ids[0]))
-        for key, value in subs.items():
-            parse = parse.replace(key, value)
+        if not complete:
+            raise ParseError("Incomplete parse")
+
+    def template_key(self, sentence_anon: str):
+        return normalize(sentence_anon), get_thresholds().version
+
+    def parse_anonymized(self, sentence_anon: str):
+        # The model output is cached rather than the decision, which is made and its score logged again on every hit
+        key = self.template_key(sentence_anon)
+        generated = self.cache.templates.get(key)
+        if generated is MISSING:
+            generated = self.generate([sentence_anon])[0]
+            self.cache.templates.put(key, generated)
+            print(generated[1])
+            print(sentence_anon)
+            print("Parse:")
+            print(generated[0])
+        parse, score, complete = generated
+        self.check_parse(parse, score, complete, sentence_anon)
         return parse
     
 class TreeParser(TextParser):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, lazy_rephraser: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self._rephraser = None
+        if not lazy_rephraser:
+            self._rephraser = Rephraser(device=self.device)
         self.learned = {}
+        # Called with every sentence given to append_tree and its parse, None when parsing failed
+        self.parse_listener = None
+
+    @property
+    def rephraser(self) -> Rephraser:
+        # Loading GPT-J is slow, offline tools only load it once a phrase is not in the cache
+        if self._rephraser is None:
+            self._rephraser = Rephraser(device=self.device)
+        return self._rephraser
+
+    def rephrase(self, kind: str, phrase: str):
+        key = (kind, normalize(phrase))
+        text = self.cache.rephrasings.get(key)
+        if text is MISSING:
+            text = self.rephraser.rephrase_ask(phrase) if kind == 'ask' else self.rephraser.rephrase_tell(phrase)
+            self.cache.rephrasings.put(key, text)
+        return text
 
     def _extract_fn(self, parse: str):
         function, body = parse.split('(', 1)
@@ -119,14 +243,17 @@ class TreeParser(TextParser):
             return self.build_behavior(parse, tree, current_node)
         except Exception as e:
             print(e)
+            parse = None
             raise ParseError("Parse failed")
+        finally:
+            if self.parse_listener is not None:
+                self.parse_listener(sample, parse)
 
     def build_behavior(self, parse: str, tree: BehaviourTree = None, current_node: Behaviour = None):
         fn, args = self._extract_fn(parse)
         if fn == 'resolve':
             if args[0] in self.learned:
-                b: Behaviour = deepcopy(self.learned[args[0]])
-                b.parent = None
+                b = BehaviourReference(self.learned[args[0]])
             else:
                 b = CustomBehavior(name=args[0])
                 self.learned[args[0]] = b
@@ -144,7 +271,7 @@ class TreeParser(TextParser):
             text = args[0]
             if text.startswith("if") or text.startswith("whether") or text.startswith("what") or text.startswith("for"):
                 print("Rephrasing:", text)
-                text = self.rephraser.rephrase_ask("Ask " + text)
+                text = self.rephrase('ask', "Ask " + text)
                 print("Rephrased:", text)
             b = AskBehavior(text=text)
             if current_node:
@@ -159,8 +286,7 @@ class TreeParser(TextParser):
             if args[0].startswith("about"):
                 behavior_name = "tell them " + args[0]
                 if behavior_name in self.learned:
-                    b: Behaviour = deepcopy(self.learned[behavior_name])
-                    b.parent = None
+                    b = BehaviourReference(self.learned[behavior_name])
                 else:
                     b = CustomBehavior(name=behavior_name)
                     self.learned[behavior_name] = b
@@ -168,7 +294,7 @@ class TreeParser(TextParser):
                     current_node.add_child(b)
                 return b
             print("Rephrasing:", args[0])
-            text = self.rephraser.rephrase_tell("Tell them " + args[0])
+            text = self.rephrase('tell', "Tell them " + args[0])
             print("Rephrased:", text)
             b = SayBehavior(text=text)
             if current_node:
@@ -1,36 +1,36 @@
-from importlib_resources import files, as_file
 import logging
 import datetime
 from pathlib import Path
+from .artifacts import store
 
-def get_logger(name: str, folder: str = None, unique: bool = False):
+def get_logger(name: str, folder: str = None, unique: bool = False, session_id: str = None):
     if unique:
         name = name + '-' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.txt'
-    path = files('multimodal') / 'logs'
+    path = store.log_path()
     if folder is not None:
         path = path / folder
     path = path / name
     logger = logging.getLogger(str(path))
     logger.setLevel(logging.DEBUG)
-    with as_file(path) as p:
-        p.parent.mkdir(parents=True, exist_ok=True)
-        handler = logging.FileHandler(p, mode='w+')
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(path, mode='w+')
+    handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    if session_id is not None:
+        # Turns logged to this logger also go to the session store
+        from .session_store import SessionHandler, get_session_store
+        logger.addHandler(SessionHandler(get_session_store(), session_id))
     return logger
 
 def get_data_path(name: str):
-    data_path = files('multimodal') / 'data' / name
-    with as_file(data_path) as p:
-        if p.is_dir():
-            p.mkdir(parents=True, exist_ok=True)
-        else:
-            p.parent.mkdir(parents=True, exist_ok=True)
-        return p
+    p = store.data_path(name)
+    if p.is_dir():
+        p.mkdir(parents=True, exist_ok=True)
+    else:
+        p.parent.mkdir(parents=True, exist_ok=True)
+    return p
 
 def get_model_path(name: str):
-    model_path = files('multimodal') / 'models' / name
-    with as_file(model_path) as p:
-        return p
\ No newline at end of file
+    return store.model_path(name)
\ No newline at end of file
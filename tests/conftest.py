@@ -0,0 +1,12 @@
+import pytest
+
+@pytest.fixture
+def data_home(tmp_path, monkeypatch):
+    """Point the artifact store at tmp_path so data, logs and the session store written by a test stay there"""
+    from social_itl.artifacts import store
+    from social_itl import session_store
+    monkeypatch.setattr(store, 'root', tmp_path)
+    monkeypatch.setattr(session_store, '_session_store', None)
+    yield tmp_path
+    if session_store._session_store is not None:
+        session_store._session_store.close()
@@ -0,0 +1,51 @@
+import pytest
+np = pytest.importorskip('numpy')
+
+from social_itl.calibration import Thresholds, fit_threshold
+
+def test_fit_threshold_picks_the_cheapest_cut():
+    scores = np.array([.9, .8, .7, .6, .5])
+    correct = np.array([True, True, False, True, False])
+    result = fit_threshold(scores, correct, True, error_cost=3, clarify_cost=1)
+    assert result['threshold'] == pytest.approx(.75)
+    assert result['accept_rate'] == pytest.approx(.4)
+    assert result['error_rate'] == 0
+    assert result['expected_cost'] == pytest.approx(.6)
+
+def test_fit_threshold_on_distances():
+    distances = np.array([.1, .2, .3, .4, .5])
+    correct = np.array([True, True, False, True, False])
+    result = fit_threshold(distances, correct, False, error_cost=3, clarify_cost=1)
+    assert result['threshold'] == pytest.approx(.25)
+    thresholds = Thresholds({'lfd': result['threshold']})
+    assert [thresholds.accept('lfd', d) for d in distances] == [True, True, False, False, False]
+
+@pytest.mark.parametrize('higher', [True, False])
+def test_fit_threshold_edges(higher):
+    scores = np.array([.9, .8, .7, .6, .5])
+    decision = 'parse' if higher else 'lfd'
+    accept_all = fit_threshold(scores, np.ones(5, dtype=bool), higher, error_cost=3, clarify_cost=1)
+    assert accept_all['accept_rate'] == 1
+    thresholds = Thresholds({decision: accept_all['threshold']})
+    assert all(thresholds.accept(decision, s) for s in scores)
+    reject_all = fit_threshold(scores, np.zeros(5, dtype=bool), higher, error_cost=3, clarify_cost=1)
+    assert reject_all['accept_rate'] == 0
+    thresholds = Thresholds({decision: reject_all['threshold']})
+    assert not any(thresholds.accept(decision, s) for s in scores)
+
+def test_thresholds_versions(data_home):
+    assert Thresholds.load().version == 0
+    assert Thresholds.load(0).thresholds == Thresholds().thresholds
+    first = Thresholds({'parse': .75})
+    assert first.save() == 1
+    second = Thresholds({'parse': .6, 'lfd': .3}, fitted={'lfd': {'samples': 5}})
+    assert second.save() == 2
+    current = Thresholds.load()
+    assert current.version == 2
+    assert current['parse'] == .6 and current['lfd'] == .3
+    assert current.fitted == {'lfd': {'samples': 5}}
+    assert Thresholds.load(1)['parse'] == .75
+    assert Thresholds.load(1)['lfd'] is None
+    with pytest.raises(FileNotFoundError):
+        Thresholds.load(3)
+    assert (data_home / 'data' / 'calibration' / 'thresholds-v2.json').exists()
@@ -0,0 +1,62 @@
+import pickle
+import pytest
+np = pytest.importorskip('numpy')
+pytest.importorskip('simcse')
+
+from social_itl import lfd
+from social_itl.lfd import LfD, PooledLfD, pairs_path
+
+demonstrations = {
+    '1': [("hello", "hi, how can I help"), ("where is the bathroom", "down the hall")],
+    '2': [("hello", "welcome"), ("I need a taxi", "I'll call one"), ("thanks", "you're welcome")],
+}
+
+@pytest.fixture
+def fake_embed(monkeypatch):
+    """A one-hot vector per distinct sentence, so every pair of different sentences is sqrt(2) apart"""
+    vocabulary = {}
+    def embed(sentences):
+        vectors = np.zeros((len(sentences), 768), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            vectors[i, vocabulary.setdefault(sentence, len(vocabulary))] = 1
+        return vectors
+    monkeypatch.setattr(lfd, 'embed', embed)
+
+def test_pooled_sync(data_home, fake_embed):
+    (data_home / 'data' / 'lfd').mkdir(parents=True)
+    for participant_id, pairs in demonstrations.items():
+        with open(pairs_path(participant_id), 'wb') as f:
+            pickle.dump(pairs, f)
+    pooled = PooledLfD()
+    assert pooled.sync() == 5
+    assert pooled.ids.tolist() == [1, 1, 2, 2, 2]
+    assert pooled.rows.tolist() == [0, 1, 0, 1, 2]
+    assert pooled.sync() == 0
+
+    # Participant 1 is still demonstrating, only the pair they added is pooled
+    live = LfD('1')
+    live.add_pair("thanks", "have a nice day")
+    assert pooled.sync({'1': live}) == 1
+    assert pooled.manifest['size'] == 6
+    assert pooled.manifest['participants']['1']['count'] == 3
+    assert pooled.ids.tolist() == [1, 1, 2, 2, 2, 1]
+    assert pooled.rows.tolist() == [0, 1, 0, 1, 2, 2]
+
+    matches = pooled.top_k("thanks", "down the hall", k=2)
+    assert [(action, participant_id) for action, _, participant_id in matches] == [("have a nice day", '1'), ("you're welcome", '2')]
+    assert matches[0][1] == pytest.approx(0)
+    assert matches[1][1] == pytest.approx(0.2 * np.sqrt(2))
+    assert pooled.top_k("thanks", "down the hall", exclude=['1'])[0][0] == "you're welcome"
+    assert pooled.get_action("hello", "", participants=['1']) == ("hi, how can I help", pytest.approx(0))
+    assert pooled.get_action("hello", "", exclude=['1']) == ("welcome", pytest.approx(0))
+
+    scores = pooled.scores("hello", "", participants=['2'], exclude=['2'])
+    assert np.isinf(scores).all()
+    with pytest.raises(FileNotFoundError):
+        pooled.get_action("hello", "", participants=['3'])
+
+    # Reopening reads the index back from the manifest and the pair files
+    reopened = PooledLfD()
+    assert reopened.manifest['size'] == 6
+    assert reopened.ids.tolist() == pooled.ids.tolist()
+    assert reopened.top_k("thanks", "down the hall", k=1)[0][0] == "have a nice day"
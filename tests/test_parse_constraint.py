@@ -0,0 +1,16 @@
+from social_itl.nlp.parse_constraint import accepts, joint_example, joint_input
+
+def test_comma_phrases_are_rejected_as_text():
+    assert not accepts('say(well, i think so.)')
+    assert not accepts('if( says(hi there), say(well, okay))')
+
+def test_joint_example_drops_phrase_punctuation():
+    sentence = 'if they say "hi, there" say "well, okay (really)"'
+    parse = 'if( says("hi, there"), say("well, okay (really)"))'
+    assert joint_example(sentence) == 'if they say hi there say well okay really'
+    assert joint_example(parse) == 'if( says(hi there), say(well okay really))'
+    assert accepts(joint_example(parse))
+    assert accepts(joint_example('say("well, i think so.")'))
+
+def test_joint_input_matches_joint_example():
+    assert joint_input('if they say hi, there say well, okay') == joint_example('if they say "hi, there" say "well, okay"')
@@ -0,0 +1,23 @@
+import json
+import pytest
+pytest.importorskip('importlib_resources')
+
+from social_itl.recorder import EventRecorder, INBOUND, OUTBOUND, read_traces, trace_files
+
+def test_rotated_traces_read_back_in_order(tmp_path):
+    recorder = EventRecorder(tmp_path, max_bytes=64, frame_records=4)
+    sent = []
+    for i in range(30):
+        direction = OUTBOUND if i % 3 == 0 else INBOUND
+        message = json.dumps({'event_name': 'furhatos.event.senses.SenseSpeech', 'text': f'turn {i}'})
+        # Outbound messages are recorded as str, inbound ones as they came off the socket
+        recorder.record(direction, message if direction == OUTBOUND else message.encode())
+        sent.append((direction, message))
+    recorder.close()
+    assert len(trace_files(tmp_path)) > 1
+    assert trace_files(tmp_path) == recorder.paths
+    records = list(read_traces(tmp_path))
+    assert [(r.direction, r.message.decode()) for r in records] == sent
+    assert records[5].event['text'] == 'turn 5'
+    times = [r.time for r in records]
+    assert times == sorted(times)
@@ -0,0 +1,66 @@
+import pytest
+pytest.importorskip('py_trees')
+pytest.importorskip('simcse')
+
+from social_itl.nlp.sentence_classifier import SentenceType
+from social_itl.tasklearning.tasklearner import Prompt, Response
+from social_itl.tasklearning.replay import LearningCheckpoint, fast_forward
+
+def prompts():
+    """Stands in for TaskLearner.generate_prompts, with prompts that need no answer between questions"""
+    steps = []
+    while True:
+        response = yield Prompt(f"What should I do after step {len(steps)}?", True)
+        if response.sentence_type == SentenceType.DONE:
+            return
+        if response.sentence_type == SentenceType.MISRECOGNIZED:
+            steps.pop()
+            yield Prompt("I'm sorry I misheard you, let's try again", False)
+            continue
+        steps.append(response.text)
+        if len(steps) % 2 == 0:
+            yield Prompt(f"Okay, {response.text}", False)
+            yield Prompt("Got it", False)
+
+def live_run(gen, responses):
+    """Answer prompts the way DialogAgent.learn does, stopping at the first question left unanswered"""
+    responses = list(responses)
+    prompt = next(gen)
+    while True:
+        if prompt.needs_response:
+            if not responses:
+                return prompt
+            prompt = gen.send(responses.pop(0))
+        else:
+            prompt = next(gen)
+
+responses = [
+    Response("say hello", SentenceType.INSTRUCTION),
+    Response("ask for their name", SentenceType.INSTRUCTION),
+    Response("you misheard me", SentenceType.MISRECOGNIZED),
+    Response("ask how they are", SentenceType.INSTRUCTION),
+    Response("say goodbye", SentenceType.INSTRUCTION),
+]
+
+def test_fast_forward_reaches_the_live_prompt():
+    for n in range(len(responses) + 1):
+        prompt = fast_forward(prompts(), responses[:n])
+        assert prompt.needs_response
+        assert prompt.text == live_run(prompts(), responses[:n]).text
+
+def test_fast_forward_stops_when_learning_finishes():
+    with pytest.raises(StopIteration):
+        fast_forward(prompts(), responses + [Response("you are done", SentenceType.DONE)])
+
+def test_checkpoint_round_trip(data_home):
+    checkpoint = LearningCheckpoint('7')
+    assert checkpoint.load() == []
+    for response in responses:
+        checkpoint.append(response)
+    loaded = checkpoint.load()
+    assert [(r.text, r.sentence_type) for r in loaded] == [(r.text, r.sentence_type) for r in responses]
+    assert fast_forward(prompts(), loaded).text == live_run(prompts(), responses).text
+    checkpoint.clear()
+    assert not checkpoint.path.exists()
+    assert checkpoint.load() == []
+    checkpoint.clear()
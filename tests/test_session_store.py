@@ -0,0 +1,59 @@
+import pytest
+pytest.importorskip('numpy')
+pytest.importorskip('importlib_resources')
+
+from social_itl.session_store import SessionStore, parse_turn, read_log
+
+@pytest.fixture
+def session_store(tmp_path):
+    store = SessionStore(tmp_path / 'social_itl.sqlite')
+    yield store
+    store.close()
+
+def test_writes_are_queryable_after_flush(session_store):
+    session_id = session_store.start_session(3, 'learning_dialog')
+    session_store.add_turn(session_id, 'robot', 'What should I do after a person approaches me?')
+    session_store.add_turn(session_id, 'user', 'say hello')
+    session_store.add_parse(session_id, 'say hello', 'say(hello)')
+    session_store.add_parse(session_id, 'mumble', None)
+    session_store.flush()
+    assert [tuple(row) for row in session_store.query('SELECT id, kind FROM sessions')] == [(session_id, 'learning_dialog')]
+    session = session_store.sessions(participant_id=3)[0]
+    assert session['ended'] >= session['started']
+    turns = session_store.turns(kind='learning_dialog')['3']
+    assert [(row['speaker'], row['text']) for row in turns] == [('robot', 'What should I do after a person approaches me?'), ('user', 'say hello')]
+    parses = session_store.query('SELECT sentence, parse, accepted FROM parses ORDER BY id')
+    assert [tuple(row) for row in parses] == [('say hello', 'say(hello)', 1), ('mumble', None, 0)]
+
+def test_failed_write_keeps_the_rest_of_the_batch(session_store):
+    session_id = session_store.start_session(4, 'lfd')
+    session_store.add_turn(session_id, 'customer', 'hello', when=1.0)
+    # The participant already exists, so this insert fails in the middle of the batch
+    session_store.write('INSERT INTO participants VALUES (?, ?)', ('4', 0.0))
+    session_store.add_turn(session_id, 'employee', 'hi there', when=2.0)
+    session_store.flush()
+    assert [row['text'] for row in session_store.turns()['4']] == ['hello', 'hi there']
+    # The writer is still running
+    session_store.add_turn(session_id, 'customer', 'thanks', when=3.0)
+    session_store.flush()
+    assert len(session_store.turns()['4']) == 3
+
+def test_parse_turn():
+    assert parse_turn('Robot: Hello there') == ('robot', 'Hello there', None)
+    assert parse_turn('User:  say hello ') == ('user', 'say hello', None)
+    # Only prompts and responses carry a label, other speakers keep their brackets
+    assert parse_turn('Customer: a coffee (large)') == ('customer', 'a coffee (large)', None)
+    assert parse_turn('Response: say hi (SentenceType.INSTRUCTION)') == ('response', 'say hi', 'SentenceType.INSTRUCTION')
+    assert parse_turn('Prompt: How do I greet people? (True)') == ('prompt', 'How do I greet people?', 'True')
+    assert parse_turn('Match distance: 0.4210') is None
+
+def test_read_log(tmp_path):
+    path = tmp_path / 'Participant-3-20240102030405.txt'
+    path.write_text('2024-01-02 03:04:05,678 - Robot: Hello\n'
+                    '2024-01-02 03:04:07,010 - User: first line\n'
+                    'second line\n'
+                    '2024-01-02 03:04:08,000 - Match distance: 0.4210\n')
+    records = read_log(path)
+    assert [message for _, message in records] == ['Robot: Hello', 'User: first line\nsecond line', 'Match distance: 0.4210']
+    assert records[1][0] - records[0][0] == pytest.approx(1.332)
+    assert [parse_turn(message) for _, message in records][:2] == [('robot', 'Hello', None), ('user', 'first line\nsecond line', None)]
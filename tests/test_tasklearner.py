@@ -0,0 +1,45 @@
+import pytest
+pytest.importorskip('py_trees')
+pytest.importorskip('simcse')
+
+from social_itl.tasklearning.behaviours import Conditional, LearnableSequence, NullBehaviour
+from social_itl.tasklearning.tasklearner import TaskLearner, UnlearnedIndex
+
+def test_unlearned_index_follows_edits():
+    # The recursive search only needs the learner when it starts from the index, so skip loading the parser
+    learner = TaskLearner.__new__(TaskLearner)
+    def check(expected):
+        assert learner.find_unlearned_behaviour(root) is expected
+        assert index.find() is expected
+
+    root = LearnableSequence(name="Root")
+    greet = LearnableSequence(name="Greet")
+    conditional = Conditional(NullBehaviour(), NullBehaviour())
+    greet.add_children([NullBehaviour(), conditional])
+    farewell = LearnableSequence(name="Farewell")
+    root.add_children([NullBehaviour(), greet, farewell])
+    index = UnlearnedIndex(root)
+    check(conditional.if_statement)
+
+    # A new behaviour deep in the tree
+    deep = LearnableSequence(name="Deep")
+    conditional.if_statement.add_child(deep)
+    check(deep)
+
+    # A node on the path is learned, the search moves on to its sibling
+    conditional.if_statement.learned = True
+    check(conditional.else_statement)
+
+    # The subtree holding the path is removed
+    root.remove_child(greet)
+    check(farewell)
+
+    # The node the path ends at is replaced
+    replacement = LearnableSequence(name="Replacement")
+    step = LearnableSequence(name="Step")
+    replacement.add_child(step)
+    root.replace_child(farewell, replacement)
+    check(step)
+
+    step.learned = True
+    check(replacement)